@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Memory of loaded inventory: json dicts vs Host records
+#
+# tracemalloc needs python 3
+#
+# Example:
+#   ./benchmarks/host_memory.py --hosts 100000
+import os
+import sys
+import json
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'shared'))
+
+from helper import Host
+from inventory import gen_hosts
+
+
+def measure(build):
+    tracemalloc.start()
+    data = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return current, peak
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='host_memory', description='Host records memory benchmark')
+    arg_parser.add_argument('--hosts', type=int, default=100000)
+    args = arg_parser.parse_args()
+
+    # loaders decode what redis returns
+    raw = [json.dumps(host) for host in gen_hosts(args.hosts)]
+
+    dicts, dicts_peak = measure(lambda: [json.loads(host) for host in raw])
+    hosts, hosts_peak = measure(lambda: [Host(json.loads(host)) for host in raw])
+
+    mb = 1024.0 * 1024
+    print('hosts: {0}'.format(args.hosts))
+    print('{0:<12} {1:>12} {2:>12} {3:>14}'.format('records', 'kept, MB', 'peak, MB', 'per host, B'))
+    print('{0:<12} {1:>12.1f} {2:>12.1f} {3:>14.0f}'.format('dict', dicts / mb, dicts_peak / mb, dicts / args.hosts))
+    print('{0:<12} {1:>12.1f} {2:>12.1f} {3:>14.0f}'.format('Host', hosts / mb, hosts_peak / mb, hosts / args.hosts))
+    print('saved: {0:.1f} MB ({1:.0f}%)'.format((dicts - hosts) / mb, 100.0 * (dicts - hosts) / dicts))
+
+
+if __name__ == '__main__':
+    main()
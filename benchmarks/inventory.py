@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Synthetic inventory generator shared by benchmarks
+import json
+import random
+
+OS_VERSIONS = ['centos7', 'centos6', 'debian8', 'debian9', 'ubuntu16', 'ubuntu14']
+DATACENTERS = ['sel-msk', 'sel-spb', 'do-ams3', 'do-nyc', 'aws-eu', 'aws-us', 'hz-fsn']
+ROLES = ['prod', 'dev', 'reserve', 'db', 'web', 'cache', 'lb', 'worker']
+
+
+def gen_hosts(count, projects=None, seed=42, first_id=100001):
+    # same seed -> same inventory, results stay comparable between runs
+    rnd = random.Random(seed)
+    if projects is None:
+        projects = max(count // 50, 1)
+    project_names = ['project{0:04d}'.format(i) for i in range(projects)]
+
+    hosts = []
+    for i in range(count):
+        server_id = first_id + i
+        hosts.append({
+            'server_id': server_id,
+            'project_name': rnd.choice(project_names),
+            'server_name': '{0}-{1}-{2}'.format(rnd.choice(DATACENTERS), rnd.choice(ROLES), i),
+            'server_ip': '10.{0}.{1}.{2}'.format((i >> 16) & 255, (i >> 8) & 255, i & 255),
+            'server_port': rnd.choice([None, 22, 2222]),
+            'server_user': rnd.choice([None, 'support', 'dealer']),
+            'server_nosudo': rnd.random() < 0.1,
+            'proxy_id': None,
+            'os_version': rnd.choice(OS_VERSIONS),
+            'updated_by': 'bench',
+            'updated_at': 1500000000 + i,
+        })
+    return hosts
+
+
+def seed_redis(redis, hosts, batch=1000):
+    # writes hosts the way auth-manager.py add-host does
+    pipe = redis.pipeline(transaction=False)
+    for i, host in enumerate(hosts, 1):
+        pipe.set('server_' + str(host['server_id']), json.dumps(host))
+        if i % batch == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+class StaticSource(object):
+    # stands for a loaded AuthHelper, see AuthHelper(source=...)
+    redis = None
+    inventory_version = None
+    search_index = None
+    proxies = None
+    storage_layout = 'json'
+
+    def __init__(self, hosts):
+        from helper import Host
+        self.hosts_dump = sorted((Host(host) for host in hosts), key=lambda host: host['project_name'])
+        self.projects = sorted(set(host['project_name'] for host in hosts))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compare AuthHelper loaders on a synthetic inventory
+#
+# Uses a separate redis db (AUTH_BENCH_DB, default 15) which is flushed!
+#
+# Example:
+#   AUTH_REDIS_PASS=... ./benchmarks/load_data.py --hosts 50000 --batch 500 --batch 2000
+import os
+import sys
+import json
+import argparse
+import shutil
+import tempfile
+from time import time
+from redis import Redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'shared'))
+
+from helper import AuthHelper, Host
+from inventory import gen_hosts, seed_redis
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        time_start = time()
+        func()
+        timings.append(time() - time_start)
+    return min(timings), sum(timings) / len(timings)
+
+
+def load_data_keys(helper):
+    # old KEYS + GET per host loader, json layout of seed_redis
+    helper.hosts_dump = []
+    helper.projects = []
+
+    for server_key in helper.redis.keys('server_*'):
+        server_data = Host(json.loads(helper.redis.get(server_key)))
+
+        helper.projects.append(server_data['project_name'])
+        helper.hosts_dump.append(server_data)
+
+    helper._finish_load()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='load_data', description='AuthHelper loaders benchmark')
+    arg_parser.add_argument('--hosts', type=int, default=20000)
+    arg_parser.add_argument('--batch', type=int, action='append', help='MGET batch size, may be repeated')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--skip-keys', action='store_true', help='do not run old KEYS + GET loader')
+    args = arg_parser.parse_args()
+
+    # AuthHelper loads data on init, point it to the bench db too
+    db = int(os.getenv('AUTH_BENCH_DB', 15))
+    os.environ['AUTH_REDIS_DB'] = str(db)
+    os.environ['AUTH_CACHE_DIR'] = tempfile.mkdtemp(prefix='auth-bench-')
+    redis = Redis(host=os.getenv('AUTH_REDIS_IP', '127.0.0.1'),
+                  port=int(os.getenv('AUTH_REDIS_PORT', 6379)),
+                  password=os.getenv('AUTH_REDIS_PASS', 'te2uth4dohLi8i'),
+                  db=db)
+    redis.flushdb()
+    seed_redis(redis, gen_hosts(args.hosts))
+
+    helper = AuthHelper(None, None)
+
+    print('hosts: {0}, redis db: {1}, repeat: {2}'.format(args.hosts, db, args.repeat))
+    print('{0:<24} {1:>10} {2:>10}'.format('loader', 'min, sec', 'avg, sec'))
+
+    if not args.skip_keys:
+        print('{0:<24} {1:>10.3f} {2:>10.3f}'.format('keys + get', *timeit(lambda: load_data_keys(helper), args.repeat)))
+
+    for batch in args.batch or [100, 1000, 5000]:
+        helper.AUTH_REDIS_BATCH = batch
+        label = 'scan + mget({0})'.format(batch)
+        print('{0:<24} {1:>10.3f} {2:>10.3f}'.format(label, *timeit(helper._load_data_redis, args.repeat)))
+
+    helper._save_snapshot('1')
+    print('{0:<24} {1:>10.3f} {2:>10.3f}'.format('snapshot', *timeit(lambda: helper._load_snapshot('1'),
+                                                                      args.repeat)))
+
+    redis.flushdb()
+    shutil.rmtree(os.environ['AUTH_CACHE_DIR'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# In-process stand-in for the redis-py client, only commands used by
+# helper.py and auth-manager.py. Values are returned as bytes like redis-py does.
+#
+# Benchmarks run without redis server with it, network round trips are
+# not part of its timings: use --redis for a real server.
+#
+import fnmatch
+
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, str):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+class MemPipeline(object):
+
+    def __init__(self, redis, immediate=False):
+        self.redis = redis
+        self.immediate = immediate
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.redis, name)
+
+        def queue(*args, **kwargs):
+            if self.immediate:
+                return command(*args, **kwargs)
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def watch(self, *keys):
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+    def reset(self):
+        self.commands = []
+
+
+class MemRedis(object):
+
+    def __init__(self):
+        self.data = dict()
+        self.commands = 0
+        self.last_stream_id = 0
+
+    def _string(self, key):
+        value = self.data.get(to_bytes(key))
+        return value if isinstance(value, bytes) else None
+
+    # connection
+    def ping(self):
+        return True
+
+    def info(self, section=None):
+        return dict(redis_version='5.0.0')
+
+    def pipeline(self, transaction=True):
+        return MemPipeline(self)
+
+    def transaction(self, func, *watches, **kwargs):
+        pipe = MemPipeline(self, immediate=True)
+        func(pipe)
+        return pipe.execute()
+
+    def flushdb(self):
+        self.data.clear()
+
+    # keys
+    def exists(self, *keys):
+        self.commands += 1
+        return sum(1 for key in keys if to_bytes(key) in self.data)
+
+    def delete(self, *keys):
+        self.commands += 1
+        return sum(1 for key in keys if self.data.pop(to_bytes(key), None) is not None)
+
+    def expire(self, key, seconds):
+        return to_bytes(key) in self.data
+
+    def keys(self, pattern='*'):
+        self.commands += 1
+        return [key for key in list(self.data) if fnmatch.fnmatchcase(key.decode('utf-8'), pattern)]
+
+    def scan_iter(self, match='*', count=None):
+        return iter(self.keys(match))
+
+    def type(self, key):
+        value = self.data.get(to_bytes(key))
+        if value is None:
+            return b'none'
+        return {bytes: b'string', set: b'set', dict: b'hash', list: b'stream'}[type(value)]
+
+    # strings
+    def get(self, key):
+        self.commands += 1
+        return self._string(key)
+
+    def set(self, key, value, **kwargs):
+        self.commands += 1
+        self.data[to_bytes(key)] = to_bytes(value)
+        return True
+
+    def setex(self, key, seconds, value):
+        return self.set(key, value)
+
+    def setnx(self, key, value):
+        if to_bytes(key) in self.data:
+            return False
+        return self.set(key, value)
+
+    def mget(self, keys, *args):
+        self.commands += 1
+        if isinstance(keys, (str, bytes)):
+            keys = [keys] + list(args)
+        return [self._string(key) for key in keys]
+
+    def incrby(self, key, amount=1):
+        self.commands += 1
+        value = int(self._string(key) or 0) + amount
+        self.data[to_bytes(key)] = to_bytes(value)
+        return value
+
+    def incr(self, key, amount=1):
+        return self.incrby(key, amount)
+
+    # sets
+    def sadd(self, key, *values):
+        self.commands += 1
+        members = self.data.setdefault(to_bytes(key), set())
+        before = len(members)
+        members.update(to_bytes(value) for value in values)
+        return len(members) - before
+
+    def srem(self, key, *values):
+        self.commands += 1
+        members = self.data.get(to_bytes(key), set())
+        before = len(members)
+        members.difference_update(to_bytes(value) for value in values)
+        if not members:
+            self.data.pop(to_bytes(key), None)
+        return before - len(members)
+
+    def smembers(self, key):
+        self.commands += 1
+        return set(self.data.get(to_bytes(key), set()))
+
+    def sismember(self, key, value):
+        self.commands += 1
+        return to_bytes(value) in self.data.get(to_bytes(key), set())
+
+    def scard(self, key):
+        self.commands += 1
+        return len(self.data.get(to_bytes(key), set()))
+
+    # hashes
+    def hget(self, key, field):
+        self.commands += 1
+        return self.data.get(to_bytes(key), {}).get(to_bytes(field))
+
+    def hmget(self, key, fields, *args):
+        self.commands += 1
+        if isinstance(fields, (str, bytes)):
+            fields = [fields] + list(args)
+        values = self.data.get(to_bytes(key), {})
+        return [values.get(to_bytes(field)) for field in fields]
+
+    def hgetall(self, key):
+        self.commands += 1
+        return dict(self.data.get(to_bytes(key), {}))
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        self.commands += 1
+        values = self.data.setdefault(to_bytes(key), dict())
+        if field is not None:
+            values[to_bytes(field)] = to_bytes(value)
+        for field, value in (mapping or {}).items():
+            values[to_bytes(field)] = to_bytes(value)
+        return 1
+
+    def hmset(self, key, mapping):
+        return self.hset(key, mapping=mapping)
+
+    def hdel(self, key, *fields):
+        self.commands += 1
+        values = self.data.get(to_bytes(key), {})
+        removed = sum(1 for field in fields if values.pop(to_bytes(field), None) is not None)
+        if not values:
+            self.data.pop(to_bytes(key), None)
+        return removed
+
+    # streams: ids are a counter, entries are (id, fields) in a list
+    def xadd(self, key, fields, id='*', maxlen=None, approximate=True):
+        self.commands += 1
+        self.last_stream_id += 1
+        entry_id = to_bytes('0-{0}'.format(self.last_stream_id))
+        entries = self.data.setdefault(to_bytes(key), list())
+        entries.append((entry_id, dict((to_bytes(field), to_bytes(value)) for field, value in fields.items())))
+        if maxlen is not None and len(entries) > maxlen:
+            del entries[:len(entries) - maxlen]
+        return entry_id
+
+    def xrange(self, key, min='-', max='+', count=None):
+        self.commands += 1
+        start = 0 if min == '-' else int(to_bytes(min).split(b'-')[1])
+        entries = [entry for entry in self.data.get(to_bytes(key), []) if int(entry[0].split(b'-')[1]) >= start]
+        return entries[:count] if count else entries
+
+    def xrevrange(self, key, max='+', min='-', count=None):
+        entries = list(reversed(self.xrange(key)))
+        return entries[:count] if count else entries
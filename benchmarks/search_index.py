@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# AuthHelper.search and AuthHelper.rank (top --limit): linear scan vs trigram index
+# on a synthetic inventory
+#
+# Example:
+#   ./benchmarks/search_index.py --hosts 100000 --query prod-12 --query 10.1.2
+import os
+import sys
+import argparse
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'shared'))
+
+from helper import AuthHelper
+from inventory import gen_hosts, StaticSource
+
+QUERIES = ['prod', 'sel-msk-db', '10.1.2.3', 'centos', 'project0042', '100777', 'nosuchhost', 'sel-mks-db']
+
+
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        time_start = time()
+        result = func()
+        timings.append(time() - time_start)
+    return min(timings), [host['server_id'] for host in result]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='search_index', description='AuthHelper.search benchmark')
+    arg_parser.add_argument('--hosts', type=int, default=100000)
+    arg_parser.add_argument('--query', type=str, action='append')
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--limit', type=int, default=20, help='rank: top hosts')
+    args = arg_parser.parse_args()
+
+    helper = AuthHelper(None, None, source=StaticSource(gen_hosts(args.hosts)))
+
+    time_start = time()
+    helper.build_search_index()
+    print('hosts: {0}, index build: {1:.3f} sec, trigrams: {2}'.format(
+        args.hosts, time() - time_start, len(helper.search_index)))
+    print('{0:<16} {1:>8} {2:>12} {3:>12} {4:>8} {5:>12} {6:>12}'.format(
+        'query', 'matches', 'scan, ms', 'index, ms', 'speedup', 'rank, ms', 'rank idx, ms'))
+
+    search_index = helper.search_index
+    for query in args.query or QUERIES:
+        helper.search_index = None
+        scan_time, scan_result = timeit(lambda: helper.search(query), args.repeat)
+        helper.search_index = search_index
+        index_time, index_result = timeit(lambda: helper.search(query), args.repeat)
+
+        helper.search_index = None
+        rank_time, rank_result = timeit(lambda: helper.rank(query, limit=args.limit), args.repeat)
+        helper.search_index = search_index
+        rank_index_time, rank_index_result = timeit(lambda: helper.rank(query, limit=args.limit), args.repeat)
+
+        if scan_result != index_result or rank_result != rank_index_result:
+            print('{0}: results differ, scan {1} vs index {2}'.format(query, len(scan_result), len(index_result)))
+            sys.exit(1)
+
+        print('{0:<16} {1:>8} {2:>12.2f} {3:>12.2f} {4:>7.1f}x {5:>12.2f} {6:>12.2f}'.format(
+            query, len(scan_result), scan_time * 1000, index_time * 1000, scan_time / max(index_time, 1e-9),
+            rank_time * 1000, rank_index_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
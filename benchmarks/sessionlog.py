@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Session log write/read throughput and CPU cost per compression mode
+#
+# Output is synthetic terminal output (logs, top-like tables, random noise)
+# written in pty sized chunks through SessionWriter, like ssh.py does.
+#
+# Example:
+#   ./benchmarks/sessionlog.py --size 256 --mode none --mode gzip:1 --mode gzip:6 --mode zstd:3
+import os
+import sys
+import random
+import shutil
+import argparse
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'wrappers'))
+
+from sessionlog import SessionWriter, read_records, READ_SIZE
+
+
+def gen_output(size, seed=42):
+    rnd = random.Random(seed)
+    chunks = []
+    total = 0
+    while total < size:
+        kind = rnd.random()
+        if kind < 0.6:
+            line = '2017-01-22 18:{0:02d}:{1:02d} app[{2}]: GET /api/v1/items/{3} 200 {4}ms\r\n'.format(
+                rnd.randint(0, 59), rnd.randint(0, 59), rnd.randint(1000, 9999),
+                rnd.randint(1, 10 ** 6), rnd.randint(1, 900))
+        elif kind < 0.9:
+            line = '{0:>6} www-data  20   0 {1:>8} {2:>6} S {3:>5.1f} {4:>4.1f} nginx\r\n'.format(
+                rnd.randint(1, 65535), rnd.randint(10 ** 4, 10 ** 6), rnd.randint(100, 99999),
+                rnd.random() * 100, rnd.random() * 10)
+        else:
+            line = ''.join(chr(rnd.randint(33, 126)) for _ in range(rnd.randint(20, 200))) + '\r\n'
+        data = line.encode('utf-8')
+        chunks.append(data)
+        total += len(data)
+    return b''.join(chunks)
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def bench_mode(mode, output, chunk_size, segment_size, base_dir):
+    compression, _, level = mode.partition(':')
+    level = int(level) if level else None
+    path = os.path.join(base_dir, compression + str(level))
+
+    time_start, cpu_start = time(), cpu_time()
+    writer = SessionWriter(path, compression=compression, level=level, segment_size=segment_size)
+    for offset in range(0, len(output), chunk_size):
+        writer.write(output[offset:offset + chunk_size])
+        writer.flush_due()
+    writer.close()
+    write_time, write_cpu = time() - time_start, cpu_time() - cpu_start
+
+    size = sum(segment['size'] for segment in writer.segments)
+    paths = [segment['path'] for segment in writer.segments]
+
+    time_start = time()
+    read = 0
+    for segment_path in paths:
+        for _, data in read_records(segment_path):
+            read += len(data)
+    read_time = time() - time_start
+    assert read == len(output)
+
+    for segment_path in paths:
+        os.unlink(segment_path)
+
+    return dict(mode=mode, write_time=write_time, write_cpu=write_cpu, read_time=read_time,
+                size=size, segments=len(paths))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='sessionlog', description='session log benchmark')
+    arg_parser.add_argument('--size', type=int, default=128, help='output size, MB')
+    arg_parser.add_argument('--chunk', type=int, default=READ_SIZE, help='pty read size')
+    arg_parser.add_argument('--segment-size', type=int, default=None, help='segment size, MB')
+    arg_parser.add_argument('--mode', type=str, action='append', help='compression[:level]')
+    args = arg_parser.parse_args()
+
+    modes = args.mode or ['none', 'gzip:1', 'gzip:6', 'zstd:3']
+    segment_size = args.segment_size * 1024 * 1024 if args.segment_size else None
+    output = gen_output(args.size * 1024 * 1024)
+    megabytes = len(output) / 1024.0 / 1024
+
+    base_dir = tempfile.mkdtemp(prefix='auth-bench-log-')
+    print('{0:<10} {1:>12} {2:>12} {3:>12} {4:>10} {5:>9}'.format(
+        'mode', 'write, MB/s', 'cpu, s/GB', 'read, MB/s', 'ratio', 'segments'))
+    try:
+        for mode in modes:
+            try:
+                result = bench_mode(mode, output, args.chunk, segment_size, base_dir)
+            except ImportError as e:
+                print('{0:<10} skipped: {1}'.format(mode, e))
+                continue
+            print('{0:<10} {1:>12.1f} {2:>12.2f} {3:>12.1f} {4:>10.2f} {5:>9}'.format(
+                mode, megabytes / result['write_time'], result['write_cpu'] / megabytes * 1024,
+                megabytes / result['read_time'], len(output) / float(result['size']), result['segments']))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Startup time of helper.py for direct address connects:
+# from interpreter start to written session file (process exit)
+#
+# redis is pointed to a closed port, the path must not need it
+#
+# Example:
+#   ./benchmarks/startup.py --repeat 50 --python python2.7
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+from time import time
+
+HELPER = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'shared', 'helper.py')
+
+
+def measure(cmd, env, repeat, session_path=None):
+    timings = []
+    for _ in range(repeat):
+        if session_path is not None and os.path.exists(session_path):
+            os.unlink(session_path)
+
+        time_start = time()
+        subprocess.check_call(cmd, env=env, stdout=subprocess.PIPE)
+        timings.append(time() - time_start)
+
+        if session_path is not None and not os.path.exists(session_path):
+            print('session file was not written by: ' + ' '.join(cmd))
+            sys.exit(1)
+
+    timings.sort()
+    return timings[0], timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='startup', description='helper.py startup benchmark')
+    arg_parser.add_argument('--repeat', type=int, default=30)
+    arg_parser.add_argument('--python', type=str, default=sys.executable)
+    arg_parser.add_argument('--target', type=str, action='append', help='g argument, default: ip and fqdn')
+    args = arg_parser.parse_args()
+
+    session_fd, session_path = tempfile.mkstemp(prefix='auth-bench-sess-')
+    os.close(session_fd)
+
+    env = dict(os.environ)
+    env.update(AUTH_SESSION=session_path, AUTH_REDIS_IP='127.0.0.1', AUTH_REDIS_PORT='1')
+
+    print('{0:<32} {1:>10} {2:>10} {3:>10}'.format('command', 'min, ms', 'p50, ms', 'p99, ms'))
+    row = '{0:<32} {1:>10.1f} {2:>10.1f} {3:>10.1f}'
+
+    timings = measure([args.python, '-c', 'pass'], env, args.repeat)
+    print(row.format('interpreter only', *[t * 1000 for t in timings]))
+
+    for target in args.target or ['10.0.0.1', 'node1.example.org']:
+        timings = measure([args.python, HELPER, 'go', target], env, args.repeat, session_path)
+        print(row.format('g ' + target, *[t * 1000 for t in timings]))
+
+    os.unlink(session_path)
+
+
+if __name__ == '__main__':
+    main()
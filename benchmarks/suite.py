@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# helper.py hot paths on synthetic inventories: p50/p99 time and peak memory per phase
+#
+# Inventory is written by auth-manager.py write_hosts() (records, indexes, version)
+# to in-process memredis by default, or to a real redis db with --redis
+# (AUTH_BENCH_DB, default 15, is flushed!).
+#
+# tracemalloc needs python 3
+#
+# Example:
+#   ./benchmarks/suite.py --sizes 1000,10000,100000 --repeat 20
+#   ./benchmarks/suite.py --sizes 10000 --redis --json /tmp/bench.json
+#   ./benchmarks/suite.py --sizes 10000 --layout hash
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import importlib.util
+from io import StringIO
+from time import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+SHARED_DIR = os.path.join(BENCH_DIR, '..', 'shared')
+sys.path.insert(0, SHARED_DIR)
+
+# helper first: its logging setup wins over auth-manager.py one
+import helper
+from inventory import gen_hosts
+from memredis import MemRedis
+
+
+def load_auth_manager():
+    spec = importlib.util.spec_from_file_location('auth_manager', os.path.join(SHARED_DIR, 'auth-manager.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def connect(args):
+    if not args.redis:
+        return MemRedis()
+    from redis import Redis
+    redis = Redis(host=os.getenv('AUTH_REDIS_IP', '127.0.0.1'),
+                  port=int(os.getenv('AUTH_REDIS_PORT', 6379)),
+                  password=os.getenv('AUTH_REDIS_PASS', 'te2uth4dohLi8i'),
+                  db=int(os.getenv('AUTH_BENCH_DB', 15)))
+    redis.flushdb()
+    return redis
+
+
+def seed(redis, size, layout='json', batch=1000):
+    auth_manager = load_auth_manager()
+    hosts = gen_hosts(size)
+    for offset in range(0, size, batch):
+        auth_manager.write_hosts(redis, add=hosts[offset:offset + batch])
+    if layout != 'json':
+        auth_manager.migrate(redis, layout, batch)
+    auth_manager.reindex(redis)
+    return hosts
+
+
+def percentile(timings, rate):
+    timings = sorted(timings)
+    return timings[min(int(len(timings) * rate), len(timings) - 1)]
+
+
+class Phase(object):
+
+    def __init__(self, size, name, func, setup=None):
+        self.size = size
+        self.name = name
+        self.func = func
+        self.setup = setup
+
+    def run(self, repeat):
+        timings = []
+        for _ in range(repeat):
+            state = self.setup() if self.setup else None
+            time_start = time()
+            self.func(state)
+            timings.append(time() - time_start)
+
+        # one more run for memory, tracemalloc slows everything down
+        state = self.setup() if self.setup else None
+        tracemalloc.start()
+        self.func(state)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return dict(size=self.size, phase=self.name, p50=percentile(timings, 0.5),
+                    p99=percentile(timings, 0.99), peak=peak)
+
+
+def new_helper(redis, argv=None, environ=None):
+    args, unknown_args = helper.init_args(argv) if argv else (None, None)
+    auth_helper = helper.AuthHelper(args, unknown_args, environ=environ)
+    auth_helper.redis = redis
+    return auth_helper
+
+
+def dispatch(redis, environ, argv):
+    # main() without process start: argv parse, helper, run, output
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        args, unknown_args = helper.init_args(argv)
+        auth_helper = helper.AuthHelper(args, unknown_args, environ=environ)
+        auth_helper.redis = redis
+        helper.run(auth_helper, args, unknown_args)
+    finally:
+        sys.stdout = stdout
+
+
+def phases(redis, size, hosts, environ):
+    version = redis.get('inventory_version').decode()
+    host = hosts[size // 2]
+    queries = ['prod', 'sel-msk-db', host['server_ip'], 'project0001']
+
+    def loaded():
+        auth_helper = new_helper(redis, environ=environ)
+        auth_helper._load_data()
+        return auth_helper
+
+    warm = loaded()
+    indexed = loaded()
+    indexed.build_search_index()
+
+    yield Phase(size, 'load redis', lambda h: h._load_data_redis(), lambda: new_helper(redis, environ=environ))
+    yield Phase(size, 'load snapshot', lambda h: h._load_snapshot(version), lambda: new_helper(redis, environ=environ))
+    yield Phase(size, 'build index', lambda h: h.build_search_index(), loaded)
+
+    for query in queries:
+        yield Phase(size, 'search scan ' + query, lambda _, q=query: warm.search(q))
+        yield Phase(size, 'search index ' + query, lambda _, q=query: indexed.search(q))
+
+    renderer = new_helper(redis, argv=['search', 'prod'], environ=environ)
+    results = warm.search('prod')
+
+    def render(_):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            renderer.print_hosts(results)
+        finally:
+            sys.stdout = stdout
+
+    yield Phase(size, 'render {0} hosts'.format(len(results)), render)
+
+    for argv in [['search', 'prod'],
+                 ['search', host['project_name'], host['server_name']],
+                 ['go', str(host['server_id'])],
+                 ['go', host['project_name'], host['server_name']],
+                 ['go', '10.255.0.1']]:
+        yield Phase(size, 'main ' + ' '.join(argv), lambda _, a=argv: dispatch(redis, environ, a))
+
+    # resident helper after one add-host: change log entries instead of full reload
+    auth_manager = load_auth_manager()
+
+    def changed():
+        auth_helper = loaded()
+        auth_manager.write_hosts(redis, add=[host])
+        return auth_helper
+
+    yield Phase(size, 'refresh after 1 change', lambda h: h.refresh(), changed)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='suite', description='helper.py benchmark suite')
+    arg_parser.add_argument('--sizes', type=str, default='1000,10000,100000')
+    arg_parser.add_argument('--repeat', type=int, default=10)
+    arg_parser.add_argument('--redis', action='store_true', help='use local redis instead of memredis')
+    arg_parser.add_argument('--json', type=str, help='write results to file')
+    arg_parser.add_argument('--layout', choices=sorted(helper.STORAGE_LAYOUTS), default='json',
+                            help='host records storage layout')
+    args = arg_parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='auth-bench-')
+    session_fd, session_path = tempfile.mkstemp(prefix='auth-bench-sess-')
+    os.close(session_fd)
+    environ = dict(os.environ, AUTH_CACHE_DIR=cache_dir, AUTH_SESSION=session_path, AUTH_COLORS='false')
+
+    results = []
+    row = '{size:>8} {phase:<48} {p50:>10.2f} {p99:>10.2f} {peak:>10.1f}'
+    print('{0:>8} {1:<48} {2:>10} {3:>10} {4:>10}'.format('hosts', 'phase', 'p50, ms', 'p99, ms', 'peak, MB'))
+
+    for size in [int(size) for size in args.sizes.split(',')]:
+        redis = connect(args)
+        hosts = seed(redis, size, args.layout)
+
+        for phase in phases(redis, size, hosts, environ):
+            result = phase.run(args.repeat)
+            results.append(result)
+            print(row.format(size=size, phase=result['phase'], p50=result['p50'] * 1000,
+                             p99=result['p99'] * 1000, peak=result['peak'] / 1024.0 / 1024))
+            sys.stdout.flush()
+
+        if args.redis:
+            redis.flushdb()
+
+    shutil.rmtree(cache_dir)
+    os.unlink(session_path)
+
+    if args.json:
+        with open(args.json, 'w') as json_f:
+            json.dump(results, json_f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ssh time to first remote output, with and without connection multiplexing
+#
+# direct: full handshake every time (ssh.py --no-mux)
+# mux:    sessions over a warm ControlMaster (ssh.py default after first g)
+#
+# Needs a reachable ssh target and key auth.
+#
+# Example:
+#   ./benchmarks/time_to_prompt.py 10.0.3.7 --user support --repeat 20
+#   ./benchmarks/time_to_prompt.py 10.0.3.7 -o ProxyJump=support@1.2.3.4 -F /opt/auth/configs/defaults.conf
+import os
+import shutil
+import argparse
+import tempfile
+import subprocess
+from time import time
+
+MARKER = '__auth_prompt__'
+
+
+def percentile(timings, rate):
+    timings = sorted(timings)
+    return timings[min(int(len(timings) * rate), len(timings) - 1)]
+
+
+def time_to_output(cmd):
+    time_start = time()
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.stdin.close()
+    elapsed = None
+    for line in iter(proc.stdout.readline, b''):
+        if MARKER.encode('utf-8') in line:
+            elapsed = time() - time_start
+            break
+    proc.stdout.close()
+    if proc.wait() != 0 or elapsed is None:
+        raise RuntimeError('{0} failed'.format(' '.join(cmd)))
+    return elapsed
+
+
+def report(name, timings):
+    print('{0:<12} min {1:>8.1f} ms  p50 {2:>8.1f} ms  p99 {3:>8.1f} ms'.format(
+        name, min(timings) * 1000, percentile(timings, 0.5) * 1000, percentile(timings, 0.99) * 1000))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='time_to_prompt', description='ssh multiplexing benchmark')
+    arg_parser.add_argument('hostname', type=str)
+    arg_parser.add_argument('--user', type=str)
+    arg_parser.add_argument('--port', type=int)
+    arg_parser.add_argument('-F', dest='config', type=str, help='ssh config')
+    arg_parser.add_argument('-o', dest='options', type=str, action='append', default=[], help='ssh option')
+    arg_parser.add_argument('--repeat', type=int, default=10)
+    args = arg_parser.parse_args()
+
+    ssh = ['ssh', '-T', '-o', 'BatchMode=yes']
+    if args.config:
+        ssh += ['-F', args.config]
+    for option in args.options:
+        ssh += ['-o', option]
+    if args.user:
+        ssh += ['-l', args.user]
+    if args.port:
+        ssh += ['-p', str(args.port)]
+    remote = [args.hostname, 'echo ' + MARKER]
+
+    control_dir = tempfile.mkdtemp(prefix='auth-mux-')
+    control_path = os.path.join(control_dir, '%C')
+    mux = ['-o', 'ControlMaster=auto', '-o', 'ControlPath=' + control_path, '-o', 'ControlPersist=60']
+
+    try:
+        report('direct', [time_to_output(ssh + ['-o', 'ControlPath=none'] + remote) for _ in range(args.repeat)])
+        report('mux first', [time_to_output(ssh + mux + remote)])
+        report('mux', [time_to_output(ssh + mux + remote) for _ in range(args.repeat)])
+    finally:
+        subprocess.call(ssh + ['-o', 'ControlPath=' + control_path, '-O', 'exit', args.hostname],
+                        stderr=open(os.devnull, 'w'))
+        shutil.rmtree(control_dir)
+
+
+if __name__ == '__main__':
+    main()
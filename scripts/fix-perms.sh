@@ -6,19 +6,43 @@ set -e;
 
 AUTH_DATA_ROOT="/opt/auth";
 cd "${AUTH_DATA_ROOT}";
-mkdir -p keys logs
+mkdir -p keys logs cache run mux metrics
 
-find "${AUTH_DATA_ROOT}" -type d -print0 | xargs -n60 -P 5 -0 chmod 0700
-find "${AUTH_DATA_ROOT}" -type f -print0 | xargs -n60 -P 5 -0 chmod 0600
+# cache and metrics files are owned by auth users, leave them alone
+find "${AUTH_DATA_ROOT}" \( -path "${AUTH_DATA_ROOT}/cache" -o -path "${AUTH_DATA_ROOT}/metrics" \) -prune \
+    -o -type d -print0 | xargs -n60 -P 5 -0 chmod 0700
+find "${AUTH_DATA_ROOT}" \( -path "${AUTH_DATA_ROOT}/cache" -o -path "${AUTH_DATA_ROOT}/metrics" \) -prune \
+    -o -type f -print0 | xargs -n60 -P 5 -0 chmod 0600
 
 chmod 0750 "${AUTH_DATA_ROOT}";
+
+# deploy lock, auth users watch it with inotifywait in deploy_lock
+if [ -f "${AUTH_DATA_ROOT}/.deploy" ]; then
+    chmod 0660 "${AUTH_DATA_ROOT}/.deploy";
+fi
 chmod 0700 "${AUTH_DATA_ROOT}/wrappers/ssh.py";
+chmod 0700 "${AUTH_DATA_ROOT}/wrappers/sessionlog.py";
+chmod 0700 "${AUTH_DATA_ROOT}/wrappers/catalog.py";
+chmod 0700 "${AUTH_DATA_ROOT}/wrappers/replay.py";
 
 chmod 0700 "${AUTH_DATA_ROOT}/configs"
 
+# inventory snapshots written by helper.py on behalf of every auth user
+chmod 2770 "${AUTH_DATA_ROOT}/cache"
+
+# helper.py and ssh.py timings, node_exporter textfile collector reads *.prom
+chmod 2770 "${AUTH_DATA_ROOT}/metrics"
+
+# helperd.py socket
+chmod 0750 "${AUTH_DATA_ROOT}/run"
+
 find "${AUTH_DATA_ROOT}/shared" -type d -print0 | xargs -n60 -P 5 -0 chmod 0750
 find "${AUTH_DATA_ROOT}/shared" -type f -print0 | xargs -n60 -P 5 -0 chmod 0640
 chmod 0750 "${AUTH_DATA_ROOT}/shared/helper.py";
+chmod 0750 "${AUTH_DATA_ROOT}/shared/helper-client.py";
+chmod 0750 "${AUTH_DATA_ROOT}/shared/helperd.py";
+chmod 0750 "${AUTH_DATA_ROOT}/shared/probe.py";
+chmod 0750 "${AUTH_DATA_ROOT}/shared/completion.py";
 chmod 0750 "${AUTH_DATA_ROOT}/shared/auth-manager.py";
 
 # python fixes
@@ -3,7 +3,9 @@
 import os
 import sys
 import re
+import csv
 import json
+import contextlib
 from time import time
 import argparse
 from redis import Redis
@@ -18,6 +20,38 @@ USER = os.getenv('USER', 'NO_USER_ENV')
 
 params = None
 
+# Secondary indexes for helper.py exact lookups (g <server_id|project> [server_name|server_ip])
+#   index_projects            set:  project names
+#   index_project_<project>   set:  server ids
+#   index_name_<project>      hash: lowercased server_name -> comma separated server ids
+#   index_ip_<project>        hash: lowercased server_ip -> comma separated server ids
+#   index_ready               set by reindex, helper.py uses indexes only when present
+INDEX_HASHES = [('server_name', 'index_name_'), ('server_ip', 'index_ip_')]
+
+# Host records layout, storage_layout key, json when there is none:
+#   json  server_<id>  string: json of host record
+#   hash  host_<id>    hash: field -> json of its value, readers HMGET only fields they need
+# auth-manager.py migrate --layout <json|hash> moves records between them
+STORAGE_LAYOUTS = dict(json='server_', hash='host_')
+
+# Change log for resident and cached helpers, one entry per changed record,
+# written in the same MULTI/EXEC as inventory_version bump it belongs to:
+#   inventory_changes  stream: version, op (set|del), server_id, host (json of record, for set)
+# Helpers apply entries after the last id they have seen. Trimmed log or a version
+# bumped without entries (reindex, migrate) means full reload for them.
+# Streams need redis 5.0+, on older servers there is no log and helpers always reload.
+CHANGES_STREAM = 'inventory_changes'
+# entries kept, approximately
+CHANGES_MAXLEN = int(os.getenv('AUTH_CHANGES_MAXLEN', 10000))
+
+# first add-host gets OFFSET_SERVER_ID + 1
+OFFSET_SERVER_ID = 100000
+
+# import / export columns
+EXPORT_FIELDS = ['server_id', 'project_name', 'server_name', 'server_ip', 'server_port', 'server_user',
+                 'server_nosudo', 'proxy_id', 'updated_by', 'updated_at']
+INT_FIELDS = ['server_id', 'server_port', 'proxy_id', 'updated_at']
+
 
 def is_valid_ipv4_address(address):
     try:
@@ -53,6 +87,426 @@ def is_valid_fqdn(hostname):
     return True
 
 
+def to_str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def get_layout(redis):
+    layout = to_str(redis.get('storage_layout'))
+    return layout if layout in STORAGE_LAYOUTS else 'json'
+
+
+def host_key(layout, server_id):
+    return '{0}{1}'.format(STORAGE_LAYOUTS[layout], server_id)
+
+
+def hset_fields(pipe, key, fields):
+    # one HSET per field: HSET of several fields needs redis 4.0 (CentOS 7 has 3.2),
+    # HMSET is deprecated in redis-py
+    for field, value in fields.items():
+        pipe.hset(key, field, value)
+
+
+def store_host(pipe, layout, host):
+    key = host_key(layout, host['server_id'])
+    if layout == 'hash':
+        # fields removed from record must not stay in hash
+        pipe.delete(key)
+        hset_fields(pipe, key, dict((field, json.dumps(value)) for field, value in host.items()))
+    else:
+        pipe.set(key, json.dumps(host))
+
+
+def decode_hash(values):
+    return dict((to_str(field), json.loads(value)) for field, value in values.items())
+
+
+def get_hosts(redis, server_ids, layout=None):
+    # host records by id, missing ones are skipped
+    layout = layout or get_layout(redis)
+    keys = [host_key(layout, server_id) for server_id in server_ids]
+    if not keys:
+        return []
+    if layout == 'hash':
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        return [decode_hash(values) for values in pipe.execute() if values]
+    return [json.loads(host) for host in redis.mget(keys) if host is not None]
+
+
+def has_streams(redis):
+    version = to_str(redis.info('server').get('redis_version', '0'))
+    return int(version.split('.')[0]) >= 5
+
+
+def log_change(pipe, version, op, host):
+    change = dict(version=version, op=op, server_id=host['server_id'])
+    if op == 'set':
+        change['host'] = json.dumps(host)
+    pipe.xadd(CHANGES_STREAM, change, maxlen=CHANGES_MAXLEN, approximate=True)
+
+
+def index_hash_keys(host):
+    for field, prefix in INDEX_HASHES:
+        if host.get(field) is not None:
+            yield prefix + host['project_name'], str(host[field]).lower()
+
+
+def write_hosts(redis, add=(), remove=()):
+    # Store and delete host records together with secondary indexes, change log and
+    # inventory_version in one MULTI/EXEC, retried if any of them changed meanwhile
+    watch_keys = set(host_key(layout, host['server_id']) for host in remove for layout in STORAGE_LAYOUTS)
+    watch_keys.update(['storage_layout', 'inventory_version'])
+    streams = has_streams(redis)
+    for host in list(add) + list(remove):
+        watch_keys.add('index_project_' + host['project_name'])
+        watch_keys.update(key for key, _ in index_hash_keys(host))
+
+    def transaction(pipe):
+        layout = get_layout(pipe)
+        # change log entries carry the version they are part of
+        version = int(pipe.get('inventory_version') or 0) + 1
+        # comma separated ids lists of touched hash fields
+        hash_ids = dict()
+        project_ids = dict()
+        for host in list(add) + list(remove):
+            for key, field in index_hash_keys(host):
+                if (key, field) not in hash_ids:
+                    ids = to_str(pipe.hget(key, field))
+                    hash_ids[(key, field)] = ids.split(',') if ids else []
+            project = host['project_name']
+            if project not in project_ids:
+                project_ids[project] = set(to_str(i) for i in pipe.smembers('index_project_' + project))
+
+        for host in remove:
+            server_id = str(host['server_id'])
+            for key_field in index_hash_keys(host):
+                if server_id in hash_ids[key_field]:
+                    hash_ids[key_field].remove(server_id)
+            project_ids[host['project_name']].discard(server_id)
+
+        for host in add:
+            server_id = str(host['server_id'])
+            for key_field in index_hash_keys(host):
+                if server_id not in hash_ids[key_field]:
+                    hash_ids[key_field].append(server_id)
+            project_ids[host['project_name']].add(server_id)
+
+        pipe.multi()
+        for host in remove:
+            pipe.delete(host_key(layout, host['server_id']))
+            pipe.srem('index_project_' + host['project_name'], host['server_id'])
+        for host in add:
+            store_host(pipe, layout, host)
+            pipe.sadd('index_project_' + host['project_name'], host['server_id'])
+
+        for (key, field), ids in hash_ids.items():
+            if ids:
+                pipe.hset(key, field, ','.join(ids))
+            else:
+                pipe.hdel(key, field)
+        for project, ids in project_ids.items():
+            if ids:
+                pipe.sadd('index_projects', project)
+            else:
+                pipe.srem('index_projects', project)
+
+        # helpers drop cached inventory snapshots on version change
+        pipe.incr('inventory_version')
+        if streams:
+            for host in remove:
+                log_change(pipe, version, 'del', host)
+            for host in add:
+                log_change(pipe, version, 'set', host)
+
+    redis.transaction(transaction, *watch_keys)
+
+
+def iter_hosts(redis, batch=1000, layout=None):
+    # streaming SCAN + MGET (or pipelined HGETALL) per batch, only keys are kept in memory
+    layout = layout or get_layout(redis)
+    prefix = STORAGE_LAYOUTS[layout]
+
+    def fetch(server_keys):
+        server_ids = [to_str(server_key)[len(prefix):] for server_key in server_keys]
+        return get_hosts(redis, server_ids, layout)
+
+    seen_keys = set()
+    server_keys = []
+    for server_key in redis.scan_iter(match=prefix + '*', count=batch):
+        # SCAN may return a key twice
+        if server_key in seen_keys:
+            continue
+        seen_keys.add(server_key)
+        server_keys.append(server_key)
+
+        if len(server_keys) >= batch:
+            for host in fetch(server_keys):
+                yield host
+            server_keys = []
+
+    if server_keys:
+        for host in fetch(server_keys):
+            yield host
+
+
+def migrate(redis, layout, batch=1000):
+    # copy every record to the new layout, switch readers to it together with
+    # inventory_version bump, then drop old records; run it with no writers around,
+    # hosts added meanwhile are not copied
+    current = get_layout(redis)
+    if current == layout:
+        return 0
+
+    old_keys = []
+    pipe = redis.pipeline(transaction=False)
+    for host in iter_hosts(redis, batch, current):
+        store_host(pipe, layout, host)
+        old_keys.append(host_key(current, host['server_id']))
+        if len(old_keys) % batch == 0:
+            pipe.execute()
+    pipe.execute()
+
+    pipe = redis.pipeline(transaction=True)
+    pipe.set('storage_layout', layout)
+    pipe.incr('inventory_version')
+    pipe.execute()
+
+    for offset in range(0, len(old_keys), batch):
+        redis.delete(*old_keys[offset:offset + batch])
+
+    return len(old_keys)
+
+
+def reindex(redis):
+    # build all secondary indexes from scratch, for databases filled before indexes
+    projects = dict()
+    hashes = dict()
+    for host in iter_hosts(redis):
+        projects.setdefault(host['project_name'], []).append(host['server_id'])
+        for key, field in index_hash_keys(host):
+            hashes.setdefault(key, dict()).setdefault(field, []).append(str(host['server_id']))
+
+    pipe = redis.pipeline(transaction=True)
+    for key in redis.scan_iter(match='index_*'):
+        pipe.delete(key)
+    for project, ids in projects.items():
+        pipe.sadd('index_projects', project)
+        pipe.sadd('index_project_' + project, *ids)
+    for key, fields in hashes.items():
+        hset_fields(pipe, key, dict((field, ','.join(ids)) for field, ids in fields.items()))
+    pipe.set('index_ready', int(time()))
+    pipe.incr('inventory_version')
+    pipe.execute()
+
+    return sum(len(ids) for ids in projects.values())
+
+
+def validate_host(host):
+    # host dict as stored in redis, raises ValueError on bad field
+    host = dict(host)
+
+    if host.get('project_name') is None:
+        raise ValueError('[project_name] Validation not passed')
+    if re.match('^[A-Za-z,\d\-]*$', host['project_name']) is None and len(host['project_name']) < 48:
+        raise ValueError('[project_name] Validation not passed')
+
+    if host.get('server_name') is None or not is_valid_fqdn(host['server_name']):
+        raise ValueError('[server_name] Validation not passed')
+
+    # SSH Options
+    if host.get('server_ip') is None or not is_valid_ipv4_address(host['server_ip']) \
+            and not is_valid_ipv6_address(host['server_ip']):
+        raise ValueError('[server_ip] Validation not passed')
+
+    if host.get('server_port') is not None:
+        if host['server_port'] > 65535 or host['server_port'] <= 0:
+            raise ValueError('[port] Validation not passed')
+
+    if host.get('server_user') is not None:
+        if re.match('^[A-Za-z,\d\-]*$', host['server_user']) is None and len(host['server_user']) < 48:
+            raise ValueError('[user] Validation not passed')
+
+    host['server_nosudo'] = bool(host.get('server_nosudo'))
+    host.setdefault('proxy_id', None)
+    host.setdefault('server_id', None)
+
+    # Meta
+    host.setdefault('updated_by', USER)
+    host.setdefault('updated_at', int(time()))
+
+    return host
+
+
+@contextlib.contextmanager
+def open_stream(path, mode):
+    # '-' is stdin/stdout, they are not closed on exit
+    if path == '-':
+        yield sys.stdin if mode == 'r' else sys.stdout
+    else:
+        with open(path, mode) as stream:
+            yield stream
+
+
+def guess_format(path):
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def read_records(stream, file_format):
+    # (line number, record dict) of jsonl or csv input
+    if file_format == 'csv':
+        for line_no, row in enumerate(csv.DictReader(stream), 2):
+            record = dict()
+            for key, value in row.items():
+                # extra columns (os_version, asn, ...) are kept as strings
+                if key is None or value in (None, ''):
+                    continue
+                if key in INT_FIELDS:
+                    value = int(value)
+                elif key == 'server_nosudo':
+                    value = value.lower() in ['true', '1', 'yes']
+                record[key] = value
+            yield line_no, record
+    else:
+        for line_no, line in enumerate(stream, 1):
+            line = line.strip()
+            if line:
+                yield line_no, json.loads(line)
+
+
+def import_hosts(redis, stream, file_format, batch=500, keep_ids=False):
+    imported = 0
+    skipped = 0
+    # (server_id of record, host)
+    hosts = []
+    # without keep_ids records get new ids, proxy_id of records behind them is rewritten;
+    # records behind a proxy that is not imported yet wait for it
+    new_ids = dict()
+    record_ids = set()
+    waiting = []
+
+    def flush(hosts):
+        if keep_ids:
+            # overwritten records must leave their old indexes
+            old_hosts = get_hosts(redis, [host['server_id'] for _, host in hosts])
+            write_hosts(redis, add=[host for _, host in hosts], remove=old_hosts)
+            raise_offset_server_id(redis, max(host['server_id'] for _, host in hosts))
+        else:
+            # reserve id range with one INCRBY
+            redis.setnx('offset_server_id', OFFSET_SERVER_ID)
+            last_id = redis.incrby('offset_server_id', len(hosts))
+            for server_id, (record_id, host) in enumerate(hosts, last_id - len(hosts) + 1):
+                host['server_id'] = server_id
+                if record_id is not None:
+                    new_ids[record_id] = server_id
+            write_hosts(redis, add=[host for _, host in hosts])
+
+    def flush_all(hosts):
+        for start in range(0, len(hosts), batch):
+            flush(hosts[start:start + batch])
+        return len(hosts)
+
+    for line_no, record in read_records(stream, file_format):
+        try:
+            host = validate_host(record)
+            if keep_ids and not isinstance(host['server_id'], int):
+                raise ValueError('[server_id] Validation not passed')
+        except (ValueError, TypeError, AttributeError) as e:
+            LOGGER.critical('line {0}: {1}'.format(line_no, e))
+            skipped += 1
+            # hosts behind it must not go to another host with the same id
+            record_ids.add(record.get('server_id'))
+            continue
+
+        record_id = None
+        if not keep_ids:
+            record_id, host['server_id'] = host['server_id'], None
+            record_ids.add(record_id)
+            if host['proxy_id'] is not None:
+                if host['proxy_id'] not in new_ids:
+                    waiting.append((line_no, record_id, host))
+                    continue
+                host['proxy_id'] = new_ids[host['proxy_id']]
+        hosts.append((record_id, host))
+
+        if len(hosts) >= batch:
+            imported += flush_all(hosts)
+            hosts = []
+
+    # proxies after hosts behind them, one level of a proxy chain per round
+    while waiting:
+        imported += flush_all(hosts)
+        hosts = [entry[1:] for entry in waiting if entry[2]['proxy_id'] in new_ids]
+        if not hosts:
+            break
+        waiting = [entry for entry in waiting if entry[2]['proxy_id'] not in new_ids]
+        for _, host in hosts:
+            host['proxy_id'] = new_ids[host['proxy_id']]
+
+    # proxy_id that is not a record of this import must be a host in redis
+    existing_ids = set(host['server_id'] for host in get_hosts(
+        redis, set(host['proxy_id'] for _, _, host in waiting if host['proxy_id'] not in record_ids)))
+    for line_no, record_id, host in waiting:
+        if host['proxy_id'] in existing_ids:
+            hosts.append((record_id, host))
+        else:
+            LOGGER.critical('line {0}: [proxy_id] {1} is not imported and not in database'.format(
+                line_no, host['proxy_id']))
+            skipped += 1
+    imported += flush_all(hosts)
+
+    return imported, skipped
+
+
+def raise_offset_server_id(redis, server_id):
+    # new add-host ids must not collide with imported ones
+    def transaction(pipe):
+        offset = pipe.get('offset_server_id')
+        if offset is None or int(offset) < server_id:
+            pipe.multi()
+            pipe.set('offset_server_id', max(server_id, OFFSET_SERVER_ID))
+
+    redis.transaction(transaction, 'offset_server_id')
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+def export_hosts(redis, stream, file_format, batch=500):
+    if file_format == 'csv':
+        # header needs every field: EXPORT_FIELDS, then extra ones of any host,
+        # they are collected by the first pass, rows are written by the second one
+        extra_fields = set()
+        for host in iter_hosts(redis, batch):
+            extra_fields.update(key for key in host if key not in EXPORT_FIELDS)
+        writer = csv.DictWriter(stream, EXPORT_FIELDS + sorted(extra_fields), extrasaction='ignore')
+        writer.writeheader()
+
+        exported = 0
+        for host in iter_hosts(redis, batch):
+            if not extra_fields.issuperset(key for key in host if key not in EXPORT_FIELDS):
+                LOGGER.critical('server_id {0}: fields added during export are not exported'.format(
+                    host['server_id']))
+            writer.writerow(dict((key, csv_value(value)) for key, value in host.items()))
+            exported += 1
+        return exported
+
+    exported = 0
+    for host in iter_hosts(redis, batch):
+        stream.write(json.dumps(host, sort_keys=True) + '\n')
+        exported += 1
+
+    return exported
+
+
 def main():
     arg_parser = argparse.ArgumentParser(prog='auth-manager', epilog='------',
                                          description='Auth shell helper')
@@ -66,6 +520,12 @@ def main():
     arg_parser.add_argument('--nosudo', action='store_true')
     arg_parser.add_argument('--proxy-id', type=int, nargs=1, default=[None], help="server_id of proxy")
     arg_parser.add_argument('--server-id', type=int, nargs=1, default=[None], help="server_id (for del-host)")
+    # import / export
+    arg_parser.add_argument('--file', type=str, default='-', help="jsonl or csv file, '-' for stdin/stdout")
+    arg_parser.add_argument('--format', type=str, choices=['jsonl', 'csv'], help="default: by --file extension")
+    arg_parser.add_argument('--batch', type=int, default=500, help="hosts per redis transaction")
+    arg_parser.add_argument('--keep-ids', action='store_true', help="import: use server_id from records")
+    arg_parser.add_argument('--layout', type=str, choices=sorted(STORAGE_LAYOUTS), help="migrate: host records layout")
 
     arg_parser.add_argument('--debug', action='store_true')
 
@@ -75,80 +535,74 @@ def main():
     redis = Redis(host=os.getenv('AUTH_REDIS_IP', '127.0.0.1'),
                   port=int(os.getenv('AUTH_REDIS_PORT', 6379)),
                   password=os.getenv('AUTH_REDIS_PASS', 'te2uth4dohLi8i'),
-                  db=0)
+                  db=int(os.getenv('AUTH_REDIS_DB', 0)))
 
     # Management info
     action = params['action'][0]
 
     if action == 'add-host':
 
-        # Validate Args/Params
-        params['action'] = params['action'][0]
-        if params['action'] is not None:
-            if re.match('^[A-Za-z,\d\-]*$', params['action']) is None and len(params['action']) < 48:
-                LOGGER.critical('[action] Validation not passed')
-                sys.exit(1)
-
-        params['project_name'] = params['project'][0]
-        if params['project_name'] is not None:
-            if re.match('^[A-Za-z,\d\-]*$', params['project_name']) is None and len(params['project_name']) < 48:
-                LOGGER.critical('[project_name] Validation not passed')
-                sys.exit(1)
-
-        params['server_name'] = params['server_name'][0]
-        if not is_valid_fqdn(params['server_name']):
-            LOGGER.critical('[server_name] Validation not passed')
-            sys.exit(1)
+        host = dict(project_name=params['project'][0] if params['project'] else None,
+                    server_name=params['server_name'][0] if params['server_name'] else None,
+                    server_ip=params['ip'][0] if params['ip'] else None,
+                    server_port=params['port'][0],
+                    server_user=params['user'][0],
+                    server_nosudo=params['nosudo'],
+                    proxy_id=params['proxy_id'][0])
 
-        # SSH Options
-        params['server_ip'] = params['ip'][0]
-
-        if not is_valid_ipv4_address(params['server_ip']) \
-                and not is_valid_ipv6_address(params['server_ip']):
-            LOGGER.critical('[server_ip] Validation not passed')
+        # Validate Args/Params
+        try:
+            host = validate_host(host)
+        except ValueError as e:
+            LOGGER.critical(e)
             sys.exit(1)
 
-        params['server_port'] = params['port'][0]
-        if params['server_port'] is not None:
-            if params['server_port'] > 65535 or params['server_port'] <= 0:
-                LOGGER.critical('[port] Validation not passed')
-                sys.exit(1)
-
-        params['server_user'] = params['user'][0]
-        if params['server_user'] is not None:
-            if re.match('^[A-Za-z,\d\-]*$', params['server_user']) is None and len(params['server_user']) < 48:
-                LOGGER.critical('[user] Validation not passed')
-                sys.exit(1)
-
-        params['server_nosudo'] = params['nosudo']
-        params['proxy_id'] = params['proxy_id'][0]
-
-        # Meta
-        params['updated_by'] = USER
-        params['updated_at'] = int(time())
-
-        del params['action']
-        del params['project']
-        del params['ip']
-        del params['port']
-        del params['user']
-        del params['nosudo']
-        del params['debug']
-
         # Put params
         if redis.get('offset_server_id') is None:
-            redis.set('offset_server_id', 100000)
+            redis.set('offset_server_id', OFFSET_SERVER_ID)
 
-        params['server_id'] = redis.incr('offset_server_id')
-        redis_key = 'server_' + str(params['server_id'])
-        redis.set(redis_key, json.dumps(params))
+        host['server_id'] = redis.incr('offset_server_id')
+        write_hosts(redis, add=[host])
         print('Database updated')
 
+    elif action == 'import':
+
+        with open_stream(params['file'], 'r') as import_f:
+            imported, skipped = import_hosts(redis, import_f, params['format'] or guess_format(params['file']),
+                                             batch=params['batch'], keep_ids=params['keep_ids'])
+        print('{0} hosts imported, {1} skipped'.format(imported, skipped))
+        if skipped:
+            sys.exit(1)
+
+    elif action == 'export':
+
+        with open_stream(params['file'], 'w') as export_f:
+            exported = export_hosts(redis, export_f, params['format'] or guess_format(params['file']),
+                                    batch=params['batch'])
+        LOGGER.info('{0} hosts exported'.format(exported))
+
     elif action == 'del-host':
 
-        key = 'server_{0}'.format(params['server_id'][0])
-        redis.delete(key)
+        key = host_key(get_layout(redis), params['server_id'][0])
+        hosts = get_hosts(redis, [params['server_id'][0]])
+        if not hosts:
+            print(key + ' not found')
+            sys.exit(1)
+
+        write_hosts(redis, remove=hosts)
         print(key + ' deleted')
 
+    elif action == 'reindex':
+
+        print('{0} hosts indexed'.format(reindex(redis)))
+
+    elif action == 'migrate':
+
+        if params['layout'] is None:
+            LOGGER.critical('--layout is required, current: ' + get_layout(redis))
+            sys.exit(1)
+        print('{0} hosts moved to {1} layout'.format(migrate(redis, params['layout'], batch=params['batch']),
+                                                     params['layout']))
+
 if __name__ == '__main__':
     main()
@@ -3,13 +3,31 @@ USER="${USER:-NO_USER_ENV}"
 AUTH_DATA_ROOT="${AUTH_DATA_ROOT:-/opt/auth}";
 AUTH_SHARED="${AUTH_DATA_ROOT}/shared";
 AUTH_HELPER="${AUTH_SHARED}/helper.py";
+AUTH_HELPER_CLIENT="${AUTH_SHARED}/helper-client.py";
 DEPLOY_LOCK="${AUTH_DATA_ROOT}/.deploy";
+DEPLOY_LOCK_TIMEOUT="${DEPLOY_LOCK_TIMEOUT:-600}";
+AUTH_COMPLETION="${AUTH_CACHE_DIR:-${AUTH_DATA_ROOT}/cache}/completion";
+AUTH_COMPLETION_LIMIT=500
 AUTH_COLORS=true
+AUTH_REDIS_ENV="${AUTH_REDIS_ENV:-/etc/sysconfig/auth-redis}";
+AUTH_METRICS_ENV="${AUTH_METRICS_ENV:-/etc/sysconfig/auth-metrics}";
+
+# redis master and local replica of this bastion, AUTH_METRICS_DIR if metrics are on,
+# see ansible auth role
+for auth_env in "${AUTH_REDIS_ENV}" "${AUTH_METRICS_ENV}"; do
+    if [ -r "${auth_env}" ]; then
+        set -a;
+        # shellcheck source=/dev/null
+        . "${auth_env}";
+        set +a;
+    fi
+done
 
 export USER;
 export AUTH_DATA_ROOT;
 export AUTH_SHARED;
 export AUTH_HELPER;
+export AUTH_HELPER_CLIENT;
 export AUTH_COLORS;
 
 export LANG="en_US.UTF-8"
@@ -22,8 +40,29 @@ export LC_TIME="en_US.UTF-8"
 export LC_ALL="en_US.UTF-8"
 
 deploy_lock () {
+    # ${DEPLOY_LOCK} exists while the auth-deploy role runs, no lock - no extra processes;
+    # inotifywait returns as soon as the lock is removed, a lock left by a failed deploy
+    # is waited for DEPLOY_LOCK_TIMEOUT seconds at most
+    if [ ! -f "${DEPLOY_LOCK}" ]; then
+        return
+    fi
+
+    echo "Lock found: ${DEPLOY_LOCK} awaiting deploy end...";
+    local deadline=$(( SECONDS + DEPLOY_LOCK_TIMEOUT ));
     while [ -f "${DEPLOY_LOCK}" ]; do
-        echo "Lock found: ${DEPLOY_LOCK} awaiting deploy end...";
+        if [ "${SECONDS}" -ge "${deadline}" ]; then
+            echo "Lock ${DEPLOY_LOCK} is still there after ${DEPLOY_LOCK_TIMEOUT}s, going on";
+            return
+        fi
+        if command -v inotifywait > /dev/null 2>&1; then
+            local code=0;
+            inotifywait -qq -t "$(( deadline - SECONDS + 1 ))" -e delete_self -e move_self \
+                "${DEPLOY_LOCK}" > /dev/null 2>&1 || code=$?;
+            # 1 - lock is gone before the watch was set or no inotify here, poll then
+            if [ "${code}" -ne 1 ] || [ ! -f "${DEPLOY_LOCK}" ]; then
+                continue
+            fi
+        fi
         sleep 1;
     done
 }
@@ -61,20 +100,63 @@ g () {
         return
     elif [[ $# -gt 0 ]] ; then
         deploy_lock
-        auth_callback "${AUTH_HELPER}" go "${@}";
+        auth_callback "${AUTH_HELPER_CLIENT}" go "${@}";
     fi
 }
 
 s () {
     if [[ $# -eq 0 ]] ; then
-        echo -e "\n  Usage: s <query> \n";
+        echo -e "\n  Usage: s <query> [ --probe | --rank ] \n";
+        return
+    elif [[ $# -gt 0 ]] ; then
+        deploy_lock
+        "${AUTH_HELPER_CLIENT}" search "${@}";
+    fi
+}
+
+x () {
+    if [[ $# -eq 0 ]] ; then
+        echo -e "\n  Usage: x <project|query> [ --parallel N | --timeout S | --user | --port | --nosudo ] -- <command> \n";
         return
     elif [[ $# -gt 0 ]] ; then
         deploy_lock
-        "${AUTH_HELPER}" search "${@}";
+        "${AUTH_HELPER_CLIENT}" exec "${@}";
+    fi
+}
+
+_auth_lookup () {
+    # lines of sorted file ${2} starting with ${1}, look(1) does a binary search
+    if command -v look > /dev/null 2>&1; then
+        LC_ALL=C look -- "${1}" "${2}" 2>/dev/null | head -n "${AUTH_COMPLETION_LIMIT}";
+    else
+        local pattern="${1//\\/\\\\}";
+        pattern="${pattern//./\\.}";
+        pattern="${pattern//\*/\\*}";
+        pattern="${pattern//\[/\\[}";
+        pattern="${pattern//^/\\^}";
+        pattern="${pattern//\$/\\$}";
+        LC_ALL=C grep -m "${AUTH_COMPLETION_LIMIT}" -e "^${pattern}" -- "${2}" 2>/dev/null;
     fi
 }
 
+_auth_complete () {
+    # TAB for g/s/x: files written by helper.py with every inventory version,
+    # no python and no redis here
+    local cur="${COMP_WORDS[COMP_CWORD]}";
+    COMPREPLY=();
+    if [[ "${cur}" == -* ]]; then
+        return
+    fi
+
+    if [[ "${COMP_CWORD}" -eq 1 ]]; then
+        mapfile -t COMPREPLY < <(_auth_lookup "${cur}" "${AUTH_COMPLETION}_words");
+    elif [[ "${COMP_CWORD}" -eq 2 ]]; then
+        mapfile -t COMPREPLY < <(_auth_lookup "${COMP_WORDS[1]} ${cur}" "${AUTH_COMPLETION}_hosts" | cut -d ' ' -f 2);
+    fi
+}
+
+complete -F _auth_complete g s x
+
 auth-add-user () {
     useradd "${1}" -m --groups auth;
     passwd "${1}";
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# g/s/x TAB completion files in AUTH_CACHE_DIR, for bash.sh:
+#   completion_words  projects, server names and ids
+#   completion_hosts  "<project> <server name or id>"
+#
+# s/g/helperd write them with every new inventory snapshot,
+# cron runs this to catch up on inventory_version changes nobody has seen yet.
+#
+# Example:
+#   ./completion.py           # only if inventory_version has changed
+#   ./completion.py --force
+import sys
+import logging
+import argparse
+
+from helper import AuthHelper, LOGGER
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='completion', epilog='------',
+                                         description='g/s/x TAB completion files')
+    arg_parser.add_argument('--force', action='store_true', help='write even if version is the same')
+    arg_parser.add_argument('--debug', action='store_true')
+    args = arg_parser.parse_args()
+
+    if args.debug:
+        LOGGER.setLevel(logging.DEBUG)
+
+    helper = AuthHelper(None, None)
+    version = helper._get_inventory_version()
+    if version is None:
+        LOGGER.critical('No inventory_version in redis')
+        sys.exit(1)
+
+    if args.force or helper.completion_version() != version:
+        # new version snapshot writes completion files itself
+        helper.refresh()
+        version = helper.inventory_version or version
+        if args.force or helper.completion_version() != version:
+            if not helper.write_completion(version):
+                LOGGER.critical('Can not write completion files to ' + helper.AUTH_CACHE_DIR)
+                sys.exit(1)
+        LOGGER.debug('completion: ' + version)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Thin s/g client: asks helperd.py over unix socket,
+# runs helper.py in process if daemon is not running
+#
+import os
+import sys
+import json
+import socket
+
+import metrics
+from pager import write_output
+
+CONNECT_TIMEOUT = 0.5
+RESPONSE_TIMEOUT = float(os.getenv('AUTH_HELPERD_TIMEOUT', 30))
+
+
+def socket_path():
+    return os.getenv('AUTH_HELPERD_SOCKET',
+                     os.path.join(os.getenv('AUTH_DATA_ROOT', '/opt/auth'), 'run', 'helperd.sock'))
+
+
+def ask_daemon(argv):
+    env = dict((key, value) for key, value in os.environ.items()
+               if key.startswith('AUTH_') or key in ['USER', 'SUDO_USER'])
+    request = json.dumps(dict(argv=argv, env=env)).encode('utf-8')
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(socket_path())
+        sock.settimeout(RESPONSE_TIMEOUT)
+        sock.sendall(request)
+        sock.shutdown(socket.SHUT_WR)
+
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+
+    try:
+        return json.loads(b''.join(chunks).decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def metrics_dir():
+    return os.getenv('AUTH_METRICS_DIR', '')
+
+
+def write_session(lines):
+    session_file_path = os.getenv('AUTH_SESSION', None)
+    if session_file_path is None or lines is None:
+        return
+
+    with open(session_file_path, 'w') as sess_f:
+        for line in lines:
+            sess_f.write(line + '\n')
+
+
+def main():
+    argv = sys.argv[1:]
+
+    # x runs ssh.py processes of the user and s --probe waits for connects,
+    # both are never done in the daemon
+    timings = metrics.Timings()
+    response = None
+    if argv[:1] != ['exec'] and '--probe' not in argv:
+        with timings.phase('helperd'):
+            response = ask_daemon(argv)
+
+    if response is None:
+        # no daemon, same as calling helper.py directly
+        sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+        import helper
+        sys.argv = [helper.__file__] + argv
+        helper.main()
+        return
+
+    write_session(response['session'])
+    try:
+        sys.stderr.write(response['stderr'])
+    except IOError:
+        pass
+    # daemon renders to a buffer, paging is up to the client terminal
+    write_output(response['stdout'])
+    # request round trip, daemon writes its own phases
+    metrics.write(metrics_dir(), metrics.HELPER_METRICS, argv[0] if argv else 'other', timings)
+    sys.exit(response['code'])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,24 @@
 # -*- coding: utf-8 -*-
 from time import time
 import argparse
-import json
 import sys
 import os
 import logging
 import operator
-from copy import copy
-from uuid import uuid4
+import marshal
 import socket
 import re
-from redis import Redis
 from operator import itemgetter
 
+from metrics import Timings, HELPER_METRICS, timed
+import metrics
+
+# json, uuid and redis are imported on demand:
+# g <ip|fqdn> does not touch inventory and should start fast
+
+# import phase: from here to main()
+STARTED_AT = time()
+
 __version__ = '0.100.500'
 
 LOG_FORMAT = '[%(levelname)s] %(name)s %(message)s'
@@ -22,6 +28,58 @@ logging.basicConfig(stream=sys.stderr, level=logging.INFO, format=LOG_FORMAT,
 
 LOGGER = logging.getLogger('helper')
 
+# Host.to_tuple() layout version in inventory snapshots
+SNAPSHOT_FORMAT = 2
+SNAPSHOT_NAME = re.compile(r'inventory_(\d+)\.marshal$')
+
+# probe.py results, expire after AUTH_PROBE_TTL
+PROBE_KEY = 'probe_{0}'
+PROBE_FIELDS = ('probe_status', 'probe_rtt')
+
+# host record key prefix per auth-manager.py storage_layout, json if not set
+STORAGE_LAYOUTS = dict(json='server_', hash='host_')
+
+# auth-manager.py change log, entries: version, op (set|del), server_id, host
+CHANGES_STREAM = 'inventory_changes'
+# hash layout: fields g needs to connect, the rest is fetched only to be shown
+CONNECT_FIELDS = ('server_id',
+                  'project_name',
+                  'server_name',
+                  'server_ip',
+                  'server_port',
+                  'server_user',
+                  'server_nosudo',
+                  'proxy_id')
+# AUTH_SPF fields that are not stored in host records
+VIRTUAL_FIELDS = ('match_info', 'match_by', 'exact_match', 'score') + PROBE_FIELDS
+
+# project_id - is bad idea
+SEARCH_FIELDS = ('project_name',
+                 'project_id',
+                 'server_name',
+                 'server_id',
+                 'server_ip',
+                 'os_version',
+                 'asn')  # 'alerts'
+
+# ranked search: field weights, match kinds exact > prefix > substring > one typo,
+# longer part of the value covered by query ranks higher within a kind
+RANK_FIELDS = (('server_name', 1.0),
+               ('server_ip', 1.0),
+               ('server_id', 0.9),
+               ('project_name', 0.7),
+               ('os_version', 0.4),
+               ('project_id', 0.3),
+               ('asn', 0.3))
+RANK_EXACT = 8
+RANK_PREFIX = 4
+RANK_SUBSTRING = 2
+RANK_TYPO = 1
+# typos are looked for in names only, short queries are one edit away from too much
+RANK_TYPO_FIELDS = ('server_name', 'project_name')
+RANK_TYPO_MIN_LENGTH = 4
+RANK_WORDS = re.compile('[^a-z0-9]+')
+
 
 def str2bool(s):
     yes_bools = ['true', 'yes', 'da', 'aga', 'ok', 'yep', 'да', 'ага', 'kk', 'y', 'конечно']
@@ -32,27 +90,180 @@ def str2bool(s):
         return False
 
 
-def init_args():
+class Host(object):
+    # Immutable inventory record, fields written by auth-manager.py are slots,
+    # anything else (metadata) goes to extra dict. None means no such field.
+    FIELDS = ('server_id',
+              'project_name',
+              'project_id',
+              'server_name',
+              'server_ip',
+              'server_port',
+              'server_user',
+              'server_nosudo',
+              'proxy_id',
+              'os_version',
+              'asn',
+              'updated_by',
+              'updated_at')
+
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, data):
+        for key in self.FIELDS:
+            object.__setattr__(self, key, data.get(key))
+        extra = dict((key, value) for key, value in data.items() if key not in self.FIELDS and value is not None)
+        object.__setattr__(self, 'extra', extra or None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Host records are immutable')
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+        elif self.extra is not None:
+            value = self.extra.get(key)
+        else:
+            value = None
+        return default if value is None else value
+
+    def keys(self):
+        keys = [key for key in self.FIELDS if getattr(self, key) is not None]
+        if self.extra is not None:
+            keys.extend(self.extra.keys())
+        return keys
+
+    def to_dict(self):
+        return dict((key, self.get(key)) for key in self.keys())
+
+    # compact form for inventory snapshots
+    def to_tuple(self):
+        return tuple(getattr(self, key) for key in self.FIELDS) + (self.extra,)
+
+    @classmethod
+    def from_tuple(cls, values):
+        host = object.__new__(cls)
+        for key, value in zip(cls.__slots__, values):
+            object.__setattr__(host, key, value)
+        return host
+
+
+def one_edit_apart(a, b):
+    # one inserted, deleted or replaced char, or two neighbours swapped
+    if abs(len(a) - len(b)) > 1 or a == b:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+
+    if len(a) != len(b):
+        return a[i:] == b[i + 1:]
+    if a[i + 1:] == b[i + 1:]:
+        return True
+    return i + 1 < len(a) and a[i] == b[i + 1] and a[i + 1] == b[i] and a[i + 2:] == b[i + 2:]
+
+
+def rank_value(query, value):
+    # score of lowercased query in lowercased field value, 0 - no match
+    if query == value:
+        return RANK_EXACT + 1.0
+    position = value.find(query)
+    if position < 0:
+        return 0
+    kind = RANK_PREFIX if position == 0 else RANK_SUBSTRING
+    return kind + float(len(query)) / len(value)
+
+
+def rank_typo(query, value):
+    # whole value, its start or one of its words with a typo;
+    # one typo leaves at least one third of query as is
+    size = len(query)
+    third = size // 3
+    if query[:third] not in value and query[third:-third] not in value and query[-third:] not in value:
+        return 0
+    for candidate in [value, value[:size], value[:size + 1], value[:size - 1]] + RANK_WORDS.split(value):
+        if one_edit_apart(query, candidate):
+            return RANK_TYPO + float(len(candidate)) / len(value)
+    return 0
+
+
+class Match(object):
+    # Search result: host record and why it matched, reads like host
+    # with match_by / exact_match / score fields added
+    __slots__ = ('host', 'match_by', 'exact_match', 'score')
+
+    def __init__(self, host, match_by=None, exact_match=None, score=None):
+        self.host = host
+        self.match_by = match_by
+        self.exact_match = exact_match
+        self.score = score
+
+    def get(self, key, default=None):
+        if key in self.__slots__[1:]:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.host.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def keys(self):
+        return self.host.keys() + [key for key in self.__slots__[1:] if getattr(self, key) is not None]
+
+
+def init_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
 
     arg_parser = argparse.ArgumentParser(prog='helper', epilog='------',
                                          description='Auth shell helper')
-    arg_parser.add_argument('action', type=str, nargs=1, choices=['search', 'go'])
+    # x <project|query> [opts] -- <command>
+    command = []
+    if '--' in argv:
+        command = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    arg_parser.add_argument('action', type=str, nargs=1, choices=['search', 'go', 'exec'])
     arg_parser.add_argument('sargs', type=str, nargs='+',
                             help='[search server_id | go project | go project server_name]')
     arg_parser.add_argument('--helper-debug', action='store_true')
+    arg_parser.add_argument('--parallel', type=int, default=20, help='exec: hosts at once')
+    arg_parser.add_argument('--timeout', type=int, default=60, help='exec: seconds per host')
+    arg_parser.add_argument('--probe', action='store_true', help='search: check ssh ports of found hosts')
+    arg_parser.add_argument('--rank', action='store_true', help='search: best matches first, AUTH_RANKED')
     arg_parser.add_argument_group('Search', 's <query> [opts]')
     arg_parser.add_argument_group('Go', 'g <project|host> [server_name|server_ip] [opts]')
+    arg_parser.add_argument_group('Exec', 'x <project|query> [opts] -- <command>')
 
     # Unknown args bypassed to ssh.py wrapper
-    args, unknown_args = arg_parser.parse_known_args()
+    args, unknown_args = arg_parser.parse_known_args(argv)
+    args.command = command
 
-    if args.helper_debug or '--debug' in sys.argv:
+    if args.helper_debug or '--debug' in argv:
         args.helper_debug = True
 
         logging.basicConfig(stream=sys.stdout, level=logging.DEBUG,
                             format=LOG_FORMAT, datefmt='%Y-%m-%d %H:%M:%S')
         LOGGER.info('Helper debug mode on')
-        LOGGER.info(sys.argv)
+        LOGGER.info(argv)
         LOGGER.info(vars(args))
         LOGGER.info(unknown_args)
 
@@ -62,6 +273,16 @@ def init_args():
     return args, unknown_args
 
 
+def format_jump(host):
+    # ssh ProxyJump [user@]host[:port], ipv6 in brackets
+    jump = host['server_ip']
+    if host.get('server_port') is not None:
+        jump = ('[{0}]' if ':' in jump else '{0}').format(jump) + ':{0}'.format(host['server_port'])
+    if host.get('server_user') is not None:
+        jump = '{0}@{1}'.format(host['server_user'], jump)
+    return jump
+
+
 class ServerConnection(object):
     #
     helper = None
@@ -80,17 +301,24 @@ class ServerConnection(object):
     nosudo = None
     proxy_id = None
     #
-    proxy_config = None
+    proxy_chain = None
     #
-    session_exports = list()
-    session_file_path = os.getenv('AUTH_SESSION', None)
-    session_exports.append('AUTH_CALLBACK="{}";'.format(session_file_path))
-    ssh_wrapper_cmd = os.getenv('AUTH_WRAPPER', 'sudo -u auth /opt/auth/wrappers/ssh.py')
+    session_exports = None
+    session_file_path = None
+    ssh_wrapper_cmd = None
 
     #
     def __init__(self, helper=None, unknown_args=None):
         self.helper = helper
         self.unknown_args = unknown_args
+        self.search_results = []
+
+        # per connection, helperd serves many of them from one process
+        environ = helper.environ if helper is not None else os.environ
+        self.session_write = helper.session_write if helper is not None else True
+        self.session_file_path = environ.get('AUTH_SESSION', None)
+        self.session_exports = ['AUTH_CALLBACK="{}";'.format(self.session_file_path)]
+        self.ssh_wrapper_cmd = environ.get('AUTH_WRAPPER', 'sudo -u auth /opt/auth/wrappers/ssh.py')
 
     #
     # perform connection structure checks
@@ -109,17 +337,17 @@ class ServerConnection(object):
             return
         host_config = self.search_results[0]
 
-        if 'server_ip' in host_config.keys():
+        if 'server_ip' in host_config:
             self.host = host_config['server_ip']
-        if 'server_port' in host_config.keys():
+        if 'server_port' in host_config:
             self.port = host_config['server_port']
-        if 'server_user' in host_config.keys():
+        if 'server_user' in host_config:
             self.user = host_config['server_user']
-        if 'server_nosudo' in host_config.keys():
+        if 'server_nosudo' in host_config:
             self.nosudo = host_config['server_nosudo']
-        if 'proxy_id' in host_config.keys():
+        if 'proxy_id' in host_config:
             self.proxy_id = host_config['proxy_id']
-
+            self.proxy_chain = self.helper.proxy_chain(host_config)
 
     #
     # resolve host configuratin
@@ -130,32 +358,48 @@ class ServerConnection(object):
     #
     # build commands
     #
-    def build_cmd(self):
+    def wrapper_args(self):
+        wrapper_args = []
 
         if self.host:
-            self.ssh_wrapper_cmd += ' {}'.format(self.host)
+            wrapper_args.append(str(self.host))
 
         if self.port:
-            self.ssh_wrapper_cmd += ' --port {}'.format(self.port)
+            wrapper_args += ['--port', str(self.port)]
 
         if self.user:
-            self.ssh_wrapper_cmd += ' --user {}'.format(self.user)
+            wrapper_args += ['--user', str(self.user)]
 
         if self.nosudo:
-            self.ssh_wrapper_cmd += ' --nosudo'
+            wrapper_args.append('--nosudo')
+
+        # ssh.py connects through them with ProxyJump
+        if self.proxy_chain:
+            wrapper_args += ['--proxy-id', str(self.proxy_id),
+                             '--jump', ','.join(format_jump(proxy) for proxy in self.proxy_chain)]
 
         if bool(self.unknown_args):
-            self.ssh_wrapper_cmd += ' ' + ' '.join(self.unknown_args)
+            wrapper_args += list(self.unknown_args)
+
+        return wrapper_args
+
+    def build_cmd(self):
+
+        wrapper_args = self.wrapper_args()
+        if wrapper_args:
+            self.ssh_wrapper_cmd += ' ' + ' '.join(wrapper_args)
 
         self.session_exports.append('AUTH_CALLBACK_CMD="{}"'.format(self.ssh_wrapper_cmd))
 
     def _write_session(self):
-        if self.session_file_path is None:
+        # helperd passes session_exports back to the client instead
+        if self.session_file_path is None or not self.session_write:
             return None
 
-        with open(self.session_file_path, 'w') as sess_f:
-            for line in self.session_exports:
-                    sess_f.write(line + '\n')
+        with self.helper.timings.phase('session_write'):
+            with open(self.session_file_path, 'w') as sess_f:
+                for line in self.session_exports:
+                        sess_f.write(line + '\n')
 
     def start(self):
         self._validate()
@@ -174,20 +418,194 @@ class ServerConnection(object):
 
 class AuthHelper(object):
 
-    def __init__(self, args, unknown_args):
-        self.uuid = str(uuid4())
-        self.projects = None
+    def __init__(self, args, unknown_args, environ=None, source=None):
+        self._uuid = None
+        # reads go to _redis: replica or master, see redis property
+        self._redis = None
+        self._redis_master = None
+        self._replica = None
+        self._replica_checked_at = None
+        # inventory is loaded on first use, exact go lookups may not need it
+        self._hosts_dump = None
+        self._projects = None
+        self._proxies = None
+        self._indexed = None
+        self._storage_layout = None
+        # server_id -> hosts_dump position and project -> hosts count, built on first change log apply
+        self._positions = None
+        self._project_sizes = None
+        self.inventory_version = None
+        # last change log entry in loaded inventory
+        self.changes_id = None
+        self.search_index = None
         self.time_start = time()
+        # per phase timings of this run, see metrics.py
+        self.timings = Timings(self.time_start)
         self.args = args
         self.unknown_args = unknown_args
+        # session file is written by the client when served from helperd
+        self.session_write = True
+        self.environ = os.environ if environ is None else environ
         self._init_env_vars()
-        self.redis = Redis(host=os.getenv('AUTH_REDIS_IP', '127.0.0.1'),
-                           port=int(os.getenv('AUTH_REDIS_PORT', 6379)),
-                           password=os.getenv('AUTH_REDIS_PASS', 'te2uth4dohLi8i'),
-                           db=0)
-        self._load_data()
+
+        # source: warm AuthHelper kept by helperd, share its data and connection
+        if source is not None:
+            self._redis = source.redis
+            self.hosts_dump = source.hosts_dump
+            self.projects = source.projects
+            self.inventory_version = source.inventory_version
+            self.search_index = source.search_index
+            # optional: loaded on first use when source does not have them
+            self._proxies = getattr(source, 'proxies', None)
+            self._storage_layout = getattr(source, 'storage_layout', None)
         LOGGER.debug('AuthHelper init done')
 
+    @property
+    def uuid(self):
+        if self._uuid is None:
+            from uuid import uuid4
+            self._uuid = str(uuid4())
+        return self._uuid
+
+    @staticmethod
+    def _connect(host, port):
+        from redis import Redis
+        return Redis(host=host, port=port,
+                     password=os.getenv('AUTH_REDIS_PASS', 'te2uth4dohLi8i'),
+                     db=int(os.getenv('AUTH_REDIS_DB', 0)))
+
+    @property
+    def redis(self):
+        # reads, connection on first use: local replica (AUTH_REDIS_READ_IP) if it is up
+        # and not behind master, master otherwise; long living processes choose again
+        # every AUTH_REDIS_LAG_INTERVAL seconds
+        if self._redis is None or self._replica_checked_at is not None \
+                and time() - self._replica_checked_at >= self.AUTH_REDIS_LAG_INTERVAL:
+            with self.timings.phase('redis_connect'):
+                self._redis = self._read_redis()
+        return self._redis
+
+    @redis.setter
+    def redis(self, value):
+        self._redis = value
+
+    @property
+    def redis_master(self):
+        # writes (probe results), reads when there is no replica or it can not be used
+        if self._redis_master is None:
+            self._redis_master = self._connect(os.getenv('AUTH_REDIS_IP', '127.0.0.1'),
+                                               int(os.getenv('AUTH_REDIS_PORT', 6379)))
+        return self._redis_master
+
+    def _read_redis(self):
+        from redis.exceptions import RedisError
+        replica_ip = os.getenv('AUTH_REDIS_READ_IP')
+        if not replica_ip:
+            # redis-py connects on the first command, make it here to time it apart from load
+            if self.AUTH_METRICS_DIR:
+                self.redis_master.ping()
+            return self.redis_master
+
+        self._replica_checked_at = time()
+        if self._replica is None:
+            self._replica = self._connect(replica_ip, int(os.getenv('AUTH_REDIS_READ_PORT',
+                                                                    os.getenv('AUTH_REDIS_PORT', 6379))))
+        try:
+            version = self._replica.get('inventory_version')
+        except RedisError as e:
+            LOGGER.debug('redis replica {0} is down, reading from master: {1}'.format(replica_ip, e))
+            return self.redis_master
+
+        master_version = self._master_version()
+        if master_version is not None and (version is None or int(version) < int(master_version)):
+            # version is read from master, data comes from its snapshot if there is one
+            LOGGER.debug('redis replica {0} is behind master: inventory_version {1} < {2}'.format(
+                replica_ip, version, master_version))
+            return self.redis_master
+        return self._replica
+
+    def _master_version(self):
+        # inventory_version of master for replica lag check, asked at most once
+        # per AUTH_REDIS_LAG_INTERVAL by all processes of this bastion
+        from redis.exceptions import RedisError
+        version_path = os.path.join(self.AUTH_CACHE_DIR, 'master_version')
+        try:
+            if time() - os.stat(version_path).st_mtime < self.AUTH_REDIS_LAG_INTERVAL:
+                with open(version_path) as version_f:
+                    return version_f.read().strip() or None
+        except (IOError, OSError):
+            pass
+
+        try:
+            version = self.redis_master.get('inventory_version')
+        except RedisError as e:
+            # replica is all there is
+            LOGGER.debug('redis master is down: ' + str(e))
+            return None
+        version = version.decode() if isinstance(version, bytes) else version
+        self._write_cache(version_path, '{0}\n'.format(version or '').encode('utf-8'), raw=True)
+        return version
+
+    @property
+    def storage_layout(self):
+        if self._storage_layout is None:
+            self._set_storage_layout(self.redis.get('storage_layout'))
+        return self._storage_layout
+
+    def _set_storage_layout(self, layout):
+        layout = layout.decode() if isinstance(layout, bytes) else layout
+        self._storage_layout = layout if layout in STORAGE_LAYOUTS else 'json'
+
+    def _host_key(self, server_id):
+        return '{0}{1}'.format(STORAGE_LAYOUTS[self.storage_layout], server_id)
+
+    @property
+    def hosts_dump(self):
+        if self._hosts_dump is None:
+            self._load_data()
+        return self._hosts_dump
+
+    @hosts_dump.setter
+    def hosts_dump(self, value):
+        self._hosts_dump = value
+
+    @property
+    def projects(self):
+        if self._hosts_dump is None:
+            self._load_data()
+        return self._projects
+
+    @projects.setter
+    def projects(self, value):
+        self._projects = value
+
+    @property
+    def proxies(self):
+        # server_id -> proxy Host, chains are resolved without redis round trips;
+        # before inventory is loaded proxies come from their own small cache file
+        if self._proxies is None:
+            if self._hosts_dump is None:
+                self._proxies = self._load_proxies()
+            if self._proxies is None:
+                self._proxies = self._collect_proxies()
+        return self._proxies
+
+    def proxy_chain(self, host):
+        """
+        Proxies of host by proxy_id, the first one is connected first
+        """
+        chain = []
+        proxy_id = host.get('proxy_id')
+        while proxy_id is not None:
+            proxy = self.proxies.get(int(proxy_id))
+            if proxy is None:
+                raise Exception('proxy_id {0} is not found in inventory'.format(proxy_id))
+            if proxy in chain:
+                raise Exception('proxy_id {0} loop'.format(proxy_id))
+            chain.insert(0, proxy)
+            proxy_id = proxy.get('proxy_id')
+        return chain
+
     def print_p(self, arg, stderr=False):
         try:
             if not stderr:
@@ -245,82 +663,473 @@ class AuthHelper(object):
 
     def _init_env_vars(self):
         # Main config options
-        self.AUTH_DATA_ROOT = os.getenv('AUTH_DATA_ROOT', '/opt/auth')
-        self.AUTH_DEBUG = str2bool(os.getenv('AUTH_DEBUG', False))
+        self.AUTH_DATA_ROOT = self.environ.get('AUTH_DATA_ROOT', '/opt/auth')
+        self.AUTH_DEBUG = str2bool(self.environ.get('AUTH_DEBUG', False))
 
-        self.USER = os.getenv('USER', 'USER_ENV_NOT_SET')
-        self.SUDO_USER = os.getenv('SUDO_USER', 'SUDO_USER_ENV_NOT_SET')
-        self.AUTH_WRAPPER = os.getenv('AUTH_WRAPPER', 'sudo -u auth /mnt/data/auth/wrap/ssh.py')
+        self.USER = self.environ.get('USER', 'USER_ENV_NOT_SET')
+        self.SUDO_USER = self.environ.get('SUDO_USER', 'SUDO_USER_ENV_NOT_SET')
+        self.AUTH_WRAPPER = self.environ.get('AUTH_WRAPPER', 'sudo -u auth /mnt/data/auth/wrap/ssh.py')
 
         # User interface options
         # search print fields seporator
-        self.AUTH_SPF_SEP = os.getenv('AUTH_SPF_SEP', ' | ')
+        self.AUTH_SPF_SEP = self.environ.get('AUTH_SPF_SEP', ' | ')
 
         # Go to server immediately if only one server in group
-        self.AUTH_BLINDE = str2bool(os.getenv('AUTH_BLINDE', False))
+        self.AUTH_BLINDE = str2bool(self.environ.get('AUTH_BLINDE', False))
 
         # Colorize interface
-        self.AUTH_COLORS = str2bool(os.getenv('AUTH_COLORS', False))
+        self.AUTH_COLORS = str2bool(self.environ.get('AUTH_COLORS', False))
 
         # Search Print Line: fields names and order, not template
-        self.AUTH_SPF = os.getenv('AUTH_SPF', 'server_id server_ip server_name').strip().split(' ')
+        self.AUTH_SPF = self.environ.get('AUTH_SPF', 'server_id server_ip server_name').strip().split(' ')
+
+        # Replica lag check: master inventory_version is asked again after this many seconds
+        self.AUTH_REDIS_LAG_INTERVAL = float(self.environ.get('AUTH_REDIS_LAG_INTERVAL', 10))
+
+        # Redis bulk load: SCAN COUNT hint and keys per MGET
+        self.AUTH_REDIS_BATCH = max(int(self.environ.get('AUTH_REDIS_BATCH', 1000)), 1)
+
+        # Ranked search: s shows best matches first, g goes to a clear winner
+        self.AUTH_RANKED = str2bool(self.environ.get('AUTH_RANKED', False))
+        # ranked results shown
+        self.AUTH_RANK_LIMIT = max(int(self.environ.get('AUTH_RANK_LIMIT', 20)), 1)
+        # clear winner: score at least this times higher than the second one
+        self.AUTH_RANK_MARGIN = float(self.environ.get('AUTH_RANK_MARGIN', 1.5))
+
+        # Change log entries applied to loaded inventory at once, full reload if there are more
+        self.AUTH_CHANGES_LIMIT = max(int(self.environ.get('AUTH_CHANGES_LIMIT', 10000)), 1)
+
+        # Local inventory snapshots, one file per inventory_version
+        self.AUTH_CACHE_DIR = self.environ.get('AUTH_CACHE_DIR', os.path.join(self.AUTH_DATA_ROOT, 'cache'))
+
+        # Prometheus textfiles with phase timings of every run, off by default:
+        # every run takes the same lock, set by /etc/sysconfig/auth-metrics
+        self.AUTH_METRICS_DIR = self.environ.get('AUTH_METRICS_DIR', '')
+
+        # probe.py: ssh port connect timeout, sockets at once, result lifetime in redis
+        self.AUTH_PROBE_TIMEOUT = float(self.environ.get('AUTH_PROBE_TIMEOUT', 2))
+        self.AUTH_PROBE_CONCURRENCY = int(self.environ.get('AUTH_PROBE_CONCURRENCY', 200))
+        self.AUTH_PROBE_TTL = int(self.environ.get('AUTH_PROBE_TTL', 300))
 
+    def _snapshot_path(self, version):
+        return os.path.join(self.AUTH_CACHE_DIR, 'inventory_{0}.marshal'.format(version))
+
+    def _load_snapshot(self, version):
+        try:
+            with open(self._snapshot_path(version), 'rb') as snap_f:
+                snapshot = marshal.loads(snap_f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return False
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != version \
+                or snapshot.get('format') != SNAPSHOT_FORMAT:
+            return False
+
+        self.hosts_dump = [Host.from_tuple(host) for host in snapshot['hosts']]
+        self.projects = snapshot['projects']
+        self.inventory_version = version
+        self.changes_id = snapshot.get('changes_id')
+        self.search_index = None
+        self._positions = None
+        self._proxies = None
+        LOGGER.debug('_load_snapshot: ' + version)
+        return True
+
+    def _proxies_path(self, version):
+        return os.path.join(self.AUTH_CACHE_DIR, 'proxies_{0}.marshal'.format(version))
+
+    def _load_proxies(self):
+        version = self._get_inventory_version()
+        if version is None:
+            return None
+        try:
+            with open(self._proxies_path(version), 'rb') as proxies_f:
+                cache = marshal.loads(proxies_f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if not isinstance(cache, dict) or cache.get('version') != version \
+                or cache.get('format') != SNAPSHOT_FORMAT:
+            return None
+
+        LOGGER.debug('_load_proxies: ' + version)
+        return dict((int(host['server_id']), host) for host in map(Host.from_tuple, cache['proxies']))
+
+    def _collect_proxies(self):
+        proxy_ids = set(int(host['proxy_id']) for host in self.hosts_dump if host.get('proxy_id') is not None)
+        return dict((int(host['server_id']), host) for host in self.hosts_dump
+                    if int(host['server_id']) in proxy_ids)
+
+    def _write_cache(self, path, data, raw=False):
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+
+        # cache is shared by all auth users, write it readable for the group
+        # and move in place atomically, readers never see a partial file
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o640)
+            with os.fdopen(fd, 'wb') as cache_f:
+                cache_f.write(data if raw else marshal.dumps(data))
+            os.chmod(tmp_path, 0o640)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            LOGGER.debug('_write_cache: ' + str(e))
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def _save_snapshot(self, version):
+        snapshot_path = self._snapshot_path(version)
+        proxies_path = self._proxies_path(version)
+        snapshot = dict(version=version, format=SNAPSHOT_FORMAT, projects=self.projects,
+                        changes_id=self.changes_id, hosts=[host.to_tuple() for host in self.hosts_dump])
+        proxies = dict(version=version, format=SNAPSHOT_FORMAT,
+                       proxies=[host.to_tuple() for host in self.proxies.values()])
+
+        if not self._write_cache(snapshot_path, snapshot) or not self._write_cache(proxies_path, proxies):
+            return
+        self.write_completion(version)
+
+        # drop caches of older versions
+        for file_name in os.listdir(self.AUTH_CACHE_DIR):
+            file_path = os.path.join(self.AUTH_CACHE_DIR, file_name)
+            if file_name.startswith(('inventory_', 'proxies_')) and file_name.endswith('.marshal') \
+                    and file_path not in [snapshot_path, proxies_path]:
+                try:
+                    os.unlink(file_path)
+                except OSError:
+                    pass
+
+    def _completion_path(self, name):
+        return os.path.join(self.AUTH_CACHE_DIR, 'completion_' + name)
+
+    def completion_version(self):
+        try:
+            with open(self._completion_path('version')) as version_f:
+                return version_f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def write_completion(self, version):
+        # TAB in bash.sh looks words up with look(1), binary search needs
+        # byte order sorted lines: words - first argument, hosts - project and second one
+        def is_word(value):
+            return bool(value) and value.split() == [value]
+
+        words = set(project for project in self.projects if is_word(project))
+        hosts = set()
+        for host in self.hosts_dump:
+            for key in ['server_name', 'server_id']:
+                word = str(host.get(key, ''))
+                if is_word(word):
+                    words.add(word)
+                    if is_word(host['project_name']):
+                        hosts.add('{0} {1}'.format(host['project_name'], word))
+
+        for name, lines in [('words', words), ('hosts', hosts)]:
+            data = ''.join(line + '\n' for line in sorted(lines)).encode('utf-8')
+            if not self._write_cache(self._completion_path(name), data, raw=True):
+                return False
+        return self._write_cache(self._completion_path('version'), (version + '\n').encode('utf-8'), raw=True)
+
+    def _get_inventory_version(self):
+        # layout changes bump the version too, read them together
+        version, layout = self.redis.mget(['inventory_version', 'storage_layout'])
+        self._set_storage_layout(layout)
+        if version is not None:
+            version = version.decode() if isinstance(version, bytes) else str(version)
+        return version
+
+    @timed('load')
     def _load_data(self):
+        # auth-manager.py bumps inventory_version on every write,
+        # data from redis is needed only when the version has changed
+        # and an older snapshot can not be brought up to it with the change log
+        version = self._get_inventory_version()
+        if version is not None and (self._load_snapshot(version) or self._load_snapshot_changes(version)):
+            return
+
+        self.inventory_version = version
+        self.changes_id = self._get_changes_id(version)
+        self._load_data_redis()
+
+        if version is not None:
+            self._save_snapshot(version)
+
+    @timed('load')
+    def refresh(self):
+        # reload for long living processes (helperd), version unknown means always;
+        # loaded inventory gets only the changes since it when the change log has them
+        version = self._get_inventory_version()
+        if version is None or version != self.inventory_version:
+            if self._hosts_dump is None or not self._apply_changes(version):
+                self._load_data()
+
+    def _load_snapshot_changes(self, version):
+        # snapshot of an older version left in cache plus change log entries after it
+        try:
+            file_names = os.listdir(self.AUTH_CACHE_DIR)
+        except OSError:
+            return False
+        versions = [int(match.group(1)) for match in map(SNAPSHOT_NAME.match, file_names)
+                    if match and int(match.group(1)) < int(version)]
+        if not versions or not self._load_snapshot(str(max(versions))) or not self._apply_changes(version):
+            return False
+
+        # resident helpers apply changes in memory only, the first process to start saves the version
+        self._save_snapshot(self.inventory_version)
+        return True
+
+    def _get_changes_id(self, version):
+        # id of the last change log entry, read together with version:
+        # entries after it are changes made after this version
+        from redis.exceptions import ResponseError
+        if version is None:
+            return None
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.get('inventory_version')
+        pipe.xrevrange(CHANGES_STREAM, count=1)
+        try:
+            current, last = pipe.execute()
+        except ResponseError as e:
+            # redis before 5.0, no streams
+            LOGGER.debug('_get_changes_id: ' + str(e))
+            return None
+
+        current = current.decode() if isinstance(current, bytes) else current
+        if not last or current != version:
+            return None
+        return last[0][0].decode()
+
+    def _apply_changes(self, version):
+        """
+        Bring loaded inventory up to version with change log entries after changes_id.
+        False if the log does not have all of them and full reload is needed.
+        """
+        import json
+        from redis.exceptions import ResponseError
+        if self.changes_id is None or self.inventory_version is None or version is None:
+            return False
+
+        try:
+            # starts with changes_id itself: if it is still there, nothing after it was trimmed
+            changes = self.redis.xrange(CHANGES_STREAM, min=self.changes_id, count=self.AUTH_CHANGES_LIMIT + 1)
+        except ResponseError as e:
+            LOGGER.debug('_apply_changes: ' + str(e))
+            return False
+        if not changes or changes[0][0].decode() != self.changes_id or len(changes) > self.AUTH_CHANGES_LIMIT:
+            return False
+        changes = changes[1:]
+
+        # versions go one by one, reindex and migrate bump it without entries
+        loaded = int(self.inventory_version)
+        for _, change in changes:
+            change_version = int(change[b'version'])
+            if change_version == loaded + 1:
+                loaded = change_version
+            elif change_version != loaded:
+                return False
+        if loaded < int(version):
+            return False
+
+        for _, change in changes:
+            if change[b'op'] == b'del':
+                self._remove_host(int(change[b'server_id']))
+                continue
+            host = json.loads(change[b'host'].decode('utf-8'))
+            if self.storage_layout == 'hash':
+                # as in _load_data_redis, metadata is fetched by print_hosts
+                host = dict((key, host.get(key)) for key in Host.FIELDS)
+            self._put_host(Host(host))
+
+        self.projects = list(sorted(project for project, size in self._project_sizes.items() if size))
+        self._proxies = None
+        self.inventory_version = str(loaded)
+        self.changes_id = changes[-1][0].decode()
+        LOGGER.debug('_apply_changes: {0} changes, version {1}'.format(len(changes), loaded))
+        return True
+
+    def _host_positions(self):
+        if self._positions is None:
+            self._positions = dict()
+            self._project_sizes = dict()
+            for position, host in enumerate(self.hosts_dump):
+                self._positions[int(host['server_id'])] = position
+                self._project_sizes[host['project_name']] = self._project_sizes.get(host['project_name'], 0) + 1
+        return self._positions
+
+    def _count_host(self, host, count):
+        self._project_sizes[host['project_name']] = self._project_sizes.get(host['project_name'], 0) + count
+
+    def _put_host(self, host):
+        # changed host keeps its position, new one goes to the end
+        positions = self._host_positions()
+        position = positions.get(int(host['server_id']))
+        if position is None:
+            position = positions[int(host['server_id'])] = len(self.hosts_dump)
+            self.hosts_dump.append(host)
+        else:
+            self._index_host(position, self.hosts_dump[position], add=False)
+            self._count_host(self.hosts_dump[position], -1)
+            self.hosts_dump[position] = host
+        self._index_host(position, host, add=True)
+        self._count_host(host, 1)
+
+    def _remove_host(self, server_id):
+        # the last host takes place of removed one, positions of the others stay
+        position = self._host_positions().pop(server_id, None)
+        if position is None:
+            return
+        self._index_host(position, self.hosts_dump[position], add=False)
+        self._count_host(self.hosts_dump[position], -1)
+        last = self.hosts_dump.pop()
+        if position < len(self.hosts_dump):
+            self._index_host(len(self.hosts_dump), last, add=False)
+            self.hosts_dump[position] = last
+            self._positions[int(last['server_id'])] = position
+            self._index_host(position, last, add=True)
+
+    def _index_host(self, position, host, add):
+        # search index postings of one host, the index is not rebuilt for a change
+        if self.search_index is None:
+            return
+        for trigram in self._trigrams(host):
+            if add:
+                self.search_index.setdefault(trigram, set()).add(position)
+                continue
+            postings = self.search_index.get(trigram)
+            if postings is not None:
+                postings.discard(position)
+                if not postings:
+                    del self.search_index[trigram]
+
+    def _load_data_redis(self):
+        import json
         self.hosts_dump = []
         self.projects = []
 
-        for server_key in self.redis.keys('server_*'):
-            server_data = self.redis.get(server_key)
-            server_data = json.loads(server_data)
+        # SCAN does not block redis like KEYS, but may return a key twice
+        server_keys = list(set(self.redis.scan_iter(match=self._host_key('*'), count=self.AUTH_REDIS_BATCH)))
+
+        if self.storage_layout == 'hash':
+            # wide metadata stays in redis, print_hosts fetches shown fields of shown hosts
+            for server_data in self._hmget_hosts(server_keys, Host.FIELDS):
+                self.projects.append(server_data['project_name'])
+                self.hosts_dump.append(server_data)
+            self._finish_load()
+            return
+
+        # one round trip for all MGET batches
+        pipe = self.redis.pipeline(transaction=False)
+        for offset in range(0, len(server_keys), self.AUTH_REDIS_BATCH):
+            pipe.mget(server_keys[offset:offset + self.AUTH_REDIS_BATCH])
+
+        for batch in pipe.execute():
+            for server_data in batch:
+                # key deleted between SCAN and MGET
+                if server_data is None:
+                    continue
+                server_data = Host(json.loads(server_data))
+
+                self.projects.append(server_data['project_name'])
+                self.hosts_dump.append(server_data)
 
-            self.projects.append(server_data['project_name'])
-            self.hosts_dump.append(server_data)
+        self._finish_load()
 
+    def _hmget_hosts(self, keys, fields):
+        # hash layout records with only these fields, pipelined HMGET, one round trip
+        import json
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, fields)
+
+        hosts = []
+        for values in pipe.execute():
+            data = dict((field, json.loads(value)) for field, value in zip(fields, values) if value is not None)
+            # key deleted between SCAN and HMGET
+            if data:
+                hosts.append(Host(data))
+        return hosts
+
+    def _finish_load(self):
         self.projects = list(sorted(set(self.projects)))
         self.hosts_dump = sorted(self.hosts_dump, key=itemgetter('project_name'))
+        self.search_index = None
+        self._positions = None
+        self._proxies = None
 
         LOGGER.debug('_load_data')
-        LOGGER.debug(json.dumps(self.hosts_dump, indent=4))
-        LOGGER.debug(json.dumps(self.projects, indent=4))
-
-    def _search_in_item(self, **kwargs):
-        item = kwargs.get('item')
-        item_keys = item.keys()
-        # query_src = kwargs.get('query_src')
-        query_lower = kwargs.get('query_lower')
-
-        # project_id - is bad idea
-        fields = kwargs.get('fields', ['project_name',
-                                       'project_id',
-                                       'server_name',
-                                       'server_id',
-                                       'server_ip',
-                                       'os_version',
-                                       'asn'])  # 'alerts'
-
-        exact_match = kwargs.get('exact_match', False)
+        # dumps of the whole inventory are costly, skip them unless debug is on
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            import json
+            LOGGER.debug(json.dumps([host.to_dict() for host in self.hosts_dump], indent=4))
+            LOGGER.debug(json.dumps(self.projects, indent=4))
+
+    def build_search_index(self):
+        # trigram -> set of hosts_dump positions, over lowercased SEARCH_FIELDS values;
+        # fields are joined with \0, so trigrams never span two fields
+        search_index = dict()
+
+        for position, item in enumerate(self.hosts_dump):
+            for trigram in self._trigrams(item):
+                postings = search_index.get(trigram)
+                if postings is None:
+                    search_index[trigram] = postings = set()
+                postings.add(position)
+
+        self.search_index = search_index
+        LOGGER.debug('build_search_index: {0} trigrams'.format(len(search_index)))
+
+    @staticmethod
+    def _trigrams(item):
+        text = '\0'.join(str(item[key]).lower() for key in SEARCH_FIELDS if key in item)
+        return set(text[i:i + 3] for i in range(len(text) - 2))
+
+    def _search_candidates(self, query_lower):
+        # hosts_dump positions with every trigram of query, still need a verify
+        postings = []
+        for trigram in set(query_lower[i:i + 3] for i in range(len(query_lower) - 2)):
+            if trigram not in self.search_index:
+                return []
+            postings.append(self.search_index[trigram])
+
+        postings.sort(key=len)
+        return sorted(postings[0].intersection(*postings[1:]))
 
+    @staticmethod
+    def _search_in_item(item, query_lower, fields=SEARCH_FIELDS, exact_match=False):
         if exact_match:
             for key in fields:
-                if key not in item_keys:
+                if key not in item:
                     continue
                 if query_lower == str(item[key]).lower():
-                    item['exact_match'] = key
-                    return item
+                    return Match(item, exact_match=key)
         else:
             for key in fields:
-                if key not in item_keys:
+                if key not in item:
                     continue
                 if query_lower in str(item[key]).lower():
-                    item['match_by'] = key
-                    return item
+                    return Match(item, match_by=key)
         return False
 
+    @timed('search')
     def search(self, query, **kwargs):
         time_search_start = time()
         source = kwargs.pop('source', self.hosts_dump)
         project = kwargs.pop('project_name', False)
-        kwargs.update(query_src=str(query), query_lower=query.lower())
+        fields = kwargs.pop('fields', SEARCH_FIELDS)
+        exact_match = kwargs.pop('exact_match', False)
+        query_lower = query.lower()
+        kwargs.update(query_src=str(query))
+
+        # index is usable only for full inventory and indexed fields,
+        # queries shorter than trigram have no postings
+        if self.search_index is not None and source is self.hosts_dump and len(query_lower) >= 3 \
+                and set(fields).issubset(SEARCH_FIELDS):
+            source = [self.hosts_dump[position] for position in self._search_candidates(query_lower)]
+            kwargs.update(search_index=True)
 
         result = list()
 
@@ -330,16 +1139,15 @@ class AuthHelper(object):
                 if item['project_name'] != project:
                     continue
 
-            item_query = copy(kwargs)
-            item_query['item'] = item
-
-            res = self._search_in_item(**item_query)
+            res = self._search_in_item(item, query_lower, fields, exact_match)
             if bool(res):
                 result.append(res)
 
-        kwargs.pop('query_lower')
         kwargs.update(search_time=float(time() - time_search_start))
 
+        # hosts added from change log are at the end of hosts_dump, keep projects together
+        result.sort(key=itemgetter('project_name'))
+
         if kwargs.get('sort'):
             result = sorted(result, key=operator.itemgetter(kwargs.get('sort')))
 
@@ -347,6 +1155,189 @@ class AuthHelper(object):
 
         return result
 
+    def _rank_candidates(self, query_lower, missing=0):
+        # hosts_dump positions with all but missing trigrams of query, None - every host
+        trigrams = set(query_lower[i:i + 3] for i in range(len(query_lower) - 2))
+        if self.search_index is None or len(trigrams) <= missing:
+            return None
+        if not missing:
+            return self._search_candidates(query_lower)
+
+        counts = dict()
+        for trigram in trigrams:
+            for position in self.search_index.get(trigram, ()):
+                counts[position] = counts.get(position, 0) + 1
+        return sorted(position for position, count in counts.items() if count >= len(trigrams) - missing)
+
+    @timed('search')
+    def rank(self, query, **kwargs):
+        """
+        Best matches of query, best first, at most limit. Hosts are scored one by one
+        and only the top limit of them are kept. Typos are looked for only when
+        there are less than limit hosts with query in them.
+        """
+        import heapq
+        import itertools
+        time_rank_start = time()
+        limit = kwargs.pop('limit', self.AUTH_RANK_LIMIT)
+        project = kwargs.pop('project_name', False)
+        query_lower = query.lower()
+        matched = set()
+
+        def scored(positions, typo):
+            if positions is None:
+                positions = range(len(self.hosts_dump))
+            for position in positions:
+                item = self.hosts_dump[position]
+                if position in matched or (project and item['project_name'] != project):
+                    continue
+
+                best_score, best_key = 0, None
+                for key, weight in RANK_FIELDS:
+                    if typo and key not in RANK_TYPO_FIELDS:
+                        continue
+                    value = item.get(key)
+                    if value is None:
+                        continue
+                    value = str(value).lower()
+                    score = rank_typo(query_lower, value) if typo else rank_value(query_lower, value)
+                    if score * weight > best_score:
+                        best_score, best_key = score * weight, key
+
+                # ties in inventory order
+                if best_score:
+                    matched.add(position)
+                    yield best_score, -position, best_key
+
+        def scored_typo():
+            # one typo breaks at most 4 trigrams of query
+            if len(matched) < limit and len(query_lower) >= RANK_TYPO_MIN_LENGTH:
+                for match in scored(self._rank_candidates(query_lower, missing=4), typo=True):
+                    yield match
+
+        top = heapq.nlargest(limit, itertools.chain(scored(self._rank_candidates(query_lower), typo=False),
+                                                    scored_typo()))
+        result = []
+        for score, negative_position, key in top:
+            item = self.hosts_dump[-negative_position]
+            exact = key if str(item[key]).lower() == query_lower else None
+            result.append(Match(item, match_by=None if exact else key, exact_match=exact, score=round(score, 2)))
+
+        LOGGER.debug((query, dict(rank_time=float(time() - time_rank_start), limit=limit)))
+        return result
+
+    def clear_winner(self, ranked):
+        # first of ranked results is far enough ahead of the second one
+        if not ranked:
+            return False
+        return len(ranked) == 1 or ranked[0]['score'] >= ranked[1]['score'] * self.AUTH_RANK_MARGIN
+
+    def _use_redis_index(self):
+        # secondary indexes are maintained by auth-manager.py since reindex,
+        # loaded inventory is faster to scan than to ask redis
+        if self._hosts_dump is not None:
+            return False
+        if self._indexed is None:
+            self._indexed = bool(self.redis.exists('index_ready'))
+        return self._indexed
+
+    def _get_hosts(self, server_ids):
+        import json
+        if not server_ids:
+            return []
+        if self.storage_layout == 'hash':
+            fields = CONNECT_FIELDS + tuple(key for key in self.AUTH_SPF
+                                            if key in Host.FIELDS and key not in CONNECT_FIELDS)
+            return self._hmget_hosts([self._host_key(server_id) for server_id in server_ids], fields)
+        hosts = self.redis.mget(['server_{0}'.format(server_id) for server_id in server_ids])
+        return [Host(json.loads(host)) for host in hosts if host is not None]
+
+    @timed('search')
+    def is_project(self, name):
+        if self._use_redis_index():
+            return bool(self.redis.sismember('index_projects', name))
+        return name in self.projects
+
+    @timed('search')
+    def find_by_server_id(self, server_id):
+        if not self._use_redis_index():
+            return self.search(server_id, fields=['server_id'], exact_match=True)
+        return [Match(host, exact_match='server_id') for host in self._get_hosts([server_id])]
+
+    @timed('search')
+    def find_by_project(self, project):
+        if not self._use_redis_index():
+            return self.search(project, fields=['project_name'], exact_match=True)
+        server_ids = sorted(int(server_id) for server_id in self.redis.smembers('index_project_' + project))
+        return [Match(host, exact_match='project_name') for host in self._get_hosts(server_ids)]
+
+    @timed('search')
+    def find_in_project(self, project, query):
+        fields = ['server_name', 'server_id', 'server_ip']
+        if not self._use_redis_index():
+            return self.search(query, project_name=project, fields=fields, exact_match=True)
+
+        query_lower = query.lower()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hget('index_name_' + project, query_lower)
+        pipe.hget('index_ip_' + project, query_lower)
+        names, ips = pipe.execute()
+
+        server_ids = []
+        for ids in [names, ips]:
+            if ids is not None:
+                server_ids.extend(int(server_id) for server_id in ids.decode('utf-8').split(','))
+        if query.isdigit():
+            server_ids.append(int(query))
+
+        # same annotations as search(exact_match=True) in fields order
+        result = []
+        for host in self._get_hosts(sorted(set(server_ids))):
+            if host['project_name'] != project:
+                continue
+            res = self._search_in_item(host, query_lower, fields, exact_match=True)
+            if res:
+                result.append(res)
+        return result
+
+    def probe_hosts(self, hosts, concurrency=None, timeout=None):
+        # connect to ssh port of hosts, results are kept in redis for AUTH_PROBE_TTL
+        from probe import probe
+
+        targets = [(int(host['server_id']), host['server_ip'], int(host.get('server_port', 22)))
+                   for host in hosts if 'server_ip' in host and 'proxy_id' not in host]
+        results = probe(targets, concurrency=concurrency or self.AUTH_PROBE_CONCURRENCY,
+                        timeout=timeout or self.AUTH_PROBE_TIMEOUT)
+
+        import json
+        probed_at = time()
+        pipe = self.redis_master.pipeline(transaction=False)
+        for server_id, rtt in results.items():
+            pipe.set(PROBE_KEY.format(server_id), json.dumps(dict(rtt=rtt, probed_at=probed_at)),
+                     ex=self.AUTH_PROBE_TTL)
+        pipe.execute()
+        return results
+
+    def probe_results(self, hosts):
+        # server_id -> last probe, one MGET, hosts never probed or expired are missing
+        import json
+        server_ids = [int(host['server_id']) for host in hosts if 'server_id' in host]
+        if not server_ids:
+            return dict()
+
+        results = dict()
+        for server_id, probe in zip(server_ids, self.redis.mget([PROBE_KEY.format(server_id)
+                                                                 for server_id in server_ids])):
+            if probe is not None:
+                results[server_id] = json.loads(probe)
+        return results
+
+    def write_metrics(self, action):
+        # whole run is the total phase, output is already written
+        self.timings.total()
+        LOGGER.debug(self.timings.phases)
+        return metrics.write(self.AUTH_METRICS_DIR, HELPER_METRICS, action, self.timings)
+
     def colorize(self, text, color=None):
         colors = dict(
             header='\033[95m',
@@ -374,7 +1365,7 @@ class AuthHelper(object):
         else:
             return '{0}{1}{2}'.format(colors.get(color), text, colors.get('reset'))
 
-    def ljust_algin(self, host, **kwargs):
+    def ljust_algin(self, rows):
         # Minimum field size (add spaces)
         ljust_size = {
             'project_name': 8,
@@ -384,23 +1375,37 @@ class AuthHelper(object):
             'ssh_config_ip': 16
         }
 
-        host = copy(host)
-        for key in self.AUTH_SPF:
-            if key not in host.keys():
-                continue
-            if host[key] in [None, True, False]:
-                continue
-            if len(str(host[key])) > 0 and key in self.AUTH_SPF:
-                if key in ljust_size:
-                    host[key] = str(host[key]).ljust(ljust_size[key], ' ')
-                if host[key][-1] != ' ':
-                    host[key] += ' '
-        return host
+        # rows: printed fields values, one pass for column widths,
+        # at least one space after the longest value
+        widths = dict()
+        for fields in rows:
+            for key, value in fields.items():
+                width = max(len(value) + 1, ljust_size.get(key, 0))
+                if width > widths.get(key, 0):
+                    widths[key] = width
+
+        # columns empty in every row are not printed
+        columns = [key for key in self.AUTH_SPF if key in widths]
+
+        virtual_colors = dict(match_info='okgreen', probe_rtt='okblue')
+        status_colors = dict(up='green', down='critical')
+        aligned = []
+        for fields in rows:
+            line = []
+            for key in columns:
+                value = fields.get(key, '')
+                color = status_colors.get(value) if key == 'probe_status' else virtual_colors.get(key)
+                value = value.ljust(widths[key], ' ')
+                if color is not None:
+                    value = self.colorize(value, color=color)
+                line.append(value)
+            aligned.append(line)
+        return aligned
 
     def append_virtual_fields(self, host, **kwargs):
-        # Some helpful fields hook
+        # Some helpful fields hook, returns only virtual fields
         ambiguous = kwargs.get('ambiguous', False)
-        host_keys = host.keys()
+        virtual_fields = dict()
 
         if ambiguous:
             self.AUTH_SPF = ['server_id', 'match_info', 'exact_match', 'server_id', 'project_name',
@@ -409,20 +1414,47 @@ class AuthHelper(object):
         # matching debug field
         if 'match_info' in self.AUTH_SPF:
             match_info = list()
-            if 'match_by' in host_keys:
+            if 'match_by' in host:
                 match_info.append('by: {}'.format(host['match_by']))
-            if 'exact_match' in host_keys:
+            if 'exact_match' in host:
                 match_info.append('exact: {}'.format(host['exact_match']))
+            if 'score' in host:
+                match_info.append('score: {}'.format(host['score']))
 
-            host['match_info'] = self.colorize(', '.join(match_info), color='okgreen')
+            virtual_fields['match_info'] = ', '.join(match_info)
 
-        return host
+        # hash layout metadata fields fetched by print_hosts
+        virtual_fields.update(kwargs.get('extra') or {})
 
+        # ssh port reachability, as probe.py saw it last time
+        probes = kwargs.get('probes')
+        if probes is not None and 'server_id' in host and int(host['server_id']) in probes:
+            rtt = probes[int(host['server_id'])]['rtt']
+            virtual_fields['probe_status'] = 'down' if rtt is None else 'up'
+            if rtt is not None:
+                virtual_fields['probe_rtt'] = '{0:.1f}ms'.format(rtt * 1000)
+
+        return virtual_fields
+
+    def host_fields(self, host, **kwargs):
+        # AUTH_SPF fields of host as strings
+        virtual_fields = kwargs.get('virtual_fields', {})
+        fields = dict()
+        for key in self.AUTH_SPF:
+            value = virtual_fields[key] if key in virtual_fields else host.get(key)
+            if value is not None:
+                fields[key] = str(value)
+        return fields
+
+    @timed('render')
     def print_hosts(self, hosts, **kwargs):
+        # whole output is rendered to one buffer and written once
+        from pager import write_output
+
         title = kwargs.get('title', True)  # Print project title by default
         total = kwargs.get('total', True)
         current_project = None  # stub
-        counter = 0
+        out = []
 
         if len(hosts) == 0:
             ambiguous = True
@@ -431,58 +1463,58 @@ class AuthHelper(object):
 
         if ambiguous:
             if len(hosts) == 0:
-                self.print_p(self.colorize('\n  No servers found by this query: ', color='warn')
-                             + ' '.join(self.args.sargs))
+                out.append(self.colorize('\n  No servers found by this query: ', color='warn')
+                           + ' '.join(self.args.sargs))
             else:
-                self.print_p(self.colorize('\n  Ambiguous, more than one server found '
-                                           'by this query: \n', color='warn'))
+                out.append(self.colorize('\n  Ambiguous, more than one server found '
+                                         'by this query: \n', color='warn'))
 
         if not title:
-            self.print_p('')
-
+            out.append('')
+
+        # Fields print prepare
+        probes = None
+        if set(PROBE_FIELDS).intersection(self.AUTH_SPF) and not ambiguous:
+            probes = self.probe_results(hosts)
+
+        # hash layout: AUTH_SPF metadata fields are not loaded with inventory
+        extras = dict()
+        extra_fields = [key for key in self.AUTH_SPF if key not in Host.FIELDS and key not in VIRTUAL_FIELDS]
+        if extra_fields and hosts and self.storage_layout == 'hash':
+            keys = [self._host_key(host['server_id']) for host in hosts]
+            for extra in self._hmget_hosts(keys, ['server_id'] + extra_fields):
+                extras[int(extra['server_id'])] = dict((key, extra.get(key)) for key in extra_fields if key in extra)
+
+        rows = []
         for host in hosts:
+            virtual_fields = self.append_virtual_fields(host, ambiguous=ambiguous, probes=probes,
+                                                        extra=extras.get(int(host['server_id'])) if extras else None)
+            rows.append(self.host_fields(host, virtual_fields=virtual_fields))
+
+        for host, host_line in zip(hosts, self.ljust_algin(rows)):
             # project_name
             # ------
             # Title
             if current_project != host['project_name'] and title and not ambiguous:
                 current_project = host['project_name']
-                title_tpl = '\n{0}\n------'.format(self.colorize(current_project, color='project_name'))
-                self.print_p(title_tpl)
-
-            # Fields print prepare
-            host = self.append_virtual_fields(host, ambiguous=ambiguous)
-            host = self.ljust_algin(host)
-
-            # Concat strings
-            host_line = []
-
-            for field in self.AUTH_SPF:
-                if field in host.keys():
-                    host_line.append(host[field])
+                out.append('\n{0}\n------'.format(self.colorize(current_project, color='project_name')))
 
             if ambiguous or not title:
-                line = '  ' + self.AUTH_SPF_SEP.join(host_line)
+                out.append('  ' + self.AUTH_SPF_SEP.join(host_line))
             else:
-                line = self.AUTH_SPF_SEP.join(host_line)
-
-            self.print_p(line)
-            counter += 1
+                out.append(self.AUTH_SPF_SEP.join(host_line))
 
         if ambiguous:
-            total_tpl = '\n  Total: {0}\n'.format(counter)
-            self.print_p(total_tpl)
-
+            out.append('\n  Total: {0}\n'.format(len(hosts)))
         elif total:
-            total_tpl = '\n------\nTotal: {0}\n'.format(counter)
-            self.print_p(total_tpl)
+            out.append('\n------\nTotal: {0}\n'.format(len(hosts)))
         else:
-            self.print_p('')
+            out.append('')
 
+        write_output('\n'.join(out) + '\n')
 
-def main():
-    args, unknown_args = init_args()
-    helper = AuthHelper(args, unknown_args)
 
+def run(helper, args, unknown_args):
     conn = ServerConnection(helper=helper, unknown_args=unknown_args)
 
     if args.action[0] == 'search':
@@ -490,14 +1522,25 @@ def main():
         LOGGER.debug(args)
         LOGGER.debug(unknown_args)
 
-        if len(args.sargs) == 1 and args.sargs[0] in helper.projects:
+        if args.rank or helper.AUTH_RANKED:
+            if len(args.sargs) == 2 and args.sargs[0] in helper.projects:
+                search_results = helper.rank(args.sargs[1], project_name=args.sargs[0])
+            else:
+                search_results = helper.rank(' '.join(args.sargs))
+        elif len(args.sargs) == 1 and args.sargs[0] in helper.projects:
             search_results = helper.search(args.sargs[0], fields=['project'], exact_match=True)
         elif len(args.sargs) == 2 and args.sargs[0] in helper.projects:
             search_results = helper.search(args.sargs[1], project=args.sargs[0])
         else:
             search_results = helper.search(' '.join(args.sargs))
 
-        helper.print_hosts(search_results)
+        # on demand probe, plain s only shows results of probe.py
+        if args.probe:
+            helper.probe_hosts(search_results)
+            helper.AUTH_SPF += [key for key in PROBE_FIELDS if key not in helper.AUTH_SPF]
+
+        # ranked results are in score order, not grouped by project
+        helper.print_hosts(search_results, title=not (args.rank or helper.AUTH_RANKED))
 
     elif args.action[0] == 'go':
 
@@ -511,7 +1554,7 @@ def main():
         # if its some ID (only digits) search in server_id fields
         if len(args.sargs) == 1 and args.sargs[0].isdigit():
             conn.arg_type = 'server_id_only'
-            conn.search_results = helper.search(args.sargs[0], fields=['server_id'], exact_match=True)
+            conn.search_results = helper.find_by_server_id(args.sargs[0])
 
             if len(conn.search_results) == 1:
                 conn.project = conn.search_results[0]['project_name']
@@ -520,18 +1563,7 @@ def main():
             else:
                 helper.print_hosts(conn.search_results, ambiguous=True)
 
-        elif len(args.sargs) == 1 and args.sargs[0] in helper.projects:
-            conn.arg_type = 'project_only'
-            conn.project = args.sargs[0]
-            conn.search_results = helper.search(args.sargs[0], fields=['project_name'], exact_match=True)
-
-            if len(conn.search_results) == 1 and helper.AUTH_BLINDE:
-                conn.server_id = conn.search_results[0]['server_id']
-                conn.start()
-            else:
-                helper.print_hosts(conn.search_results)
-
-        # if arg is ipv4 or fqdn
+        # if arg is ipv4 or fqdn, no inventory needed
         elif len(args.sargs) == 1 and helper.is_valid_ipv4(args.sargs[0]):
             conn.arg_type = 'ipv4_only'
             conn.host = args.sargs[0]
@@ -543,16 +1575,25 @@ def main():
             conn.host = args.sargs[0]
             conn.start()
 
+        elif len(args.sargs) == 1 and helper.is_project(args.sargs[0]):
+            conn.arg_type = 'project_only'
+            conn.project = args.sargs[0]
+            conn.search_results = helper.find_by_project(args.sargs[0])
+
+            if len(conn.search_results) == 1 and helper.AUTH_BLINDE:
+                conn.server_id = conn.search_results[0]['server_id']
+                conn.start()
+            else:
+                helper.print_hosts(conn.search_results)
+
         #
         # Two arguments
         #
         # if first arg is project and second ... shit
-        elif len(args.sargs) == 2 and args.sargs[0] in helper.projects:
+        elif len(args.sargs) == 2 and helper.is_project(args.sargs[0]):
             conn.arg_type = 'project_with_some_shit'
             conn.project = args.sargs[0]
-            conn.search_results = helper.search(args.sargs[1], project_name=conn.project,
-                                                fields=['server_name', 'server_id', 'server_ip'],
-                                                exact_match=True)
+            conn.search_results = helper.find_in_project(conn.project, args.sargs[1])
 
             if len(conn.search_results) == 1:
                 if args.sargs[1].isdigit():
@@ -580,15 +1621,111 @@ def main():
                 elif helper.is_valid_fqdn(args.sargs[1]) and not args.sargs[1].isdigit() and '.' in args.sargs[1]:
                     conn.arg_type = 'project_with_fqdn_host_not_found'
                     conn.start()
+                elif helper.AUTH_RANKED:
+                    go_ranked(helper, conn, args.sargs[1], project=conn.project)
                 else:
                     helper.print_hosts(conn.search_results, ambiguous=True)
+            elif helper.AUTH_RANKED:
+                go_ranked(helper, conn, args.sargs[1], project=conn.project)
             else:
                 helper.print_hosts(conn.search_results, ambiguous=True)
+
+        # anything else is a query, when ranked search is on
+        elif helper.AUTH_RANKED:
+            go_ranked(helper, conn, ' '.join(args.sargs))
         else:
             LOGGER.critical('args not match')
+
+    elif args.action[0] == 'exec':
+        if not args.command:
+            LOGGER.critical('No command, usage: x <project|query> [opts] -- <command>')
+            sys.exit(1)
+
+        if len(args.sargs) == 1 and helper.is_project(args.sargs[0]):
+            hosts = helper.find_by_project(args.sargs[0])
+        elif len(args.sargs) == 2 and helper.is_project(args.sargs[0]):
+            hosts = helper.search(args.sargs[1], project_name=args.sargs[0])
+        else:
+            hosts = helper.search(' '.join(args.sargs))
+
+        sys.exit(run_parallel(helper, hosts, args, unknown_args))
     else:
         LOGGER.critical('Unknown action: ' + args.action[0])
 
+    return conn
+
+
+def go_ranked(helper, conn, query, project=None):
+    # connect to a clear winner of ranked search, list best matches otherwise
+    conn.search_results = helper.rank(query, project_name=project)
+
+    if helper.clear_winner(conn.search_results):
+        conn.arg_type = 'ranked_winner'
+        conn.search_results = conn.search_results[:1]
+        conn.project = conn.search_results[0]['project_name']
+        conn.server_id = conn.search_results[0]['server_id']
+        conn.start()
+    else:
+        helper.print_hosts(conn.search_results, ambiguous=True)
+
+
+def run_parallel(helper, hosts, args, unknown_args):
+    import shlex
+    from parallel import Job, run_jobs, TIMEOUT_EXIT_CODE
+
+    command = ' '.join(args.command)
+    hosts = [host for host in hosts if 'server_ip' in host]
+    if not hosts:
+        LOGGER.critical('No hosts found')
+        return 1
+
+    names = ['{0} {1}'.format(host.get('server_name', ''), host['server_ip']) for host in hosts]
+    width = max(len(name) for name in names)
+
+    jobs = []
+    failed = []
+    for host, name in zip(hosts, names):
+        name = helper.colorize(name.ljust(width), 'blue')
+
+        # same ssh.py options as g <host>, every host gets its own session log
+        conn = ServerConnection(helper=helper, unknown_args=unknown_args)
+        conn.search_results = [host]
+        try:
+            conn.resolve()
+        except Exception as e:
+            helper.print_p('{0} {1}'.format(name, e), stderr=True)
+            failed.append(name)
+            continue
+
+        argv = shlex.split(conn.ssh_wrapper_cmd) + conn.wrapper_args()
+        argv += ['--command', command, '--timeout', str(args.timeout)]
+        jobs.append(Job(name, argv))
+
+    helper.print_p('x: {0} hosts, {1} at once, timeout {2}s: {3}'.format(
+        len(hosts), args.parallel, args.timeout, command), stderr=True)
+
+    for job in run_jobs(jobs, parallel=max(args.parallel, 1), timeout=args.timeout):
+        if job.exit_code == TIMEOUT_EXIT_CODE:
+            helper.print_p('{0} {1}'.format(job.name, helper.colorize('timeout', 'critical')), stderr=True)
+        elif job.exit_code != 0:
+            helper.print_p('{0} {1}'.format(job.name, helper.colorize('exit code {0}'.format(job.exit_code),
+                                                                      'critical')), stderr=True)
+        if job.exit_code != 0:
+            failed.append(job.name)
+
+    helper.print_p('x: {0} ok, {1} failed'.format(len(hosts) - len(failed), len(failed)), stderr=True)
+    return 1 if failed else 0
+
+
+def main():
+    args, unknown_args = init_args()
+    helper = AuthHelper(args, unknown_args)
+    helper.timings.add('import', helper.time_start - STARTED_AT)
+    try:
+        run(helper, args, unknown_args)
+    finally:
+        helper.write_metrics(args.action[0])
+
     done_delta = round(time() - helper.time_start, 3)
     LOGGER.debug('run time: ' + str(done_delta) + ' sec')
 
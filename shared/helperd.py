@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Resident helper: keeps AuthHelper inventory warm and serves
+# helper-client.py requests over a unix socket
+#
+# Protocol: client sends one json request and shuts down writing,
+# daemon answers with one json response and closes connection
+#
+# request:  {"argv": ["search", "prod"], "env": {"AUTH_SPF": "...", ...}}
+# response: {"stdout": "...", "stderr": "...", "code": 0, "session": ["AUTH_CALLBACK=...", ...]}
+#
+# Every connection is read and answered in its own thread, a client that stalls
+# does not hold others; requests are handled one at a time (stdout is swapped).
+# Connections over MAX_CONNECTIONS are closed, their clients run helper.py themselves.
+#
+import os
+import sys
+import json
+import socket
+import signal
+import logging
+import argparse
+import threading
+from time import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from helper import AuthHelper, LOGGER, LOG_FORMAT, init_args, run
+from metrics import Timings
+
+__version__ = '0.0.1'
+
+# Only user interface options are taken from clients,
+# redis, cache and data paths are daemon settings
+CLIENT_ENV = [
+    'USER',
+    'SUDO_USER',
+    'AUTH_SESSION',
+    'AUTH_WRAPPER',
+    'AUTH_SPF',
+    'AUTH_SPF_SEP',
+    'AUTH_BLINDE',
+    'AUTH_COLORS',
+    'AUTH_DEBUG',
+    'AUTH_RANKED',
+    'AUTH_RANK_LIMIT',
+    'AUTH_RANK_MARGIN',
+]
+
+REQUEST_MAX_SIZE = 1024 * 1024
+# whole request must come in this time, response must be taken in RESPONSE_TIMEOUT
+REQUEST_TIMEOUT = 1.0
+RESPONSE_TIMEOUT = 5.0
+MAX_CONNECTIONS = 64
+
+
+def default_socket_path():
+    return os.getenv('AUTH_HELPERD_SOCKET',
+                     os.path.join(os.getenv('AUTH_DATA_ROOT', '/opt/auth'), 'run', 'helperd.sock'))
+
+
+def recv_all(conn, max_size=None, timeout=None):
+    chunks = []
+    size = 0
+    deadline = time() + timeout if timeout is not None else None
+    while True:
+        if deadline is not None:
+            if time() >= deadline:
+                raise socket.timeout('request is not complete in {0} sec'.format(timeout))
+            conn.settimeout(deadline - time())
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise ValueError('request is too large')
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+class HelperDaemon(object):
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.sock = None
+        self.requests = 0
+        # handle() and reload() share the warm helper
+        self.lock = threading.Lock()
+        self.connections = threading.BoundedSemaphore(MAX_CONNECTIONS)
+        # warm inventory, per request helpers share its data and search index
+        self.helper = AuthHelper(None, None)
+        self.helper.build_search_index()
+
+    def refresh(self):
+        self.helper.refresh()
+        if self.helper.search_index is None:
+            self.helper.build_search_index()
+
+    def handle(self, request):
+        environ = dict(os.environ)
+        for key, value in request.get('env', {}).items():
+            if key in CLIENT_ENV:
+                environ[key] = value
+
+        stdout, stderr = StringIO(), StringIO()
+        log_handler = logging.StreamHandler(stderr)
+        log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        log_handler.setLevel(logging.WARN)
+
+        code = 0
+        session = None
+        helper = None
+        timings = Timings()
+
+        sys_stdout, sys_stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = stdout, stderr
+        LOGGER.addHandler(log_handler)
+        LOGGER.propagate = False
+        try:
+            with timings.phase('load'):
+                self.refresh()
+            args, unknown_args = init_args(request['argv'])
+            if args.action[0] == 'exec':
+                raise ValueError('exec is run by helper-client.py itself')
+            if args.probe:
+                raise ValueError('--probe is run by helper-client.py itself')
+            helper = AuthHelper(args, unknown_args, environ=environ, source=self.helper)
+            helper.session_write = False
+            helper.timings = timings
+            conn = run(helper, args, unknown_args)
+            if conn.session_file_path is not None and len(conn.session_exports) > 1:
+                session = conn.session_exports
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            LOGGER.exception(e)
+            code = 1
+        finally:
+            sys.stdout, sys.stderr = sys_stdout, sys_stderr
+            LOGGER.removeHandler(log_handler)
+            LOGGER.propagate = True
+
+        if helper is not None:
+            helper.write_metrics(args.action[0])
+
+        return dict(stdout=stdout.getvalue(), stderr=stderr.getvalue(), code=code, session=session)
+
+    def _bind(self):
+        socket_dir = os.path.dirname(self.socket_path)
+        if not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        # auth group members connect from their shells
+        os.chmod(self.socket_path, 0o660)
+        self.sock.listen(128)
+
+    def close(self, *args):
+        if self.sock is not None:
+            self.sock.close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+        sys.exit(0)
+
+    def reload(self, *args):
+        LOGGER.warning('reload requested')
+        with self.lock:
+            self.helper._load_data()
+            self.helper.build_search_index()
+
+    def serve_connection(self, conn):
+        time_start = time()
+        try:
+            request = json.loads(recv_all(conn, REQUEST_MAX_SIZE, REQUEST_TIMEOUT).decode('utf-8'))
+            with self.lock:
+                response = self.handle(request)
+                self.requests += 1
+            conn.settimeout(RESPONSE_TIMEOUT)
+            conn.sendall(json.dumps(response).encode('utf-8'))
+        except (socket.error, ValueError) as e:
+            LOGGER.warning('bad request: ' + str(e))
+        finally:
+            conn.close()
+            self.connections.release()
+        LOGGER.debug('request done in {0:.4f} sec'.format(time() - time_start))
+
+    def serve(self):
+        self._bind()
+        signal.signal(signal.SIGTERM, self.close)
+        signal.signal(signal.SIGINT, self.close)
+        signal.signal(signal.SIGHUP, self.reload)
+        LOGGER.warning('helperd {0} listen on {1}, hosts: {2}'.format(__version__, self.socket_path,
+                                                                     len(self.helper.hosts_dump)))
+
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                # interrupted by signal
+                continue
+
+            if not self.connections.acquire(False):
+                LOGGER.warning('too many connections, client runs helper.py itself')
+                conn.close()
+                continue
+
+            thread = threading.Thread(target=self.serve_connection, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='helperd', epilog='------',
+                                         description='Auth resident helper')
+    arg_parser.add_argument('--socket', type=str, default=default_socket_path())
+    arg_parser.add_argument('--debug', action='store_true')
+    args = arg_parser.parse_args()
+
+    if args.debug:
+        LOGGER.setLevel(logging.DEBUG)
+
+    HelperDaemon(args.socket).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Phase timings of helper.py and ssh.py runs as Prometheus histograms,
+# one textfile per program in AUTH_METRICS_DIR for node_exporter textfile collector:
+#
+#   auth_helper_phase_seconds{action="go",phase="load"}   helper.prom
+#   auth_ssh_phase_seconds{action="session",phase="first_output"}   ssh.prom
+#
+# Every run adds its timings to <name>.prom.state (json, bucket counters)
+# under flock of <name>.prom.lock and renders <name>.prom again,
+# both files are replaced atomically. Errors are only logged at debug level,
+# metrics never break s/g.
+#
+# Phases may be nested, a phase includes time of phases inside it
+# (load includes redis_connect if inventory is the first to use redis).
+#
+# json is imported on write: helper.py imports this module on start.
+#
+# Metrics are off unless AUTH_METRICS_DIR is set: every run of every user takes
+# the same lock. ansible auth role sets it in CONFIG with auth_metrics=true.
+#
+import os
+import re
+import fcntl
+import logging
+import functools
+import contextlib
+from time import time
+
+LOGGER = logging.getLogger('metrics')
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# textfile name, metric, help
+HELPER_METRICS = ('helper', 'auth_helper_phase_seconds', 'Phases of helper.py s/g/x runs in seconds')
+SSH_METRICS = ('ssh', 'auth_ssh_phase_seconds', 'Phases of ssh.py sessions in seconds')
+
+# AUTH_METRICS_DIR for programs started without auth environment (ssh.py under sudo)
+CONFIG = '/etc/sysconfig/auth-metrics'
+
+# label values come from command line
+ACTION = re.compile('^[a-z_]+$')
+
+
+class Timings(object):
+    """
+    Phase name -> seconds of one run, repeated phases are summed up
+    """
+
+    def __init__(self, started_at=None):
+        self.started_at = time() if started_at is None else started_at
+        self.phases = dict()
+        self._active = set()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # inner phase of the same name is a part of the outer one
+        if name in self._active:
+            yield
+            return
+        self._active.add(name)
+        phase_start = time()
+        try:
+            yield
+        finally:
+            self._active.discard(name)
+            self.add(name, time() - phase_start)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def total(self):
+        self.add('total', time() - self.started_at)
+
+
+def configured_dir(path=CONFIG):
+    """
+    AUTH_METRICS_DIR of sysconfig file, '' if there is none
+    """
+    try:
+        with open(path) as config_f:
+            for line in config_f:
+                key, _, value = line.strip().partition('=')
+                if key == 'AUTH_METRICS_DIR':
+                    return value.strip('\'"')
+    except (IOError, OSError):
+        pass
+    return ''
+
+
+def timed(phase):
+    """
+    Method decorator, calls are timed as phase of self.timings
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.timings.phase(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _labels(action, phase, le=None):
+    labels = 'action="{0}",phase="{1}"'.format(action, phase)
+    if le is not None:
+        labels += ',le="{0}"'.format(le)
+    return '{' + labels + '}'
+
+
+def render(metric, help_text, state):
+    lines = ['# HELP {0} {1}'.format(metric, help_text),
+             '# TYPE {0} histogram'.format(metric)]
+    for key in sorted(state):
+        action, phase = key.split(' ', 1)
+        counts, count, total = state[key]
+        for le, bucket_count in zip(BUCKETS, counts):
+            lines.append('{0}_bucket{1} {2}'.format(metric, _labels(action, phase, repr(le)), bucket_count))
+        lines.append('{0}_bucket{1} {2}'.format(metric, _labels(action, phase, '+Inf'), count))
+        lines.append('{0}_sum{1} {2!r}'.format(metric, _labels(action, phase), total))
+        lines.append('{0}_count{1} {2}'.format(metric, _labels(action, phase), count))
+    return '\n'.join(lines) + '\n'
+
+
+def _replace(path, data):
+    # readable for node_exporter, writable only through rename by auth group members
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        with os.fdopen(fd, 'w') as tmp_f:
+            tmp_f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write(directory, metrics, action, timings):
+    """
+    Add timings of one run to histograms of <directory>/<name>.prom, False on error
+    """
+    if not directory or not timings.phases:
+        return False
+    import json
+
+    name, metric, help_text = metrics
+    action = action if ACTION.match(action) else 'other'
+    path = os.path.join(directory, name + '.prom')
+    lock_fd = None
+    try:
+        # flock works on read only descriptors, lock file of another user is fine
+        # as long as it is readable: bootstrap.sh umask is 0077
+        lock_fd = os.open(path + '.lock', os.O_RDONLY | os.O_CREAT, 0o644)
+        if os.fstat(lock_fd).st_uid == os.getuid():
+            os.fchmod(lock_fd, 0o644)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+
+        try:
+            with open(path + '.state') as state_f:
+                state = json.load(state_f)
+        except (IOError, OSError, ValueError):
+            state = dict()
+
+        for phase, seconds in timings.phases.items():
+            counts, count, total = state.get('{0} {1}'.format(action, phase), [[0] * len(BUCKETS), 0, 0.0])
+            # buckets are cumulative: every bucket with le >= seconds
+            counts = [bucket_count + (seconds <= le) for le, bucket_count in zip(BUCKETS, counts)]
+            state['{0} {1}'.format(action, phase)] = [counts, count + 1, total + seconds]
+
+        _replace(path + '.state', json.dumps(state))
+        _replace(path, render(metric, help_text, state))
+    except (IOError, OSError, ValueError, TypeError) as e:
+        LOGGER.debug('metrics {0}: {1}'.format(path, e))
+        return False
+    finally:
+        if lock_fd is not None:
+            os.close(lock_fd)
+    return True
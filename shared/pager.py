@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+# Output of rendered s/g results: one write, or a pager
+# when it does not fit the terminal
+#
+import os
+import sys
+
+PAGER_CHUNK_SIZE = 64 * 1024
+
+
+def terminal_rows(stream):
+    try:
+        import fcntl
+        import struct
+        import termios
+        rows, _ = struct.unpack('hh', fcntl.ioctl(stream.fileno(), termios.TIOCGWINSZ, b'\0' * 4))
+    except (ImportError, IOError, OSError, ValueError, AttributeError):
+        rows = 0
+    return rows or int(os.getenv('LINES', 24))
+
+
+def write_output(text, stream=None):
+    if stream is None:
+        stream = sys.stdout
+
+    try:
+        is_tty = stream.isatty()
+    except (AttributeError, ValueError):
+        is_tty = False
+
+    pager_cmd = os.getenv('AUTH_PAGER', os.getenv('PAGER', 'less -R -F -X'))
+
+    if is_tty and pager_cmd and text.count('\n') >= terminal_rows(stream):
+        import subprocess
+        try:
+            pager = subprocess.Popen(pager_cmd, shell=True, stdin=subprocess.PIPE)
+        except OSError:
+            pager = None
+
+        if pager is not None:
+            data = text.encode('utf-8') if not isinstance(text, bytes) else text
+            try:
+                for offset in range(0, len(data), PAGER_CHUNK_SIZE):
+                    pager.stdin.write(data[offset:offset + PAGER_CHUNK_SIZE])
+                pager.stdin.close()
+            except IOError:
+                # pager closed before reading everything
+                pass
+            pager.wait()
+            return
+
+    try:
+        stream.write(text)
+        stream.flush()
+    except IOError:
+        pass
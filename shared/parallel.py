@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Parallel runs of ssh.py for x: bounded number of processes at once,
+# output is streamed line by line with a host prefix
+#
+# ssh.py terminates its own session after --timeout, here a job is
+# terminated only if it is still alive KILL_GRACE seconds later,
+# and killed with SIGKILL after another KILL_GRACE
+#
+import os
+import sys
+import errno
+import select
+import signal
+import subprocess
+from time import time
+
+KILL_GRACE = 10
+# ssh.py exit code of a session terminated after --timeout
+TIMEOUT_EXIT_CODE = 124
+READ_SIZE = 64 * 1024
+
+
+class Job(object):
+
+    def __init__(self, name, argv):
+        self.name = name
+        self.argv = argv
+        self.proc = None
+        self.buffer = b''
+        self.started_at = None
+        self.exit_code = None
+        self.killed = False
+        self.killed_at = None
+
+    def start(self):
+        devnull = open(os.devnull, 'rb')
+        try:
+            self.proc = subprocess.Popen(self.argv, stdin=devnull, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT)
+        finally:
+            devnull.close()
+        self.started_at = time()
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def feed(self, data):
+        """
+        Complete lines of output so far
+        """
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        return [line.rstrip(b'\r') for line in lines]
+
+    def finish(self):
+        lines = [self.buffer.rstrip(b'\r')] if self.buffer else []
+        self.buffer = b''
+        self.proc.stdout.close()
+        self.exit_code = self.proc.wait()
+        return lines
+
+    def kill(self):
+        # SIGTERM first, SIGKILL on the next call
+        sig = signal.SIGKILL if self.killed else signal.SIGTERM
+        self.killed = True
+        self.killed_at = time()
+        try:
+            self.proc.send_signal(sig)
+        except OSError:
+            pass
+
+
+def run_jobs(jobs, parallel=20, timeout=None, stream=None):
+    """
+    Run jobs, at most parallel at once. Returns jobs in order of completion.
+    """
+    if stream is None:
+        stream = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    def write(job, lines):
+        prefix = job.name.encode('utf-8') + b' '
+        for line in lines:
+            stream.write(prefix + line + b'\n')
+        stream.flush()
+
+    pending = list(jobs)
+    running = []
+    done = []
+
+    while pending or running:
+        while pending and len(running) < parallel:
+            job = pending.pop(0)
+            try:
+                job.start()
+            except OSError as e:
+                job.exit_code = 127
+                write(job, [str(e).encode('utf-8')])
+                done.append(job)
+                continue
+            running.append(job)
+
+        if not running:
+            continue
+
+        try:
+            ready, _, _ = select.select(running, [], [], 1.0)
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for job in ready:
+            data = os.read(job.fileno(), READ_SIZE)
+            if data:
+                write(job, job.feed(data))
+            else:
+                write(job, job.finish())
+                running.remove(job)
+                done.append(job)
+
+        if timeout:
+            now = time()
+            for job in running:
+                if not job.killed and now - job.started_at > timeout + KILL_GRACE:
+                    job.kill()
+                elif job.killed_at is not None and now - job.killed_at > KILL_GRACE:
+                    # SIGTERM is ignored
+                    job.kill()
+
+    return done
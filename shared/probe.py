@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ssh port reachability probe: TCP connect to every host at once,
+# connect time and up/down go to redis with a TTL, s shows them
+# as probe_status / probe_rtt fields of AUTH_SPF
+#
+# Non-blocking connects in one select loop, at most --concurrency
+# sockets open at once. s never probes, it reads what is in redis.
+#
+# Hosts behind proxy_id are not reachable from here and are skipped.
+#
+# Example:
+#   ./probe.py                          # whole inventory once
+#   ./probe.py starwars --timeout 1     # only this project
+#   ./probe.py --interval 60            # background, auth-probe.service
+import sys
+import errno
+import select
+import socket
+import logging
+import argparse
+from time import time, sleep
+
+from helper import AuthHelper, LOGGER
+
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+
+def probe(targets, concurrency=200, timeout=2.0):
+    """
+    targets: (key, host, port), returns key -> connect time in seconds, None if down
+    """
+    # select() is limited by FD_SETSIZE
+    concurrency = max(1, min(concurrency, 1000))
+    pending = list(reversed(targets))
+    connecting = dict()
+    results = dict()
+
+    while pending or connecting:
+        while pending and len(connecting) < concurrency:
+            key, host, port = pending.pop()
+            sock = None
+            try:
+                addr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+                sock = socket.socket(addr[0], socket.SOCK_STREAM)
+                sock.setblocking(0)
+                started_at = time()
+                error = sock.connect_ex(addr[4])
+            except socket.error as e:
+                LOGGER.debug('probe {0}:{1} {2}'.format(host, port, e))
+                results[key] = None
+                if sock is not None:
+                    sock.close()
+                continue
+
+            if error in CONNECT_IN_PROGRESS:
+                connecting[sock] = (key, started_at)
+            else:
+                results[key] = time() - started_at if error == 0 else None
+                sock.close()
+
+        if not connecting:
+            continue
+
+        wait = min(started for _, started in connecting.values()) + timeout - time()
+        try:
+            _, connected, _ = select.select([], list(connecting), [], max(wait, 0))
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        now = time()
+        for sock in connected:
+            key, started_at = connecting.pop(sock)
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            results[key] = now - started_at if error == 0 else None
+            sock.close()
+
+        for sock, (key, started_at) in list(connecting.items()):
+            if now - started_at >= timeout:
+                del connecting[sock]
+                results[key] = None
+                sock.close()
+
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='probe', epilog='------',
+                                         description='ssh port reachability probe')
+    arg_parser.add_argument('projects', type=str, nargs='*', help='only these projects')
+    arg_parser.add_argument('--interval', type=int, default=0, help='probe every N seconds, 0 - once')
+    arg_parser.add_argument('--concurrency', type=int, default=None)
+    arg_parser.add_argument('--timeout', type=float, default=None, help='connect timeout, seconds')
+    arg_parser.add_argument('--debug', action='store_true')
+    args = arg_parser.parse_args()
+
+    if args.debug:
+        LOGGER.setLevel(logging.DEBUG)
+
+    helper = AuthHelper(None, None)
+    while True:
+        time_start = time()
+        helper.refresh()
+        hosts = [host for host in helper.hosts_dump
+                 if not args.projects or host['project_name'] in args.projects]
+        results = helper.probe_hosts(hosts, concurrency=args.concurrency, timeout=args.timeout)
+
+        up = len([rtt for rtt in results.values() if rtt is not None])
+        LOGGER.warning('probe: {0} up, {1} down in {2:.2f} sec'.format(
+            up, len(results) - up, time() - time_start))
+
+        if not args.interval:
+            break
+        sleep(max(args.interval - (time() - time_start), 0))
+
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# bootstrap.sh _auth_lookup on completion files written by AuthHelper.write_completion:
+# look(1) binary search and grep fallback give the same lines as a plain prefix filter
+#
+import os
+import sys
+import subprocess
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'shared'))
+
+from helper import AuthHelper, Host
+
+BOOTSTRAP = os.path.join(ROOT, 'shared', 'bootstrap.sh')
+BASH = '/bin/bash'
+
+HOSTS = [
+    ('starwars', 'sel-msk-prod', 100001),
+    ('starwars', 'sel-spb-reserve', 100002),
+    ('starwars', 'sel-spb-dev', 100003),
+    ('StarTrek', 'Enterprise-1701', 100004),
+    ('tinyfinger', 'do-ams3.prod', 100005),
+    ('tinyfinger', 'do-nyc-dev', 100006),
+    ('drugstore', 'aws-eu-prod', 100010),
+]
+
+PREFIXES = [
+    '',
+    's',
+    'sel-spb',
+    'star',
+    'Star',         # upper case sorts before lower case in byte order
+    'STAR',         # no case folding: no match
+    'do-ams3.',     # regex special characters are literal
+    'do-ams3x',
+    '1000',
+    'zzz',          # after the last line
+    'aaa',          # before the first line
+]
+
+HOST_PREFIXES = [
+    'starwars ',
+    'starwars sel-spb',
+    'StarTrek E',
+    'starwars Sel',
+    'tinyfinger do-ams3.',
+    'nosuchproject ',
+]
+
+
+@pytest.fixture(scope='module')
+def completion(tmpdir_factory):
+    cache_dir = str(tmpdir_factory.mktemp('cache'))
+    helper = AuthHelper(None, None, environ=dict(os.environ, AUTH_CACHE_DIR=cache_dir))
+    helper.hosts_dump = [Host(dict(project_name=project, server_name=name, server_id=server_id))
+                         for project, name, server_id in HOSTS]
+    helper.projects = sorted(set(project for project, _, _ in HOSTS))
+    assert helper.write_completion('1')
+    return os.path.join(cache_dir, 'completion')
+
+
+@pytest.fixture(scope='module')
+def no_look_path(tmpdir_factory):
+    # PATH with tools of the grep fallback only
+    bin_dir = tmpdir_factory.mktemp('bin')
+    for tool in ['grep', 'head']:
+        for directory in os.environ['PATH'].split(os.pathsep):
+            if os.path.exists(os.path.join(directory, tool)):
+                os.symlink(os.path.join(directory, tool), str(bin_dir.join(tool)))
+                break
+    return str(bin_dir)
+
+
+def run(script, args, search_path=None):
+    # exit code is of grep: 1 if nothing is found
+    env = dict(os.environ, AUTH_DATA_ROOT=ROOT)
+    if search_path is not None:
+        env['PATH'] = search_path
+    proc = subprocess.Popen([BASH, '-c', 'source "$0"; ' + script, BOOTSTRAP] + args, env=env,
+                            stdout=subprocess.PIPE)
+    output, _ = proc.communicate()
+    return output.decode('utf-8').splitlines()
+
+
+def lookup(prefix, path, search_path=None):
+    return run('_auth_lookup "$1" "$2"', [prefix, path], search_path)
+
+
+def expected(prefix, path):
+    with open(path, 'rb') as completion_f:
+        lines = completion_f.read().decode('utf-8').splitlines()
+    assert lines == sorted(lines)
+    return [line for line in lines if line.startswith(prefix)]
+
+
+def has_look():
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(['sh', '-c', 'command -v look'], stdout=devnull) == 0
+
+
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_words_grep(completion, no_look_path, prefix):
+    path = completion + '_words'
+    assert lookup(prefix, path, no_look_path) == expected(prefix, path)
+
+
+@pytest.mark.parametrize('prefix', HOST_PREFIXES)
+def test_hosts_grep(completion, no_look_path, prefix):
+    path = completion + '_hosts'
+    assert lookup(prefix, path, no_look_path) == expected(prefix, path)
+
+
+@pytest.mark.skipif(not has_look(), reason='no look(1)')
+@pytest.mark.parametrize('prefix', PREFIXES)
+def test_words_look(completion, no_look_path, prefix):
+    path = completion + '_words'
+    assert lookup(prefix, path) == lookup(prefix, path, no_look_path) == expected(prefix, path)
+
+
+@pytest.mark.skipif(not has_look(), reason='no look(1)')
+@pytest.mark.parametrize('prefix', HOST_PREFIXES)
+def test_hosts_look(completion, no_look_path, prefix):
+    path = completion + '_hosts'
+    assert lookup(prefix, path) == lookup(prefix, path, no_look_path) == expected(prefix, path)
+
+
+def test_limit(completion, no_look_path):
+    path = completion + '_words'
+    for search_path in [no_look_path] + ([os.environ['PATH']] if has_look() else []):
+        assert run('AUTH_COMPLETION_LIMIT=2; _auth_lookup "$1" "$2"', ['s', path],
+                   search_path) == expected('s', path)[:2]
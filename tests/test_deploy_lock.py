@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# bootstrap.sh deploy_lock: waits for the auth-deploy lock with inotifywait,
+# polls without it, gives up after DEPLOY_LOCK_TIMEOUT
+#
+import os
+import stat
+import threading
+import subprocess
+from time import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+BOOTSTRAP = os.path.join(ROOT, 'shared', 'bootstrap.sh')
+BASH = '/bin/bash'
+
+
+def find_tool(tool):
+    for directory in os.environ['PATH'].split(os.pathsep):
+        if os.path.exists(os.path.join(directory, tool)):
+            return os.path.join(directory, tool)
+    return None
+
+
+def make_path(tmpdir, inotifywait=None):
+    # PATH with sleep and, if given, inotifywait only
+    bin_dir = tmpdir.mkdir('bin')
+    os.symlink(find_tool('sleep'), str(bin_dir.join('sleep')))
+    if inotifywait is not None:
+        script = bin_dir.join('inotifywait')
+        script.write(inotifywait)
+        script.chmod(stat.S_IRWXU)
+    return str(bin_dir)
+
+
+def deploy_lock(data_root, search_path, timeout=3, remove_after=None):
+    """
+    (seconds deploy_lock took, its output), lock is removed after remove_after seconds
+    """
+    lock_path = os.path.join(data_root, '.deploy')
+    if remove_after is not None:
+        timer = threading.Timer(remove_after, os.unlink, [lock_path])
+        timer.start()
+    env = dict(os.environ, AUTH_DATA_ROOT=data_root, DEPLOY_LOCK_TIMEOUT=str(timeout), PATH=search_path)
+    time_start = time()
+    output = subprocess.check_output([BASH, '-c', 'source "$0"; deploy_lock', BOOTSTRAP], env=env)
+    return time() - time_start, output.decode('utf-8')
+
+
+@pytest.fixture
+def lock(tmpdir):
+    tmpdir.join('.deploy').write('')
+    return str(tmpdir)
+
+
+def has_inotifywait():
+    return find_tool('inotifywait') is not None
+
+
+def test_no_lock(tmpdir):
+    took, output = deploy_lock(str(tmpdir), make_path(tmpdir))
+    assert output == ''
+    assert took < 1
+
+
+def test_poll_released(lock, tmpdir):
+    took, output = deploy_lock(lock, make_path(tmpdir), remove_after=1.2)
+    assert output.startswith('Lock found')
+    assert 'still there' not in output
+    assert 1.2 <= took < 3
+
+
+def test_poll_timeout(lock, tmpdir):
+    took, output = deploy_lock(lock, make_path(tmpdir), timeout=2)
+    assert 'still there after 2s' in output
+    assert 1 <= took < 4
+    assert os.path.exists(os.path.join(lock, '.deploy'))
+
+
+def test_inotifywait_fails(lock, tmpdir):
+    # exit code 1: no inotify support, polling goes on
+    took, output = deploy_lock(lock, make_path(tmpdir, '#!/bin/sh\nexit 1\n'), remove_after=1.2)
+    assert 'still there' not in output
+    assert 1.2 <= took < 3
+
+
+@pytest.mark.skipif(not has_inotifywait(), reason='no inotifywait')
+def test_inotifywait_released(lock, tmpdir):
+    search_path = make_path(tmpdir) + os.pathsep + os.path.dirname(find_tool('inotifywait'))
+    took, output = deploy_lock(lock, search_path, remove_after=0.3)
+    assert 'still there' not in output
+    # no polling delay: returns right after the lock is removed
+    assert 0.3 <= took < 0.9
+
+
+@pytest.mark.skipif(not has_inotifywait(), reason='no inotifywait')
+def test_inotifywait_timeout(lock, tmpdir):
+    search_path = make_path(tmpdir) + os.pathsep + os.path.dirname(find_tool('inotifywait'))
+    took, output = deploy_lock(lock, search_path, timeout=2)
+    assert 'still there after 2s' in output
+    assert 1 <= took < 4
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Session catalog: one sqlite row per ssh.py session, for audit queries
+# without reading every *.log.meta
+#
+# ssh.py adds a row on session start and sets end time, output bytes
+# and exit code when it ends. backfill adds sessions from existing .meta files.
+#
+# Example:
+#   ./catalog.py backfill
+#   ./catalog.py query --host 10.0.3.7 --since '2017-01-17' --until '2017-01-18'
+#   ./catalog.py query --user alice --last 20
+#   ./catalog.py query --host 10.0.3.7 --paths | xargs -n1 ./sessionlog.py cat
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+
+DEFAULT_PATH = '/opt/auth/logs/catalog.db'
+DEFAULT_LOGS = '/opt/auth/logs'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS sessions (
+        uuid TEXT PRIMARY KEY,
+        auth_user TEXT,
+        hostname TEXT,
+        port INTEGER,
+        user TEXT,
+        proxy_id TEXT,
+        proxy_host TEXT,
+        started_at REAL,
+        ended_at REAL,
+        bytes INTEGER,
+        exit_code INTEGER,
+        log_path TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS sessions_started_at ON sessions (started_at)',
+    'CREATE INDEX IF NOT EXISTS sessions_hostname ON sessions (hostname, started_at)',
+    'CREATE INDEX IF NOT EXISTS sessions_auth_user ON sessions (auth_user, started_at)',
+]
+
+COLUMNS = ['uuid', 'auth_user', 'hostname', 'port', 'user', 'proxy_id', 'proxy_host',
+           'started_at', 'ended_at', 'bytes', 'exit_code', 'log_path']
+
+
+def meta_to_row(meta):
+    """
+    sessions row of ssh.py log meta
+    """
+    proxy_id = meta.get('proxy_id')
+    # argparse nargs=1 list in ssh.py meta
+    if isinstance(proxy_id, list):
+        proxy_id = proxy_id[0] if proxy_id else None
+
+    return dict(uuid=meta['uuid'],
+                auth_user=meta.get('auth_user'),
+                hostname=meta.get('hostname'),
+                port=meta.get('port'),
+                user=meta.get('user'),
+                proxy_id=proxy_id,
+                proxy_host=meta.get('proxy_host'),
+                started_at=meta.get('auth_ts'),
+                ended_at=meta.get('ended_at'),
+                bytes=meta.get('log_bytes'),
+                exit_code=meta.get('exit_code'),
+                log_path=meta.get('log_path'))
+
+
+class Catalog(object):
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, timeout=10)
+            # concurrent sessions write, readers do not block them
+            self._db.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                self._db.execute(statement)
+            self._db.commit()
+        return self._db
+
+    def add(self, rows, replace=False):
+        query = 'INSERT OR {0} INTO sessions ({1}) VALUES ({2})'.format(
+            'REPLACE' if replace else 'IGNORE', ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+        with self.db:
+            cursor = self.db.executemany(query, ([row.get(column) for column in COLUMNS] for row in rows))
+        return cursor.rowcount
+
+    def session_started(self, meta):
+        self.add([meta_to_row(meta)], replace=True)
+
+    def session_ended(self, meta):
+        with self.db:
+            self.db.execute('UPDATE sessions SET ended_at = ?, bytes = ?, exit_code = ? WHERE uuid = ?',
+                            (meta.get('ended_at'), meta.get('log_bytes'), meta.get('exit_code'), meta['uuid']))
+
+    def query(self, since=None, until=None, last=None, **filters):
+        where = []
+        params = []
+        for column, value in sorted(filters.items()):
+            if value is None:
+                continue
+            if column not in COLUMNS:
+                raise ValueError('unknown column: {0}'.format(column))
+            where.append('{0} = ?'.format(column))
+            params.append(value)
+        if since is not None:
+            where.append('started_at >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('started_at < ?')
+            params.append(until)
+
+        query = 'SELECT {0} FROM sessions'.format(', '.join(COLUMNS))
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        if last is not None:
+            query = 'SELECT * FROM ({0} ORDER BY started_at DESC LIMIT {1:d})'.format(query, last)
+        query += ' ORDER BY started_at'
+
+        for values in self.db.execute(query, params):
+            yield dict(zip(COLUMNS, values))
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def iter_meta(logs_path):
+    for dir_path, _, file_names in os.walk(logs_path):
+        for file_name in file_names:
+            if not file_name.endswith('.log.meta'):
+                continue
+            meta_path = os.path.join(dir_path, file_name)
+            try:
+                with open(meta_path) as meta_f:
+                    meta = json.load(meta_f)
+                yield meta_to_row(meta)
+            except (IOError, ValueError, KeyError) as e:
+                sys.stderr.write('{0}: {1}\n'.format(meta_path, e))
+
+
+def backfill(catalog, logs_path, batch=1000):
+    added = 0
+    rows = []
+    for row in iter_meta(logs_path):
+        rows.append(row)
+        if len(rows) >= batch:
+            added += catalog.add(rows)
+            rows = []
+    if rows:
+        added += catalog.add(rows)
+    return added
+
+
+def parse_time(value):
+    """
+    unix timestamp or local 'YYYY-MM-DD[ HH:MM[:SS]]'
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for time_format in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+        try:
+            return time.mktime(time.strptime(value, time_format))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError('bad time: {0}'.format(value))
+
+
+def format_row(row):
+    started_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['started_at'] or 0))
+    if row['ended_at'] is not None and row['started_at'] is not None:
+        duration = '{0:.0f}s'.format(row['ended_at'] - row['started_at'])
+    else:
+        duration = '-'
+    target = '{0}:{1}'.format(row['hostname'], row['port'] or 22)
+    if row['user']:
+        target = row['user'] + '@' + target
+    return '{0}  {1:>8}  {2:<16} {3:<40} {4:<12} {5:>4} {6:>12}  {7}'.format(
+        started_at, duration, row['auth_user'] or '-', target, row['proxy_id'] or '-',
+        '-' if row['exit_code'] is None else row['exit_code'],
+        '-' if row['bytes'] is None else row['bytes'], row['uuid'])
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='catalog', epilog='------',
+                                         description='ssh.py session catalog')
+    arg_parser.add_argument('action', type=str, choices=['query', 'backfill'])
+    arg_parser.add_argument('--db', type=str, default=DEFAULT_PATH)
+    arg_parser.add_argument('--logs', type=str, default=DEFAULT_LOGS, help='backfill: logs root')
+    arg_parser.add_argument('--user', type=str, help='auth user')
+    arg_parser.add_argument('--host', type=str)
+    arg_parser.add_argument('--port', type=int)
+    arg_parser.add_argument('--login', type=str, help='target server user')
+    arg_parser.add_argument('--proxy-id', type=str)
+    arg_parser.add_argument('--uuid', type=str)
+    arg_parser.add_argument('--exit-code', type=int)
+    arg_parser.add_argument('--since', type=parse_time)
+    arg_parser.add_argument('--until', type=parse_time)
+    arg_parser.add_argument('--last', type=int, help='only last N sessions')
+    arg_parser.add_argument('--json', action='store_true', help='one json per line')
+    arg_parser.add_argument('--paths', action='store_true', help='only log paths')
+    args = arg_parser.parse_args()
+
+    catalog = Catalog(args.db)
+
+    if args.action == 'backfill':
+        added = backfill(catalog, args.logs)
+        sys.stdout.write('{0} sessions added\n'.format(added))
+
+    elif args.action == 'query':
+        rows = catalog.query(since=args.since, until=args.until, last=args.last,
+                             auth_user=args.user, hostname=args.host, port=args.port, user=args.login,
+                             proxy_id=args.proxy_id, uuid=args.uuid, exit_code=args.exit_code)
+        try:
+            for row in rows:
+                if args.paths:
+                    line = row['log_path']
+                elif args.json:
+                    line = json.dumps(row, sort_keys=True)
+                else:
+                    line = format_row(row)
+                sys.stdout.write(line + '\n')
+        except IOError:
+            # closed pipe
+            pass
+
+    catalog.close()
+
+
+if __name__ == '__main__':
+    main()
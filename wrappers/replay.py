@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Session log replay: jump to a moment of session or to a string in its output,
+# play it back in real time, faster or slower
+#
+# Segments are opened on demand, the ones that end before --from are skipped
+# by their start time in .meta. Uncompressed segments are memory mapped and indexed
+# by record headers (timestamp -> record offset, every INDEX_SECONDS or INDEX_BYTES),
+# the index is saved as <segment>.idx when the directory is writable.
+# Compressed segments are read from the last restart point before --from listed
+# in <segment>.idx by sessionlog.py, segments without it from their start.
+# timecode.awk logs are read from the start.
+#
+# Time is an offset from session start: SS, MM:SS or HH:MM:SS
+#
+# Example:
+#   ./replay.py /opt/auth/logs/user/<session>.log --from 45:00 --speed 4
+#   ./replay.py /opt/auth/logs/user/<session>.log --search 'rm -rf' --matches
+#   ./replay.py /opt/auth/logs/user/<session>.log --search 'rm -rf' --max-idle 1
+import os
+import sys
+import mmap
+import errno
+import bisect
+import argparse
+from time import sleep
+
+from sessionlog import (MAGIC, RECORD_HEADER, open_segment, read_segment, read_stream_records,
+                        segment_compression, session_log_segments, read_index, write_index)
+
+INDEX_SECONDS = 10
+INDEX_BYTES = 1024 * 1024
+
+
+def parse_offset(value):
+    seconds = 0.0
+    try:
+        for part in value.split(':'):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        raise argparse.ArgumentTypeError('bad time: {0}, SS, MM:SS or HH:MM:SS'.format(value))
+    return seconds
+
+
+def format_offset(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0:02d}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+class Segment(object):
+
+    def __init__(self, path, started_at=None):
+        self.path = path
+        # from .meta, first record is not older
+        self.started_at = None if started_at is None else int(started_at * 1000000)
+        self.compression = None
+        self.log_f = None
+        self.mm = None
+        self.index = None
+        self._first_timestamp = False
+
+    def _open(self):
+        if self.compression is not None:
+            return
+        self.log_f = open(self.path, 'rb')
+        self.source_size = os.fstat(self.log_f.fileno()).st_size
+        self.compression = segment_compression(self.log_f)
+
+        if self.compression == 'none':
+            if self.log_f.read(len(MAGIC)) != MAGIC:
+                self.compression = 'awk'
+                self.index = []
+                return
+            self.mm = mmap.mmap(self.log_f.fileno(), self.source_size, access=mmap.ACCESS_READ)
+            self._load_index()
+        else:
+            # restart points of an open segment are valid for the part written before
+            index = read_index(self.path)
+            self.index = index[1] if index is not None and index[0] <= self.source_size else []
+        self.index_timestamps = [entry[0] for entry in self.index]
+        self.index_offsets = [entry[1] for entry in self.index]
+
+    def _load_index(self):
+        # open session segment grows, index of uncompressed one is valid only for the same size
+        index = read_index(self.path)
+        if index is not None and index[0] == self.source_size:
+            self.index = index[1]
+            # end of the last whole record is after the last entry
+            self.end = self._scan(self.index[-1][1] if self.index else len(MAGIC))
+            return
+        self._build_index()
+        write_index(self.path, self.source_size, self.index)
+
+    def _scan(self, offset):
+        size = len(self.mm)
+        while offset + RECORD_HEADER.size <= size:
+            _, length = RECORD_HEADER.unpack_from(self.mm, offset)
+            if offset + RECORD_HEADER.size + length > size:
+                break
+            offset += RECORD_HEADER.size + length
+        return offset
+
+    def _build_index(self):
+        index = []
+        offset = len(MAGIC)
+        size = len(self.mm)
+        last_offset = offset
+        last_timestamp = previous_timestamp = None
+        while offset + RECORD_HEADER.size <= size:
+            timestamp, length = RECORD_HEADER.unpack_from(self.mm, offset)
+            if offset + RECORD_HEADER.size + length > size:
+                # truncated last record
+                break
+            if last_timestamp is None:
+                last_timestamp = timestamp
+            elif timestamp - last_timestamp >= INDEX_SECONDS * 1000000 or offset - last_offset >= INDEX_BYTES:
+                index.append((previous_timestamp, offset, offset))
+                last_timestamp, last_offset = timestamp, offset
+            previous_timestamp = timestamp
+            offset += RECORD_HEADER.size + length
+        self.index = index
+        self.end = offset
+
+    def _entry(self, timestamp):
+        """
+        Index entry to read timestamp from: last one after a record older than timestamp
+        """
+        if timestamp is None or not self.index:
+            return None
+        position = bisect.bisect_left(self.index_timestamps, timestamp) - 1
+        return self.index[position] if position >= 0 else None
+
+    def _data_offset(self, timestamp):
+        entry = self._entry(timestamp)
+        return entry[1] if entry is not None else len(MAGIC)
+
+    @property
+    def first_timestamp(self):
+        if self._first_timestamp is False:
+            self._first_timestamp = next((timestamp for timestamp, _ in self.records()), None)
+        return self._first_timestamp
+
+    def _mm_records(self, offset=None):
+        """
+        (timestamp, offset, data) of uncompressed segment from offset
+        """
+        offset = len(MAGIC) if offset is None else offset
+        while offset < self.end:
+            timestamp, length = RECORD_HEADER.unpack_from(self.mm, offset)
+            start = offset + RECORD_HEADER.size
+            yield timestamp, offset, self.mm[start:start + length]
+            offset = start + length
+
+    def _stream_records(self, timestamp):
+        entry = self._entry(timestamp)
+        with open(self.path, 'rb') as log_f:
+            stream = open_segment(log_f, entry[2] if entry is not None else 0)
+            if entry is None and stream.read(len(MAGIC)) != MAGIC:
+                return
+            for record in read_stream_records(stream):
+                yield record
+
+    def records(self, timestamp=None):
+        """
+        (timestamp, data) from the first record at or after timestamp, microseconds
+        """
+        self._open()
+        if self.compression == 'none':
+            records = ((record_timestamp, data) for record_timestamp, _, data in
+                       self._mm_records(self._data_offset(timestamp)))
+        elif self.compression == 'awk':
+            records = ((int(record_timestamp * 1000000), data) for record_timestamp, data in read_segment(self.path))
+        else:
+            records = self._stream_records(timestamp)
+
+        for record_timestamp, data in records:
+            if timestamp is not None and record_timestamp < timestamp:
+                continue
+            timestamp = None
+            yield record_timestamp, data
+
+    def _record_at(self, data_offset, size=1):
+        """
+        (timestamp, offset) of record with data_offset:data_offset + size in its data,
+        None if it overlaps a record header
+        """
+        position = bisect.bisect_right(self.index_offsets, data_offset) - 1
+        for timestamp, offset, data in self._mm_records(self.index[position][1] if position >= 0 else None):
+            start = offset + RECORD_HEADER.size
+            if data_offset < start:
+                return None
+            if data_offset < start + len(data):
+                return (timestamp, offset) if data_offset + size <= start + len(data) else None
+        return None
+
+    def find(self, needle, timestamp=None):
+        """
+        Timestamps of records with needle, needle split between records is not found
+        """
+        self._open()
+        if self.compression != 'none':
+            for record_timestamp, data in self.records(timestamp):
+                if needle in data:
+                    yield record_timestamp
+            return
+
+        position = len(MAGIC)
+        if timestamp is not None:
+            position = next((offset for record_timestamp, offset, _ in self._mm_records(self._data_offset(timestamp))
+                             if record_timestamp >= timestamp), self.end)
+        while True:
+            position = self.mm.find(needle, position, self.end)
+            if position < 0:
+                return
+            record = self._record_at(position, len(needle))
+            if record is None:
+                position += 1
+                continue
+            yield record[0]
+            # one match per record
+            _, length = RECORD_HEADER.unpack_from(self.mm, record[1])
+            position = record[1] + RECORD_HEADER.size + length
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        if self.log_f is not None:
+            self.log_f.close()
+
+
+class Session(object):
+
+    def __init__(self, path):
+        self.segments = [Segment(segment['path'], segment.get('started_at'))
+                         for segment in session_log_segments(path) if os.path.exists(segment['path'])]
+        self._started_at = False
+
+    @property
+    def started_at(self):
+        if self._started_at is False:
+            self._started_at = next((segment.first_timestamp for segment in self.segments
+                                     if segment.first_timestamp is not None), None)
+        return self._started_at
+
+    def _segments(self, timestamp=None):
+        """
+        Segments to read timestamp from: records of a segment are older than the next one start
+        """
+        first = 0
+        if timestamp is not None:
+            for number in range(len(self.segments) - 1, 0, -1):
+                started_at = self.segments[number].started_at
+                if started_at is not None and started_at <= timestamp:
+                    first = number
+                    break
+        return self.segments[first:]
+
+    def records(self, timestamp=None):
+        """
+        (timestamp, data) from timestamp, microseconds
+        """
+        for segment in self._segments(timestamp):
+            for record in segment.records(timestamp):
+                yield record
+
+    def find(self, needle, timestamp=None):
+        for segment in self._segments(timestamp):
+            for match in segment.find(needle, timestamp):
+                yield match
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+def play(records, stream, speed=1.0, max_idle=None, until=None):
+    last_timestamp = None
+    for timestamp, data in records:
+        if until is not None and timestamp > until:
+            break
+        if speed and last_timestamp is not None:
+            delay = (timestamp - last_timestamp) / 1000000.0
+            if max_idle is not None:
+                delay = min(delay, max_idle)
+            if delay > 0:
+                sleep(delay / speed)
+        stream.write(data)
+        stream.flush()
+        last_timestamp = timestamp
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='replay', epilog='------',
+                                         description='ssh.py session log replay')
+    arg_parser.add_argument('path', type=str, help='session log or its .meta')
+    arg_parser.add_argument('--from', dest='start', type=parse_offset, help='start at, offset from session start')
+    arg_parser.add_argument('--to', dest='stop', type=parse_offset, help='stop at, offset from session start')
+    arg_parser.add_argument('--speed', type=float, default=1.0, help='0 - no delays')
+    arg_parser.add_argument('--max-idle', type=float, default=None, help='longest pause, seconds')
+    arg_parser.add_argument('--search', type=str, help='start at first output with this string')
+    arg_parser.add_argument('--matches', action='store_true', help='list --search matches instead of playing')
+    args = arg_parser.parse_args()
+
+    session = Session(args.path)
+    if session.started_at is None:
+        sys.stderr.write('{0}: empty session log\n'.format(args.path))
+        sys.exit(1)
+
+    def to_timestamp(offset):
+        return None if offset is None else session.started_at + int(offset * 1000000)
+
+    start, stop = to_timestamp(args.start), to_timestamp(args.stop)
+    stream = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    try:
+        if args.search is not None:
+            needle = args.search.encode('utf-8')
+            matches = session.find(needle, start)
+            if args.matches:
+                for timestamp in matches:
+                    sys.stdout.write(format_offset((timestamp - session.started_at) / 1000000.0) + '\n')
+                return
+            start = next(matches, None)
+            if start is None:
+                sys.stderr.write('{0}: not found\n'.format(args.search))
+                sys.exit(1)
+
+        if start is not None:
+            sys.stderr.write('replay from {0}\r\n'.format(format_offset((start - session.started_at) / 1000000.0)))
+        play(session.records(start), stream, args.speed, args.max_idle, stop)
+    except KeyboardInterrupt:
+        pass
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Session recorder for ssh.py: runs command in a pty, copies its output
+# to the terminal and to a session log
+#
+# Log format: MAGIC, then records of
+#   8 bytes  unsigned, big endian: timestamp, microseconds since epoch
+#   4 bytes  unsigned, big endian: data length
+#   data     raw terminal output
+#
+# Records are buffered and written at least every FLUSH_INTERVAL seconds,
+# so a crash loses no more than that. Truncated last record is ignored by readers.
+#
+# Log can be compressed as one gzip member or zstd frame, every write ends
+# with a sync/block flush so open sessions can be read too. With segment_size
+# session is split to <log>, <log>.1, <log>.2 ... (+ .gz/.zst) files,
+# each one is a complete log with its own MAGIC and compression stream.
+# Segments are listed in ssh.py <log>.meta.
+#
+# Compressed segments have restart points every RESTART_BYTES of log data or
+# RESTART_SECONDS: gzip full flush or new zstd frame, decompression can start there.
+# They are listed in <segment>.idx as [timestamp of the record before, data offset,
+# file offset], replay.py seeks with it without unpacking the segment.
+#
+# zstd needs python zstandard module.
+#
+# Example:
+#   ./sessionlog.py cat /opt/auth/logs/user/user_127.0.0.1_None_1485110002_<uuid>.log
+#   ./sessionlog.py convert old.log new.log  # timecode.awk log to this format
+#   ./sessionlog.py convert --compression zstd old.log new.log
+import os
+import re
+import sys
+import tty
+import pty
+import zlib
+import json
+import errno
+import fcntl
+import signal
+import select
+import struct
+import termios
+import argparse
+from time import time
+
+MAGIC = b'AUTHLOG\x01'
+FORMAT = 'sessionlog-1'
+RECORD_HEADER = struct.Struct('!QI')
+
+FLUSH_INTERVAL = 1.0
+BUFFER_SIZE = 64 * 1024
+READ_SIZE = 16 * 1024
+
+RESTART_BYTES = 4 * 1024 * 1024
+RESTART_SECONDS = 60
+INDEX_VERSION = 2
+
+# same as coreutils timeout
+TIMEOUT_EXIT_CODE = 124
+# SIGKILL to a command still alive this long after timeout SIGTERM
+KILL_GRACE = 5
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# timecode.awk: "<unix ts>.<counter from 100000001>" line before every output line
+AWK_TIMECODE = re.compile(br'^(\d+)\.(\d+)$')
+AWK_COUNTER_BASE = 100000001
+
+
+def write_all(fd, data):
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+class PlainCompressor(object):
+    suffix = ''
+    # plain log is seekable as is, replay.py indexes it by record headers
+    restarts = False
+
+    def __init__(self, level=None):
+        pass
+
+    def compress(self, data, restart=False):
+        return data
+
+    def close(self):
+        return b''
+
+
+class GzipCompressor(object):
+    suffix = '.gz'
+    restarts = True
+
+    # level 6 is 3 times slower for ~10% better ratio, see benchmarks/sessionlog.py
+    def __init__(self, level=None):
+        self.obj = zlib.compressobj(1 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data, restart=False):
+        # full flush also resets the dictionary: raw inflate can start right after it
+        return self.obj.compress(data) + self.obj.flush(zlib.Z_FULL_FLUSH if restart else zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        return self.obj.flush()
+
+
+class ZstdCompressor(object):
+    suffix = '.zst'
+    restarts = True
+
+    def __init__(self, level=None):
+        import zstandard
+        self.flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        self.flush_frame = zstandard.COMPRESSOBJ_FLUSH_FINISH
+        self.cctx = zstandard.ZstdCompressor(level=3 if level is None else level)
+        self.obj = self.cctx.compressobj()
+
+    def compress(self, data, restart=False):
+        if not restart:
+            return self.obj.compress(data) + self.obj.flush(self.flush_block)
+        # frame ends here, next one is decompressed on its own
+        data = self.obj.compress(data) + self.obj.flush(self.flush_frame)
+        self.obj = self.cctx.compressobj()
+        return data
+
+    def close(self):
+        return self.obj.flush()
+
+
+COMPRESSORS = {
+    'none': PlainCompressor,
+    'gzip': GzipCompressor,
+    'zstd': ZstdCompressor,
+}
+
+
+class SessionWriter(object):
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, buffer_size=BUFFER_SIZE,
+                 compression='none', level=None, segment_size=None, on_segment=None,
+                 restart_bytes=RESTART_BYTES, restart_seconds=RESTART_SECONDS):
+        if compression not in COMPRESSORS:
+            raise ValueError('unknown compression: {0}'.format(compression))
+
+        self.path = path
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.compression = compression
+        self.level = level
+        self.segment_size = segment_size
+        self.on_segment = on_segment
+        self.restart_bytes = restart_bytes
+        self.restart_seconds = restart_seconds
+        self.buffer = []
+        self.buffered = 0
+        self.bytes = 0
+        self.flushed_at = time()
+        # time to first output of a session, ssh.py metrics
+        self.first_write_at = None
+
+        self.fd = None
+        self.compressor = None
+        self.segments = []
+        self._open_segment()
+
+    def _segment_path(self, number):
+        suffix = '.{0}'.format(number) if number else ''
+        return self.path + suffix + COMPRESSORS[self.compression].suffix
+
+    def _open_segment(self):
+        # ImportError here for zstd without zstandard module
+        compressor = COMPRESSORS[self.compression](self.level)
+        path = self._segment_path(len(self.segments))
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        self.compressor = compressor
+        self.segment = dict(path=path, started_at=time(), ended_at=None, size=0)
+        self.segments.append(self.segment)
+        # restart points of this segment, see write_index
+        self.data_size = 0
+        self.last_timestamp = 0
+        self.restart_at = (0, self.segment['started_at'])
+        self.restart_points = []
+
+        self.buffer.insert(0, MAGIC)
+        self.buffered += len(MAGIC)
+
+        if self.on_segment is not None:
+            self.on_segment(self.segments)
+
+    def _close_segment(self):
+        self._write_buffer()
+        data = self.compressor.close()
+        write_all(self.fd, data)
+        self.segment['size'] += len(data)
+        self.segment['ended_at'] = time()
+        os.close(self.fd)
+        self.fd = None
+        if self.compressor.restarts:
+            write_index(self.segment['path'], self.segment['size'], self.restart_points)
+
+    def _write_buffer(self):
+        if self.buffered:
+            # buffer holds whole records, restart point is at a record boundary
+            self.data_size += self.buffered
+            restart = self.compressor.restarts and (
+                self.data_size - self.restart_at[0] >= self.restart_bytes or
+                time() - self.restart_at[1] >= self.restart_seconds)
+            data = self.compressor.compress(b''.join(self.buffer), restart)
+            write_all(self.fd, data)
+            self.segment['size'] += len(data)
+            self.buffer = []
+            self.buffered = 0
+
+            if restart:
+                self.restart_at = (self.data_size, time())
+                self.restart_points.append([self.last_timestamp, self.data_size, self.segment['size']])
+                write_index(self.segment['path'], self.segment['size'], self.restart_points)
+
+    def write(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time()
+        if self.first_write_at is None:
+            self.first_write_at = timestamp
+        self.last_timestamp = int(timestamp * 1000000)
+        self.buffer.append(RECORD_HEADER.pack(self.last_timestamp, len(data)))
+        self.buffer.append(data)
+        self.buffered += RECORD_HEADER.size + len(data)
+        self.bytes += len(data)
+
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush_due(self):
+        if self.buffered and time() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._write_buffer()
+        self.flushed_at = time()
+
+        if self.segment_size and self.segment['size'] >= self.segment_size:
+            self._close_segment()
+            self._open_segment()
+
+    def close(self):
+        if self.fd is not None:
+            self._close_segment()
+            if self.on_segment is not None:
+                self.on_segment(self.segments)
+
+
+def index_path(segment_path):
+    return segment_path + '.idx'
+
+
+def write_index(segment_path, source_size, entries):
+    """
+    <segment>.idx: entries [timestamp of the record before, data offset, file offset],
+    valid for the first source_size bytes of segment. False on error, index is optional
+    """
+    path = index_path(segment_path)
+    try:
+        with open(path + '.tmp', 'w') as index_f:
+            json.dump(dict(version=INDEX_VERSION, source_size=source_size, entries=entries), index_f)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def read_index(segment_path):
+    """
+    (source_size, entries) of <segment>.idx, None if there is none or it is of other version
+    """
+    try:
+        with open(index_path(segment_path)) as index_f:
+            index = json.load(index_f)
+        if index['version'] == INDEX_VERSION:
+            return index['source_size'], [tuple(entry) for entry in index['entries']]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+class ZstdFrames(object):
+    """
+    decompress() of zstd stream of several frames
+    """
+
+    def __init__(self):
+        import zstandard
+        self.dctx = zstandard.ZstdDecompressor()
+        self.obj = self.dctx.decompressobj()
+
+    def decompress(self, data):
+        chunks = []
+        while data:
+            chunks.append(self.obj.decompress(data))
+            if not self.obj.eof:
+                break
+            data = self.obj.unused_data
+            self.obj = self.dctx.decompressobj()
+        return b''.join(chunks)
+
+
+class DecompressReader(object):
+
+    def __init__(self, log_f, decompress):
+        self.log_f = log_f
+        self.decompress = decompress
+        self.buffer = b''
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            chunk = self.log_f.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            self.buffer += self.decompress(chunk)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def segment_compression(log_f):
+    head = log_f.read(len(ZSTD_MAGIC))
+    log_f.seek(0)
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head == ZSTD_MAGIC:
+        return 'zstd'
+    return 'none'
+
+
+def open_segment(log_f, offset=0):
+    """
+    File object of log data, without compression, from the start or a restart point
+    """
+    compression = segment_compression(log_f)
+    log_f.seek(offset)
+    if compression == 'gzip':
+        # gzip header is only at the start, restart points are raw deflate
+        return DecompressReader(log_f, zlib.decompressobj(16 + zlib.MAX_WBITS if not offset else
+                                                          -zlib.MAX_WBITS).decompress)
+    if compression == 'zstd':
+        return DecompressReader(log_f, ZstdFrames().decompress)
+    return log_f
+
+
+def read_awk_records(log_f):
+    timestamp = 0.0
+    expect_timecode = True
+    for line in log_f:
+        match = AWK_TIMECODE.match(line.rstrip(b'\n')) if expect_timecode else None
+        if match is not None:
+            counter = min(max(int(match.group(2)) - AWK_COUNTER_BASE, 0), 999999)
+            timestamp = int(match.group(1)) + counter / 1000000.0
+            expect_timecode = False
+            continue
+        # awk prints every line with a newline, even the last one
+        yield timestamp, line
+        expect_timecode = True
+
+
+def read_stream_records(stream):
+    """
+    (timestamp in microseconds, data) of log data from a record boundary
+    """
+    while True:
+        header = stream.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        timestamp, size = RECORD_HEADER.unpack(header)
+        data = stream.read(size)
+        if len(data) < size:
+            return
+        yield timestamp, data
+
+
+def read_segment(path):
+    """
+    (timestamp, data) of one log file, any format
+    """
+    with open(path, 'rb') as log_f:
+        stream = open_segment(log_f)
+        if stream.read(len(MAGIC)) != MAGIC:
+            if stream is not log_f:
+                return
+            log_f.seek(0)
+            for record in read_awk_records(log_f):
+                yield record
+            return
+
+        for timestamp, data in read_stream_records(stream):
+            yield timestamp / 1000000.0, data
+
+
+def session_log_segments(path):
+    """
+    Segments of session by its log or meta path: dicts of path, started_at... from .meta
+    """
+    if path.endswith('.meta'):
+        path = path[:-len('.meta')]
+    try:
+        with open(path + '.meta') as meta_f:
+            segments = json.load(meta_f).get('log_segments')
+    except (IOError, ValueError):
+        segments = None
+    if not segments:
+        return [dict(path=path)]
+    return segments
+
+
+def session_segments(path):
+    """
+    Segment files of session by its log or meta path
+    """
+    return [segment['path'] for segment in session_log_segments(path)]
+
+
+def read_records(path):
+    """
+    (timestamp, data) of session log, all segments
+    """
+    for segment_path in session_segments(path):
+        if not os.path.exists(segment_path):
+            continue
+        for record in read_segment(segment_path):
+            yield record
+
+
+def copy_winsize(src_fd, dst_fd):
+    try:
+        winsize = fcntl.ioctl(src_fd, termios.TIOCGWINSZ, b'\0' * 8)
+        fcntl.ioctl(dst_fd, termios.TIOCSWINSZ, winsize)
+    except (IOError, OSError):
+        pass
+
+
+def record(argv, writer, timeout=None):
+    """
+    Run argv in a pty, terminal output goes to stdout and writer.
+    Returns exit code of argv, TIMEOUT_EXIT_CODE if it was terminated after timeout seconds.
+    """
+    pid, master_fd = pty.fork()
+    if pid == 0:
+        try:
+            os.execvp(argv[0], argv)
+        except OSError as e:
+            sys.stderr.write('{0}: {1}\n'.format(argv[0], e.strerror))
+        os._exit(127)
+
+    stdin_fd = sys.stdin.fileno()
+    stdout_fd = sys.stdout.fileno()
+    sys.stdout.flush()
+
+    tty_attrs = None
+    winch_handler = None
+    if os.isatty(stdin_fd):
+        copy_winsize(stdin_fd, master_fd)
+        tty_attrs = termios.tcgetattr(stdin_fd)
+        tty.setraw(stdin_fd)
+        winch_handler = signal.signal(signal.SIGWINCH, lambda *args: copy_winsize(stdin_fd, master_fd))
+
+    deadline = time() + timeout if timeout else None
+    timed_out = False
+    killed = False
+
+    fds = [master_fd, stdin_fd]
+    try:
+        while True:
+            wait = writer.flush_interval
+            if deadline is not None and not killed:
+                if not timed_out and time() >= deadline:
+                    # keep reading, output after SIGTERM goes to the log too
+                    timed_out = True
+                    os.kill(pid, signal.SIGTERM)
+                    deadline += KILL_GRACE
+                elif timed_out and time() >= deadline:
+                    # SIGTERM is ignored: whole process group of the pty session
+                    killed = True
+                    try:
+                        os.killpg(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                    deadline += KILL_GRACE
+                wait = min(wait, max(deadline - time(), 0))
+            elif killed and time() >= deadline:
+                # pty is still held open by processes outside the group
+                break
+            try:
+                ready, _, _ = select.select(fds, [], [], wait)
+            except (select.error, IOError, OSError) as e:
+                # SIGWINCH
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if master_fd in ready:
+                try:
+                    data = os.read(master_fd, READ_SIZE)
+                except OSError:
+                    # EIO: every slave side is closed
+                    data = b''
+                if not data:
+                    break
+                writer.write(data)
+                try:
+                    write_all(stdout_fd, data)
+                except OSError:
+                    pass
+
+            if stdin_fd in ready:
+                data = os.read(stdin_fd, READ_SIZE)
+                if data:
+                    write_all(master_fd, data)
+                else:
+                    fds.remove(stdin_fd)
+
+            writer.flush_due()
+    finally:
+        if tty_attrs is not None:
+            termios.tcsetattr(stdin_fd, termios.TCSAFLUSH, tty_attrs)
+            signal.signal(signal.SIGWINCH, winch_handler)
+        writer.flush()
+        os.close(master_fd)
+
+    _, status = os.waitpid(pid, 0)
+    if timed_out:
+        return TIMEOUT_EXIT_CODE
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def convert(src_path, dst_path, compression='none'):
+    writer = SessionWriter(dst_path, compression=compression)
+    try:
+        for timestamp, data in read_records(src_path):
+            writer.write(data, timestamp)
+    finally:
+        writer.close()
+    return writer
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(prog='sessionlog', epilog='------',
+                                         description='ssh.py session logs')
+    arg_parser.add_argument('action', type=str, choices=['cat', 'convert'])
+    arg_parser.add_argument('path', type=str, nargs='+')
+    arg_parser.add_argument('--compression', type=str, choices=sorted(COMPRESSORS), default='none')
+    args = arg_parser.parse_args()
+
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    if args.action == 'cat':
+        try:
+            for path in args.path:
+                for _, data in read_records(path):
+                    stdout.write(data)
+            stdout.flush()
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+
+    elif args.action == 'convert':
+        if len(args.path) != 2:
+            arg_parser.error('convert needs <source> and <destination>')
+        try:
+            writer = convert(args.path[0], args.path[1], args.compression)
+        except OSError as e:
+            sys.stderr.write('{0}: {1}\n'.format(e.filename, e.strerror))
+            sys.exit(1)
+        except ImportError as e:
+            sys.stderr.write('{0}\n'.format(e))
+            sys.exit(1)
+        for segment in writer.segments:
+            sys.stdout.write('{0}: {1} bytes\n'.format(segment['path'], segment['size']))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,13 @@ import argparse
 import logging
 import uuid
 
+import catalog
+import sessionlog
+
+# shared/metrics.py, helper.py writes its timings with it too
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'shared'))
+import metrics
+
 LOGGER = logging.getLogger('ssh-wrapper')
 LOG_FORMAT = '[%(asctime)s] [%(levelname)6s] %(name)s %(message)s'
 
@@ -26,12 +33,31 @@ data_root = '/opt/auth'
 ssh_configs_path = data_root + '/configs'
 logs_base_path = data_root + '/logs'
 
+# session logs: none, gzip or zstd (python zstandard module),
+# new segment file after log_segment_size bytes on disk
+log_compression = 'gzip'
+log_segment_size = 256 * 1024 * 1024
+
+# sessions index for audit queries, see catalog.py
+catalog_path = logs_base_path + '/catalog.db'
+
+# connection multiplexing: one ssh master per auth user and target,
+# next g to the same target skips handshake and auth (--no-mux to disable)
+ssh_multiplexing = True
+ssh_control_persist = '10m'
+mux_base_path = data_root + '/mux'
+
+# Prometheus textfile ssh.prom with startup and time to first output, '' - off;
+# sudo drops AUTH_METRICS_DIR, it is read from /etc/sysconfig/auth-metrics
+metrics_dir = metrics.configured_dir()
+
 # args prepare
 args = sys.argv[1:]
 
 
 # misc
-local_timestamp = int(time.time())
+started_at = time.time()
+local_timestamp = int(started_at)
 
 term_colors = {
     'gray': '\033[38;5;249m',
@@ -94,6 +120,16 @@ def is_valid_fqdn(hostname):
     return True
 
 
+def format_jump(user, hostname, port):
+    # ssh ProxyJump [user@]host[:port], ipv6 in brackets
+    jump = hostname
+    if port is not None:
+        jump = ('[{0}]' if ':' in hostname else '{0}').format(hostname) + ':{0}'.format(port)
+    if user is not None:
+        jump = '{0}@{1}'.format(user, jump)
+    return jump
+
+
 def verify_args(args):
 
     host = dict()
@@ -104,8 +140,13 @@ def verify_args(args):
     host['proxy_host'] = None
     host['proxy_port'] = None
     host['proxy_user'] = None
+    host['jump'] = []
+    host['command'] = args.command[0] if args.command is not None else None
+    host['timeout'] = args.timeout
     host['nosudo'] = bool(args.nosudo)
     host['debug'] = bool(args.debug)
+    # ssh -v master keeps stderr, the pty of the first session would never close
+    host['mux'] = ssh_multiplexing and not args.no_mux and not args.debug
 
     # host
     hostname = args.hostname[0]
@@ -161,9 +202,45 @@ def verify_args(args):
             host['proxy_port'] = proxy_port
             LOGGER.debug('[proxy_port] override is set: ' + str(proxy_port))
 
+    # manual proxy is the first hop
+    if host['proxy_host'] is not None:
+        host['jump'].append(format_jump(host['proxy_user'], host['proxy_host'], host['proxy_port']))
+
+    # proxy chain resolved by helper.py: [user@]host[:port],...
+    if args.jump is not None:
+        for jump in args.jump[0].split(','):
+            match = re.match(r'^(?:([A-Za-z\d\-]+)@)?(\[[0-9A-Fa-f:.]+\]|[^:@\[\]]+)(?::(\d+))?$', jump)
+            if match is None:
+                LOGGER.critical('[jump] Validation not passed')
+                sys.exit(1)
+
+            jump_user, jump_host, jump_port = match.groups()
+            jump_host = jump_host.strip('[]')
+            if not (is_valid_ipv4_address(jump_host) or is_valid_ipv6_address(jump_host) or is_valid_fqdn(jump_host)):
+                LOGGER.critical('[jump] Validation not passed')
+                sys.exit(1)
+            if jump_port is not None and not 0 < int(jump_port) <= 65535:
+                LOGGER.critical('[jump] Validation not passed')
+                sys.exit(1)
+
+            host['jump'].append(format_jump(jump_user, jump_host, jump_port))
+        LOGGER.debug('[jump] is set: ' + ','.join(host['jump']))
+
     return host
 
 
+# ControlPath per auth user, %C is a hash of local host, target host, port and user
+def mux_args(user):
+
+    control_dir = '{0}/{1}'.format(mux_base_path, user)
+    mkdir(control_dir)
+    os.chmod(control_dir, 0o700)
+
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={0}/%C'.format(control_dir),
+            '-o', 'ControlPersist={0}'.format(ssh_control_persist)]
+
+
 # make dirs and prepare files
 def init_log_file(host):
 
@@ -186,27 +263,81 @@ def init_log_file(host):
                                                             host['uuid'][:12])
 
     host['log_path'] = current_log_path
-    loger_pipe_cmd = 'tee >( awk -f {0}/timecode.awk >> {1} );'.format(working_dir, current_log_path)
+    host['log_format'] = sessionlog.FORMAT
+    host['log_compression'] = log_compression
+    host['log_segments'] = []
 
     LOGGER.debug(current_log_path)
 
-    # write logfile metadata
+    write_log_meta(host)
+
+    return current_log_path
+
+
+# logfile metadata, rewritten on every new log segment
+def write_log_meta(host):
+
     log_meta = '{0}'.format(json.dumps(host, indent=4))
-    with open(current_log_path + '.meta', 'w') as log_f:
+    meta_path = host['log_path'] + '.meta'
+    with open(meta_path + '.tmp', 'w') as log_f:
         log_f.write(log_meta)
+    os.rename(meta_path + '.tmp', meta_path)
 
     LOGGER.debug(log_meta)
 
-    return loger_pipe_cmd
 
+def update_catalog(method, host):
+    # catalog is for audit convenience, .meta files are the source of truth
+    try:
+        sessions = catalog.Catalog(catalog_path)
+        getattr(sessions, method)(host)
+        sessions.close()
+    except Exception as e:
+        LOGGER.warn('session catalog: {0}'.format(e))
 
-def run_command(cmd):
+
+def run_command(cmd, host):
 
     LOGGER.debug(cmd)
 
-    exit_code = os.system(cmd)
+    def on_segment(segments):
+        host['log_segments'] = segments
+        write_log_meta(host)
 
-    if exit_code != 0:
+    try:
+        writer = sessionlog.SessionWriter(host['log_path'], compression=host['log_compression'],
+                                          segment_size=log_segment_size, on_segment=on_segment)
+    except ImportError:
+        LOGGER.warn('zstandard module is not installed, session log is gzip compressed')
+        host['log_compression'] = 'gzip'
+        writer = sessionlog.SessionWriter(host['log_path'], compression=host['log_compression'],
+                                          segment_size=log_segment_size, on_segment=on_segment)
+
+    update_catalog('session_started', host)
+
+    # startup: wrapper own work before ssh is spawned, first_output: ssh connect and auth
+    timings = metrics.Timings(started_at)
+    spawned_at = time.time()
+    timings.add('startup', spawned_at - started_at)
+
+    exit_code = None
+    try:
+        exit_code = sessionlog.record(cmd, writer, timeout=host['timeout'])
+    finally:
+        writer.close()
+        host['ended_at'] = time.time()
+        host['log_bytes'] = writer.bytes
+        host['exit_code'] = exit_code
+        write_log_meta(host)
+        update_catalog('session_ended', host)
+
+        if writer.first_write_at is not None:
+            timings.add('first_output', writer.first_write_at - spawned_at)
+        metrics.write(metrics_dir, metrics.SSH_METRICS, 'session' if host['command'] is None else 'command',
+                      timings)
+
+    # parallel exec (helper.py x) reports exit codes itself
+    if exit_code != 0 and host['command'] is None:
         msg = 'Exit code: {1}{0}{2}'.format(exit_code, term_colors['red'], term_colors['reset'])
         msg = '\n  {0}\n'.format(msg)
         LOGGER.warn(msg)
@@ -223,11 +354,16 @@ if __name__ == '__main__':
     parser.add_argument('--nosudo', action='store_true', help='run connection without sudo terminating command')
     parser.add_argument('--config', help='DEPRECATED', type=str, nargs=1)
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--no-mux', action='store_true', help='do not share connection with other sessions')
     #
     parser.add_argument('--proxy-host', type=str, nargs=1)
     parser.add_argument('--proxy-user', type=str, nargs=1)
     parser.add_argument('--proxy-port', type=int)
     parser.add_argument('--proxy-id', type=str, nargs=1, help='just for pretty logs')
+    parser.add_argument('--jump', type=str, nargs=1, help='ProxyJump hosts: [user@]host[:port],...')
+    #
+    parser.add_argument('--command', type=str, nargs=1, help='run command instead of interactive shell')
+    parser.add_argument('--timeout', type=int, help='terminate session after seconds')
     args = parser.parse_args()
     #
     if args.debug:
@@ -245,46 +381,42 @@ if __name__ == '__main__':
     LOGGER.debug(args)
     #
     host_meta = verify_args(args)
-    log_pipe = init_log_file(host_meta)
+    init_log_file(host_meta)
     #
     ssh_args = []
-    ssh_proxy_args = []
+
+    # every session is still a separate ssh client with own pty and log,
+    # only the connection is shared
+    if host_meta['mux']:
+        ssh_args += mux_args(local_sudo_user)
+
+    # proxies: native ProxyJump, no nc on proxy hosts
+    if host_meta['jump']:
+        ssh_args += ['-J', ','.join(host_meta['jump'])]
 
     # host connection
     if args.debug:
         ssh_args.append('-v')
     if bool(host_meta['user']):
-        ssh_args.append('-l ' + str(host_meta['user']))
+        ssh_args += ['-l', str(host_meta['user'])]
     if bool(host_meta['port']):
-        ssh_args.append('-p ' + str(host_meta['port']))
+        ssh_args += ['-p', str(host_meta['port'])]
     if bool(host_meta['hostname']):
         ssh_args.append(host_meta['hostname'])
-    if host_meta['nosudo'] is False:  # if nosudo disabled <_<
-        ssh_args.append('\'sudo -i\'')
-    ssh_args = ' '.join(ssh_args)
-    ssh_args += ' 2>&1'
-
-    # ProxyCommand
-    # if configs present
-    if args.proxy_host:
-        if args.debug:
-            ssh_proxy_args.append('-v')
-        if bool(host_meta['proxy_user']):
-            ssh_proxy_args.append('-l ' + str(host_meta['proxy_user']))
-        if bool(host_meta['proxy_port']):
-            ssh_proxy_args.append('-p ' + str(host_meta['proxy_port']))
-        if bool(host_meta['proxy_host']):
-            ssh_proxy_args.append(host_meta['proxy_host'])
-
-        ssh_proxy_args = ' '.join(ssh_proxy_args)
-        proxy_cmd = '-o ProxyCommand=\'{0} {1} nc %h %p\''.format(ssh_command, ssh_proxy_args)
-
-        cmd = 'bash --norc -c "{0} -t {1} {2} | {3} "'.format(ssh_command, proxy_cmd, ssh_args, log_pipe)
-    else:
-        cmd = 'bash --norc -c "{0} -t {1} | {2} "'.format(ssh_command, ssh_args, log_pipe)
+    if host_meta['command'] is not None:
+        # no password or host key prompts nobody would answer
+        ssh_args = ['-o', 'BatchMode=yes'] + ssh_args
+        if host_meta['nosudo'] is False:
+            ssh_args.append('sudo -i ' + host_meta['command'])
+        else:
+            ssh_args.append(host_meta['command'])
+    elif host_meta['nosudo'] is False:  # if nosudo disabled <_<
+        ssh_args.append('sudo -i')
+
+    cmd = ssh_command.split() + ['-t'] + ssh_args
 
     LOGGER.debug(cmd)
     LOGGER.debug(host_meta)
 
     host_meta['cmd'] = cmd
-    run_command(cmd)
+    sys.exit(run_command(cmd, host_meta))